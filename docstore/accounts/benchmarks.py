@@ -0,0 +1,25 @@
+from django.test import Client
+
+from ..libs.benchmarks import benchmark, measure
+from .factories import TokenFactory
+from .models import token_cache
+
+
+@benchmark
+def token_authentication(repeat):
+    # Compare authenticated requests with and without the token cache.
+    token = TokenFactory()
+    client = Client()
+    
+    def call():
+        client.get('/documents/?limit=1', secure=True, HTTP_AUTHORIZATION=f'Bearer {token.uuid}')
+    
+    def uncached():
+        token_cache.clear()
+        call()
+    
+    return {
+        'uncached': measure(uncached, repeat),
+        'cached': measure(call, repeat),
+        'cache': token_cache.stats(),
+    }
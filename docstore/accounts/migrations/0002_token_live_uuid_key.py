@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='token',
+            constraint=models.UniqueConstraint(condition=models.Q(('deleted', None)), fields=('uuid',), name='token_live_uuid_key'),
+        ),
+        migrations.AlterField(
+            model_name='token',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+    ]
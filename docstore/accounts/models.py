@@ -1,22 +1,96 @@
-from uuid import uuid4
+from uuid import UUID, uuid4
 
+from django.conf import settings
+from django.db.models import Q, UniqueConstraint
 from django.db.models.deletion import PROTECT
 from django.db.models.fields import CharField, UUIDField
 from django.db.models.fields.related import ForeignKey
 
+from ..libs.caching import MISSING, ExpiringCache
 from ..libs.models import BasicModel
 
 
+# Resolved tokens by UUID.
+token_cache = ExpiringCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+
+# UUIDs known not to match a live token, kept apart so that a flood of
+# guesses can only evict each other, never the tokens in use.
+missing_token_cache = ExpiringCache(settings.TOKEN_CACHE_MISSING_SIZE, settings.TOKEN_CACHE_NEGATIVE_TTL)
+
+
+def cached_token(key):
+    # The cached token, None if it's known to be missing, or MISSING if unknown.
+    token = token_cache.get(key)
+    if token is MISSING:
+        token = missing_token_cache.get(key)
+    return token
+
+
 class Account(BasicModel):
     name = CharField(max_length=127)
     
     def __str__(self):
         return super().__str__() + ': ' + repr(self.name)
+    
+    def discard_cached(self):
+        super().discard_cached()
+        token_cache.discard_where(lambda token: token.account_id == self.pk)
 
 
 class Token(BasicModel):
     account = ForeignKey(Account, on_delete=PROTECT)
-    uuid = UUIDField(default=uuid4, editable=False, db_index=True)
+    uuid = UUIDField(default=uuid4, editable=False)
+    
+    class Meta:
+        constraints = [
+            # Serves authentication lookups through the soft-delete manager.
+            UniqueConstraint(fields=['uuid'], condition=Q(deleted=None), name='token_live_uuid_key'),
+        ]
     
     def __str__(self):
         return super().__str__() + ': ' + str(self.token)
+    
+    def discard_cached(self):
+        super().discard_cached()
+        key = UUID(str(self.uuid))
+        token_cache.discard(key)
+        missing_token_cache.discard(key)
+    
+    @classmethod
+    def authenticate(cls, value):
+        r'''Find the live token, with its live account, for a UUID string.
+            Returns None for malformed, unknown, or deleted tokens.
+            Results are cached in-process, including failures, so repeated
+            requests with the same token rarely need a database query.
+        '''#"""#'''
+        
+        try:
+            key = UUID(str(value))
+        except ValueError:
+            return None
+        
+        token = cached_token(key)
+        if token is MISSING:
+            objects = cls.objects.select_related('account').filter(account__deleted=None)
+            token = objects.filter(uuid=key).first()
+            if token is None:
+                missing_token_cache.set(key, None)
+            else:
+                token_cache.set(key, token)
+        return token
+    
+    @classmethod
+    async def authenticate_async(cls, value):
+        r'''Like authenticate(), but only leaves the event loop on a cache miss.
+        '''#"""#'''
+        
+        try:
+            key = UUID(str(value))
+        except ValueError:
+            return None
+        
+        token = cached_token(key)
+        if token is MISSING:
+            from asgiref.sync import sync_to_async
+            token = await sync_to_async(cls.authenticate)(key)
+        return token
@@ -1,8 +1,13 @@
 from json import dumps as json_encode
+from uuid import uuid4
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from ..libs.factories import fake
 from ..libs.tests import CustomTestCase
-from .models import Account, Token
+from .factories import TokenFactory
+from .models import Account, Token, missing_token_cache, token_cache
 
 
 class AccountTests(CustomTestCase):
@@ -27,3 +32,74 @@ class AccountTests(CustomTestCase):
         response = self.client.post('/accounts/', data, content_type='application/json')
         result = self.assertJsonResponse(response)
         account = self.assertCreated(Account, result.get('account', {}).get('id'), name=name)
+    
+    def test_queries(self):
+        # Registration should insert the account and its token, and nothing else.
+        with self.assertQueryBudget(exact=2):
+            response = self.client.post('/accounts/', data={'name': fake.company()})
+        self.assertJsonResponse(response)
+
+
+class TokenCacheTests(CustomTestCase):
+    def test_cached(self):
+        # Repeated authentication with the same token should not hit the database.
+        token = TokenFactory()
+        with self.assertNumQueries(1):
+            self.assertEqual(Token.authenticate(token.uuid), token)
+        with self.assertNumQueries(0):
+            found = Token.authenticate(str(token.uuid))
+        self.assertEqual(found, token)
+        self.assertEqual(found.account, token.account)
+        self.assertEqual(token_cache.stats()['hits'], 1)
+    
+    def test_unknown(self):
+        # Unknown tokens should be cached as well, to blunt guessing attacks.
+        uuid = uuid4()
+        with self.assertNumQueries(1):
+            self.assertIsNone(Token.authenticate(uuid))
+        with self.assertNumQueries(0):
+            self.assertIsNone(Token.authenticate(uuid))
+            self.assertIsNone(Token.authenticate(fake.word()))
+    
+    def test_flood(self):
+        # Unknown tokens shouldn't push the ones in use out of the cache.
+        token = TokenFactory()
+        Token.authenticate(token.uuid)
+        for n in range(token_cache.size + 1):
+            self.assertIsNone(Token.authenticate(uuid4()))
+        self.assertEqual(len(missing_token_cache.entries), missing_token_cache.size)
+        self.assertGreater(missing_token_cache.stats()['evictions'], 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(Token.authenticate(token.uuid), token)
+    
+    def test_created(self):
+        # A token created after a failed lookup should become usable immediately.
+        uuid = uuid4()
+        self.assertIsNone(Token.authenticate(uuid))
+        token = TokenFactory(uuid=uuid)
+        self.assertEqual(Token.authenticate(uuid), token)
+    
+    def test_deleted_token(self):
+        token = TokenFactory()
+        self.assertEqual(Token.authenticate(token.uuid), token)
+        token.delete()
+        self.assertIsNone(Token.authenticate(token.uuid))
+    
+    def test_deleted_account(self):
+        token = TokenFactory()
+        self.assertEqual(Token.authenticate(token.uuid), token)
+        token.account.delete()
+        self.assertIsNone(Token.authenticate(token.uuid))
+    
+    def test_index(self):
+        token = TokenFactory()
+        with CaptureQueriesContext(connection) as queries:
+            Token.authenticate(token.uuid)
+        self.assertEqual(len(queries), 1)
+        self.assertUsesIndex(queries[0]['sql'], 'token_live_uuid_key')
+    
+    def test_expiration(self):
+        uuid = uuid4()
+        token = TokenFactory(uuid=uuid)
+        missing_token_cache.set(uuid, None, ttl=-1)
+        self.assertEqual(Token.authenticate(uuid), token)
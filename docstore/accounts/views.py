@@ -1,11 +1,11 @@
-from ..libs.views import ApiResponse, ApiView
+from ..libs.views import ApiResponse, AsyncApiView
 
 from .forms import AccountRegistrationForm
 from .models import Token
 from .serializers import serialize_account, serialize_token
 
 
-class AccountList(ApiView):
+class AccountList(AsyncApiView):
     auth_required = False
     
     def post(self, request):
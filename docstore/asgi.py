@@ -0,0 +1,40 @@
+"""
+ASGI config for the docstore project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/dev/howto/deployment/asgi/
+"""
+
+import os
+
+import django
+from asgiref.sync import ThreadSensitiveContext
+from django.core.handlers.asgi import ASGIHandler
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "docstore.settings")
+
+# As in django.core.asgi.get_asgi_application(), but awaiting async views directly.
+django.setup(set_prefix=False)
+
+# Importing models has to wait until Django is set up.
+from .documents.events import events, secure
+from .libs.views import AsyncViewRouting
+
+
+class Handler(AsyncViewRouting, ASGIHandler):
+    pass
+
+
+django_application = Handler()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == '/documents/events/' and secure(scope):
+        return await events(scope, receive, send)
+    
+    # Give each request a thread of its own for synchronous code,
+    # which Django 3.2 would otherwise run in one thread for every request.
+    async with ThreadSensitiveContext():
+        return await django_application(scope, receive, send)
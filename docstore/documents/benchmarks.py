@@ -0,0 +1,410 @@
+from itertools import count, cycle
+from json import dumps as json_encode
+
+from django.test import Client, override_settings
+
+from ..accounts.factories import TokenFactory
+from ..libs.benchmarks import benchmark, fixture, measure, scale
+from ..libs.factories import fake
+from ..libs.fields import pack
+from .factories import DocumentFactory
+from .models import Blob, Document, Tally, content_digest
+from .serializers import serialize_document, serialize_documents
+
+
+# Approximate content sizes, in bytes, for each document size class.
+size_classes = {
+    'tiny': 100,
+    'small': 2000,
+    'medium': 50000,
+    'large': 1000000,
+}
+
+
+def sample_text(size):
+    text = ''
+    while len(text) < size:
+        text += "\n".join(fake.paragraphs(nb=10)) + "\n"
+    return text[:size]
+
+
+@fixture
+def dataset():
+    # Seed accounts with a token and documents each, in bulk.
+    tokens = [TokenFactory() for n in range(scale['accounts'])]
+    for token in tokens:
+        documents = DocumentFactory.build_batch(scale['documents'], account=token.account)
+        blobs = Blob.objects.acquire_many([document.content for document in documents])
+        for document, blob in zip(documents, blobs):
+            document.blob = blob
+        Document.objects.bulk_create(documents, batch_size=500)
+        Tally.objects.record([(None, document.tally_key) for document in documents], blobs)
+    return tokens
+
+
+def api_client(token):
+    return Client(HTTP_AUTHORIZATION=f'Bearer {token.uuid}')
+
+
+@benchmark
+def serialization(repeat):
+    # Serialize a page of documents, one at a time and column-wise.
+    token = dataset()[0]
+    page = list(Document.objects.filter(account=token.account).select_related('blob')[:100])
+    for document in page:
+        document.content
+    return {
+        'documents': len(page),
+        'serialize_document': measure(lambda: [serialize_document(document) for document in page], repeat),
+        'serialize_documents': measure(lambda: serialize_documents(page), repeat),
+    }
+
+
+@benchmark
+def document_list(repeat):
+    # List one account's documents, through the whole request cycle.
+    client = api_client(dataset()[0])
+    return {
+        'page': measure(lambda: client.get('/documents/', secure=True), repeat),
+        'summary': measure(lambda: client.get('/documents/?view=summary', secure=True), repeat),
+        'stream': measure(lambda: b''.join(client.get('/documents/?stream=true', secure=True).streaming_content), repeat),
+    }
+
+
+@benchmark
+def totals(repeat):
+    # Count an account's documents and bytes by scanning them, and from its tally.
+    from django.db.models import Count, Sum
+    token = dataset()[0]
+    documents = Document.objects.filter(account=token.account)
+    client = api_client(token)
+    return {
+        'documents': documents.count(),
+        'scan': measure(lambda: documents.aggregate(documents=Count('id'), bytes=Sum('blob__size')), repeat),
+        'tally': measure(lambda: Tally.objects.totals(token.account_id), repeat),
+        'endpoint': measure(lambda: client.get('/documents/totals/', secure=True), repeat),
+    }
+
+
+@benchmark
+def document_view(repeat):
+    # Read, rewrite, and delete single documents.
+    token = dataset()[0]
+    client = api_client(token)
+    account = token.account
+    code = Document.objects.filter(account=account).first().code
+    
+    # Alternate between two versions, so that every rewrite changes the content.
+    versions = cycle([{'name': fake.bs(), 'content': fake.text()} for n in range(2)])
+    
+    # Each delete needs a document of its own, including the extra calls.
+    doomed = iter(DocumentFactory.create_batch(repeat + 2, account=account))
+    
+    def put():
+        client.put(f'/documents/{code}/', json_encode(next(versions)),
+            content_type='application/json', secure=True)
+    
+    return {
+        'get': measure(lambda: client.get(f'/documents/{code}/', secure=True), repeat),
+        'put': measure(put, repeat),
+        'patch': measure(lambda: client.patch(f'/documents/{code}/', json_encode({'name': fake.bs()}),
+            content_type='application/json', secure=True), repeat),
+        'delete': measure(lambda: client.delete(f'/documents/{next(doomed).code}/', secure=True), repeat),
+    }
+
+
+@benchmark
+def middleware(repeat):
+    # Read one document through the previous middleware stack, the current one,
+    # and none at all, to find the per-request overhead of each.
+    from django.conf import settings
+    token = dataset()[0]
+    url = '/documents/%s/' % Document.objects.filter(account=token.account).first().code
+    full = list(settings.MIDDLEWARE)
+    index = full.index('docstore.libs.middleware.BrowserMiddleware')
+    full[index:index + 1] = settings.BROWSER_MIDDLEWARE
+    
+    # The differences are small, so take turns and keep each stack's best round.
+    results = {}
+    for rounds in range(3):
+        for name, stack in [('none', []), ('full', full), ('lean', settings.MIDDLEWARE)]:
+            with override_settings(MIDDLEWARE=stack):
+                client = api_client(token)
+                result = measure(lambda: client.get(url, secure=True), repeat)
+            if name not in results or result['p50_ms'] < results[name]['p50_ms']:
+                results[name] = result
+    for name in ['full', 'lean']:
+        results[name + '_overhead_ms'] = results[name]['p50_ms'] - results['none']['p50_ms']
+    return results
+
+
+@benchmark
+def content_compression(repeat):
+    # Compare stored size and latency for each compression setting.
+    results = {}
+    for size_class, size in size_classes.items():
+        content = sample_text(size)
+        results[size_class] = {}
+        for algorithm in ['none', 'zlib', 'lzma']:
+            with override_settings(CONTENT_COMPRESSION=algorithm):
+                blob = Blob.objects.create(digest=content_digest(content + algorithm), size=size, content=content)
+                
+                def write():
+                    blob.content = content
+                    blob.save()
+                
+                def read():
+                    Blob.objects.get(id=blob.id).content
+                
+                results[size_class][algorithm] = {
+                    'stored_bytes': len(pack(content)),
+                    'write': measure(write, repeat),
+                    'read': measure(read, repeat),
+                }
+    return results
+
+
+@benchmark
+def content_storage(repeat):
+    # Serve large content through the JSON view and the raw endpoint,
+    # from the database and from files, whole and by range.
+    from tempfile import TemporaryDirectory
+    token = TokenFactory()
+    client = api_client(token)
+    results = {}
+    with TemporaryDirectory() as directory:
+        for storage in ['', 'files']:
+            with override_settings(CONTENT_STORAGE=storage, CONTENT_STORAGE_DIRECTORY=directory):
+                for size_class in ['medium', 'large']:
+                    content = sample_text(size_classes[size_class]) + storage
+                    code = DocumentFactory(account=token.account, content=content).code
+                    
+                    def fetch(path, **headers):
+                        response = client.get(path, secure=True, **headers)
+                        b''.join(response.streaming_content) if response.streaming else response.content
+                    
+                    results[f'{storage or "database"}_{size_class}'] = {
+                        'json': measure(lambda: fetch(f'/documents/{code}/'), repeat),
+                        'raw': measure(lambda: fetch(f'/documents/{code}/content'), repeat),
+                        'range': measure(lambda: fetch(f'/documents/{code}/content', HTTP_RANGE='bytes=-4096'), repeat),
+                    }
+    return results
+
+
+@benchmark
+def content_upload(repeat):
+    # Replace large content through JSON and as a raw body, in the database and in files.
+    from tempfile import TemporaryDirectory
+    token = TokenFactory()
+    client = api_client(token)
+    code = DocumentFactory(account=token.account).code
+    # Fresh content every time, so that each call stores a new blob.
+    text = sample_text(size_classes['large'])
+    versions = (text + str(n) for n in count())
+    
+    def json_put():
+        client.put(f'/documents/{code}/', json_encode({'name': 'Large', 'content': next(versions)}),
+            content_type='application/json', secure=True)
+    
+    def raw_put():
+        client.put(f'/documents/{code}/content', next(versions).encode('utf-8'),
+            content_type='text/plain', secure=True)
+    
+    results = {}
+    with TemporaryDirectory() as directory:
+        for storage in ['', 'files']:
+            with override_settings(CONTENT_STORAGE=storage, CONTENT_STORAGE_DIRECTORY=directory):
+                results[storage or 'database'] = {
+                    'json': measure(json_put, repeat),
+                    'raw': measure(raw_put, repeat),
+                }
+    return results
+
+
+@benchmark
+def batch_creation(repeat, size=100):
+    # Compare one request per document against a single batch request.
+    client = api_client(TokenFactory())
+    documents = [{'name': fake.bs(), 'content': fake.text()} for n in range(size)]
+    
+    def post(path, data):
+        client.post(path, json_encode(data), content_type='application/json', secure=True)
+    
+    def single():
+        for document in documents:
+            post('/documents/', document)
+    
+    def batch():
+        post('/documents/batch/', {'operations': [dict(document, op='create') for document in documents]})
+    
+    # Each call creates a hundred documents, so a tenth of the calls will do.
+    repeat = max(1, repeat // 10)
+    return {
+        'documents': size,
+        'single': measure(single, repeat),
+        'batch': measure(batch, repeat),
+    }
+
+
+@benchmark
+def concurrency(repeat, clients=40, threads=4, chunks=5, delay=0.01):
+    # Serve many slow clients at once, each trickling its request body in chunks.
+    # WSGI mode models a thread-per-request server with a fixed pool;
+    # ASGI mode reads bodies in the event loop before handing requests to Django.
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from io import BytesIO
+    from time import perf_counter, sleep
+    from django.core.handlers.wsgi import WSGIHandler
+    from ..asgi import application
+    from ..libs.benchmarks import percentile
+    
+    token = dataset()[0]
+    body = json_encode({'note': fake.text(max_nb_chars=2000)}).encode('utf-8')
+    pieces = [body[len(body) * n // chunks:len(body) * (n + 1) // chunks] for n in range(chunks)]
+    headers = {
+        'HTTP_AUTHORIZATION': f'Bearer {token.uuid}',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    
+    class SlowInput(BytesIO):
+        # Blocks the reading thread until the whole request arrives, as servers do.
+        def read(self, size=-1):
+            wanted = len(body) - self.tell() if size < 0 else size
+            data = b''
+            while len(data) < wanted and self.tell() < len(body):
+                sleep(delay)
+                data += super().read(min(wanted - len(data), len(pieces[0])))
+            return data
+    
+    wsgi = WSGIHandler()
+    
+    def wsgi_request():
+        environ = dict(headers, REQUEST_METHOD='GET', PATH_INFO='/documents/', QUERY_STRING='view=summary&limit=10',
+            SERVER_NAME='testserver', SERVER_PORT='443', SCRIPT_NAME='', **{
+                'wsgi.input': SlowInput(body), 'wsgi.url_scheme': 'https', 'wsgi.errors': BytesIO()})
+        response = wsgi(environ, lambda status, headers: None)
+        b''.join(response)
+        response.close()
+        return perf_counter()
+    
+    async def asgi_request():
+        parts = list(pieces)
+        
+        async def receive():
+            await asyncio.sleep(delay)
+            return {'type': 'http.request', 'body': parts.pop(0), 'more_body': bool(parts)}
+        
+        async def send(message):
+            pass
+        
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'https',
+            'path': '/documents/', 'raw_path': b'/documents/', 'query_string': b'view=summary&limit=10', 'root_path': '',
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 443),
+            'headers': [
+                (b'host', b'testserver'),
+                (b'authorization', headers['HTTP_AUTHORIZATION'].encode('ascii')),
+                (b'content-type', b'application/json'),
+                (b'content-length', headers['CONTENT_LENGTH'].encode('ascii')),
+            ],
+        }
+        await application(scope, receive, send)
+        return perf_counter()
+    
+    async def asgi_batch():
+        return await asyncio.gather(*[asgi_request() for n in range(clients)])
+    
+    def summarize(run):
+        # Every client starts at once, so latency runs from the start of the batch.
+        started = perf_counter()
+        latencies = sorted(finished - started for finished in run())
+        elapsed = latencies[-1]
+        return {
+            'clients': clients,
+            'wall_ms': elapsed * 1000,
+            'requests_per_second': clients / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+        }
+    
+    with ThreadPoolExecutor(threads) as pool:
+        wsgi_mode = summarize(lambda: list(pool.map(lambda n: wsgi_request(), range(clients))))
+    return {
+        'client_upload_ms': chunks * delay * 1000,
+        'wsgi_threads': threads,
+        'wsgi': wsgi_mode,
+        'asgi': summarize(lambda: asyncio.run(asgi_batch())),
+    }
+
+
+@benchmark
+def idle_subscribers(repeat, clients=10000):
+    # Hold many event streams open through the ASGI application, then wake them all.
+    # Memory is what the streams allocate while idle, so it shows how many fit in a worker.
+    import asyncio
+    import threading
+    import tracemalloc
+    from time import perf_counter
+    from ..accounts.models import Token
+    from ..asgi import application
+    from ..libs.benchmarks import percentile
+    from ..libs.broker import broker
+    
+    token = dataset()[0]
+    Token.authenticate(token.uuid)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'https',
+        'path': '/documents/events/', 'raw_path': b'/documents/events/', 'query_string': b'', 'root_path': '',
+        'client': ('127.0.0.1', 0), 'server': ('testserver', 443),
+        'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token.uuid}'.encode('ascii'))],
+    }
+    
+    async def hold():
+        events = []
+        connected = asyncio.Event()
+        woken = asyncio.Event()
+        disconnect = asyncio.Event()
+        
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+        
+        async def send(message):
+            if message.get('body', b'').startswith(b'retry'):
+                events.append(None)
+                if len(events) == clients:
+                    connected.set()
+            elif message.get('body', b'').startswith(b'event'):
+                events.append(perf_counter())
+                if len(events) == clients * 2:
+                    woken.set()
+        
+        threads = threading.active_count()
+        tracemalloc.start()
+        started = perf_counter()
+        streams = [asyncio.ensure_future(application(dict(scope), receive, send)) for n in range(clients)]
+        await connected.wait()
+        connect = perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        idle_threads = threading.active_count() - threads
+        
+        started = perf_counter()
+        broker().publish(token.account_id)
+        await woken.wait()
+        latencies = sorted(finished - started for finished in events[clients:])
+        disconnect.set()
+        await asyncio.gather(*streams)
+        return {
+            'subscribers': clients,
+            'connect_ms': connect * 1000,
+            'kb_per_subscriber': memory / 1024 / clients,
+            'extra_threads': idle_threads,
+            'fanout_p50_ms': percentile(latencies, 0.50) * 1000,
+            'fanout_max_ms': latencies[-1] * 1000,
+        }
+    
+    with override_settings(CHANGES_SETTLE_TIME=0):
+        return asyncio.run(hold())
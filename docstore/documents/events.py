@@ -0,0 +1,190 @@
+r'''Push notifications of document changes, as server-sent events.
+    Clients hold open a GET to /documents/events/ with their bearer token,
+    and receive a `changes` event whenever documents in their account change,
+    after which they read the details from /documents/changes/.
+    Events wait out settings.CHANGES_SETTLE_TIME first, so that the change
+    feed is sure to include whatever they announce.
+
+    The stream is served straight from the ASGI application, outside of
+    Django's request handling, so that an idle client costs a coroutine
+    instead of a thread; it isn't available through WSGI.
+    Clients of WSGI servers long-poll /documents/events/poll/ instead,
+    which holds a server thread for as long as each one waits.
+'''#"""#'''
+
+import asyncio
+
+from django.db import transaction
+from django.utils import timezone
+
+from ..libs.broker import PollingBroker, broker
+
+
+# Seconds between comments sent to keep idle connections open.
+KEEPALIVE = 15
+
+# The stream's name in the metrics, as if it were a view.
+VIEW = 'document-event-stream'
+
+
+def notify(account_id):
+    r'''Tell the account's subscribers about a change, once it's committed.
+    '''#"""#'''
+
+    transaction.on_commit(lambda: broker().publish(account_id))
+
+
+def pending_change(account_id, since):
+    r'''The modification time of the earliest change past a change feed cursor,
+        whether or not it has settled yet; None if there are none.
+    '''#"""#'''
+
+    from ..libs.pagination import paginate_changes
+    from .models import Document
+    documents = Document.all_objects.filter(account_id=account_id).only('modified')
+    changes, cursor, more = paginate_changes(documents, {'since': since, 'limit': 1}, timezone.now())
+    return changes[0].modified if changes else None
+
+
+async def wait_for_changes(account_id, since, timeout):
+    r'''Wait up to `timeout` seconds for the account's change feed to report
+        something past the `since` cursor, or for any new change without one.
+        Returns whether it will, once the change has settled.
+    '''#"""#'''
+
+    from asgiref.sync import sync_to_async
+    from django.conf import settings
+    with broker().subscribe(account_id) as subscription:
+        # Subscribed first, so that changes committed during the check still wake us.
+        modified = since and await sync_to_async(pending_change)(account_id, since)
+        if not modified:
+            if not await subscription.wait(timeout):
+                return False
+            modified = timezone.now()
+    delay = settings.CHANGES_SETTLE_TIME - (timezone.now() - modified).total_seconds()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return True
+
+
+class DocumentPollingBroker(PollingBroker):
+    # Channels are account ids.
+
+    def changed(self, channels):
+        from django.db.models import Max
+        from .models import Document
+        rows = Document.all_objects.filter(account_id__in=channels).values('account_id')
+        return {row['account_id']: row['latest'] for row in rows.annotate(latest=Max('modified')).order_by()}
+
+
+def secure(scope):
+    from django.conf import settings
+    if scope.get('scheme') == 'https' or not settings.SECURE_SSL_REDIRECT:
+        return True
+    header, value = settings.SECURE_PROXY_SSL_HEADER
+    name = header[len('HTTP_'):].lower().replace('_', '-').encode('latin-1')
+    return any(key == name and data.decode('latin-1') == value for key, data in scope['headers'])
+
+
+async def respond(send, status, body, content_type=b'application/json', more_body=False):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'cache-control', b'no-cache'),
+            # Keeps proxies like nginx from holding events back.
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+async def events(scope, receive, send):
+    r'''ASGI application streaming change events for the token's account.
+        Served outside of Django's handler, so it does for itself what matters
+        of the stack: ALLOWED_HOSTS checks, metrics, error logging, and a thread
+        of its own for the token lookup, as docstore.asgi gives each request.
+        Sessions, CSRF checks, and security headers are skipped on purpose,
+        as they are for any API request with a bearer token; plain HTTP
+        requests go on to Django instead, for its redirect.
+    '''#"""#'''
+
+    try:
+        return await stream_events(scope, receive, send)
+    except Exception:
+        from logging import getLogger
+        getLogger('docstore').exception('Error handling %s to %s:', scope['method'], scope['path'])
+        raise
+
+
+def authenticate(credential, timer):
+    # Runs in a worker thread, counting any queries for the metrics.
+    from django.db import connection
+    from ..accounts.models import Token
+    with connection.execute_wrapper(timer):
+        return Token.authenticate(credential)
+
+
+async def stream_events(scope, receive, send):
+    from io import BytesIO
+    from time import perf_counter
+    from asgiref.sync import ThreadSensitiveContext, sync_to_async
+    from django.conf import settings
+    from django.core.exceptions import DisallowedHost
+    from django.core.handlers.asgi import ASGIRequest
+    from ..libs.encoding import backend
+    from ..libs.metrics import QueryTimer, collector
+
+    started = perf_counter()
+    timer = QueryTimer()
+
+    def record(status, size):
+        # Like MetricsMiddleware, streams are timed up to their headers.
+        elapsed = perf_counter() - started
+        collector.record(VIEW, scope['method'], status, elapsed, timer.queries, timer.seconds, size)
+
+    async def refuse(status, message):
+        body = backend().encode({'result': None, 'errors': message})
+        await respond(send, status, body)
+        record(status, len(body))
+
+    request = ASGIRequest(scope, BytesIO())
+    try:
+        request.get_host()
+    except DisallowedHost:
+        return await refuse(400, 'Bad Request')
+
+    token = None
+    prefix = 'bearer '
+    credential = request.META.get('HTTP_AUTHORIZATION', '')
+    if credential[:len(prefix)].lower() == prefix:
+        async with ThreadSensitiveContext():
+            token = await sync_to_async(authenticate)(credential[len(prefix):], timer)
+    if token is None:
+        return await refuse(401, 'Unauthorized')
+    if scope['method'] != 'GET':
+        return await refuse(405, 'Method Not Allowed')
+
+    # Watch for the client leaving, while waiting for something to send.
+    async def disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    gone = asyncio.ensure_future(disconnect())
+    try:
+        with broker().subscribe(token.account_id) as subscription:
+            await respond(send, 200, b'retry: 5000\n\n', content_type=b'text/event-stream', more_body=True)
+            record(200, 0)
+            while not gone.done():
+                waiting = asyncio.ensure_future(subscription.wait())
+                done, pending = await asyncio.wait([waiting, gone], timeout=KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+                if waiting in done:
+                    await asyncio.sleep(settings.CHANGES_SETTLE_TIME)
+                    message = b'event: changes\ndata: {}\n\n'
+                else:
+                    waiting.cancel()
+                    message = b': keepalive\n\n'
+                if not gone.done():
+                    await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+    finally:
+        gone.cancel()
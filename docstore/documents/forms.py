@@ -1,9 +1,16 @@
-from django.forms import ModelForm
+from django.core.exceptions import ValidationError
+from django.forms import CharField, ModelForm, Textarea
 
+from ..folders.models import Folder
 from .models import Document
 
 
 class DocumentCreationForm(ModelForm):
+    # Content lives in a shared Blob, so it isn't a model field.
+    content = CharField(widget=Textarea)
+    # A folder code; left out, the folder stays the same, and empty, there is none.
+    folder = CharField(required=False)
+    
     class Meta:
         model = Document
         fields = [
@@ -11,7 +18,40 @@ class DocumentCreationForm(ModelForm):
             'content',
         ]
     
+    def __init__(self, *args, account=None, folders=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.account = account
+        # Folders by code, when the caller has already looked them up.
+        self.folders = folders
+    
+    def clean_folder(self):
+        code = self.cleaned_data.get('folder')
+        if not code:
+            return None
+        if self.folders is not None:
+            folder = self.folders.get(code)
+        else:
+            folder = Folder.objects.filter(code=code, account=self.account).first()
+        if folder is None:
+            raise ValidationError('Unknown folder')
+        return folder
+    
     def save(self, account=None, commit=True):
         if account is not None:
             self.instance.account = account
+        if 'folder' in self.data:
+            self.instance.folder = self.cleaned_data['folder']
+        self.instance.content = self.cleaned_data['content']
         return super().save(commit=commit)
+
+
+class DocumentPatchForm(DocumentCreationForm):
+    # Only the fields sent are validated, and only those change.
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name, field in self.fields.items():
+            field.required = name in self.data and name != 'folder'
+    
+    def changes(self):
+        return {name: self.cleaned_data[name] for name in self.fields if name in self.data}
@@ -0,0 +1,53 @@
+from json import dumps as json_encode, load as json_load
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ....libs import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Time the service\'s hot paths against seeded data, reporting the results as JSON.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', metavar='benchmark',
+            help='Benchmarks to run, such as documents.document_list; all of them by default.')
+        parser.add_argument('--list', action='store_true', dest='catalog',
+            help='List the available benchmarks, without running them.')
+        parser.add_argument('--repeat', type=int, default=100,
+            help='Number of timed calls for each measurement.')
+        parser.add_argument('--accounts', type=int, default=10,
+            help='Number of accounts to seed.')
+        parser.add_argument('--documents', type=int, default=100,
+            help='Number of documents to seed for each account.')
+        parser.add_argument('--output', metavar='FILE',
+            help='Write the results to a file instead of standard output.')
+        parser.add_argument('--baseline', metavar='FILE',
+            help='Fail if the results are worse than those in an earlier output file.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+            help='Fraction by which p95 latency may exceed the baseline.')
+    
+    def handle(self, names, catalog, repeat, accounts, documents, output, baseline, tolerance, **options):
+        if catalog:
+            self.stdout.write('\n'.join(sorted(benchmarks.discover())))
+            return
+        
+        if repeat < 1 or accounts < 1 or documents < 1:
+            raise CommandError('Repeat and seed counts must be positive.')
+        
+        try:
+            results = benchmarks.run(names, repeat, accounts=accounts, documents=documents)
+        except KeyError as err:
+            raise CommandError(err.args[0])
+        
+        report = json_encode(results, indent=2, sort_keys=True)
+        if output:
+            with open(output, 'w') as out:
+                out.write(report + '\n')
+        else:
+            self.stdout.write(report)
+        
+        if baseline:
+            with open(baseline) as previous:
+                problems = list(benchmarks.regressions(results, json_load(previous), tolerance))
+            if problems:
+                raise CommandError('Performance regressed:\n' + '\n'.join(problems))
@@ -0,0 +1,78 @@
+from datetime import timedelta
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from ....libs.storage import backend as storage_backend
+from ....libs.storage import backends as storage_backends
+from ...models import Blob, Document
+
+
+class Command(BaseCommand):
+    help = 'Repair blob reference counts, and delete blobs and stored bodies that no document uses.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=3600,
+            help='Leave blobs alone until they have been unchanged for this many seconds.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Number of blobs to examine in each transaction.')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Report what would change, without changing it.')
+    
+    def handle(self, grace, batch_size, dry_run, verbosity, **options):
+        cutoff = timezone.now() - timedelta(seconds=grace)
+        
+        # Soft-deleted documents still count, so they can be restored intact.
+        references = Document.all_objects.filter(blob=OuterRef('pk'))
+        counts = references.values('blob').annotate(total=Count('id')).values('total')
+        actual = Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+        
+        repaired = collected = 0
+        stored = []
+        last = 0
+        while True:
+            batch = list(Blob.objects.filter(id__gt=last).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not batch:
+                break
+            last = batch[-1]
+            
+            with transaction.atomic():
+                # Recently touched blobs may have writes in flight.
+                settled = Blob.objects.filter(id__in=batch, modified__lt=cutoff)
+                drifted = settled.annotate(actual=actual).exclude(references=F('actual'))
+                repaired += len(drifted) if dry_run else drifted.update(references=actual)
+                
+                orphans = settled.filter(~Exists(references))
+                if dry_run:
+                    collected += orphans.count()
+                else:
+                    # Locked, so that the bodies listed belong to exactly the blobs deleted.
+                    doomed = list(orphans.select_for_update().values_list('id', 'storage', 'digest'))
+                    collected += Blob.objects.filter(id__in=[row[0] for row in doomed]).delete()[0]
+                    stored.extend(row[1:] for row in doomed if row[1])
+        
+        # Bodies go once their rows are committed gone, unless a new blob has saved them again since.
+        discarded = Blob.objects.discard(stored, before=cutoff)
+        
+        # Bodies saved for blobs whose rows never committed, and abandoned spools, have no rows at all.
+        def in_use(name, digests):
+            return Blob.objects.filter(storage=name, digest__in=digests).values_list('digest', flat=True)
+        
+        swept = 0
+        for name in storage_backends:
+            swept += storage_backend(name).sweep(cutoff, partial(in_use, name), batch_size, dry_run)
+        
+        if verbosity:
+            action = 'Would repair' if dry_run else 'Repaired'
+            self.stdout.write(f'{action} {repaired} reference counts.')
+            action = 'Would collect' if dry_run else 'Collected'
+            self.stdout.write(f'{action} {collected} unreferenced blobs.')
+            if discarded:
+                self.stdout.write(f'Discarded {discarded} stored bodies.')
+            if swept:
+                action = 'Would sweep' if dry_run else 'Swept'
+                self.stdout.write(f'{action} {swept} stray files.')
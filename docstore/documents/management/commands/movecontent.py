@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ....libs.storage import backend
+from ...models import Blob
+
+
+class Command(BaseCommand):
+    help = 'Move existing content into the storage backend named by settings.CONTENT_STORAGE, or back out of it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--out', action='store_true',
+            help='Move content from every storage backend back into the database.')
+        parser.add_argument('--batch-size', type=int, default=100,
+            help='Number of blobs to move in each transaction.')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Report what would move, without moving it.')
+
+    def handle(self, out, batch_size, dry_run, verbosity, **options):
+        storage = backend()
+        if out:
+            candidates = Blob.objects.exclude(storage='')
+            destination = 'the database'
+        elif storage is None:
+            raise CommandError('settings.CONTENT_STORAGE names no backend to move content into.')
+        else:
+            candidates = Blob.objects.filter(storage='', size__gte=storage.threshold)
+            destination = storage.name
+
+        moved = 0
+        stored = []
+        last = 0
+        while True:
+            batch = list(candidates.filter(id__gt=last).order_by('id')[:batch_size])
+            if not batch:
+                break
+            last = batch[-1].id
+            if dry_run:
+                moved += len(batch)
+                continue
+
+            with transaction.atomic():
+                for blob in batch:
+                    # Blobs never change content, so only the storage needs checking.
+                    if out:
+                        rows = Blob.objects.filter(id=blob.id, storage=blob.storage)
+                        moved += rows.update(content=blob.read(), storage='')
+                        stored.append((blob.storage, blob.digest))
+                    else:
+                        storage.save(blob.digest, blob.content.encode('utf-8'))
+                        rows = Blob.objects.filter(id=blob.id, storage='')
+                        moved += rows.update(content='', storage=storage.name)
+
+        # Readers holding rows from before the move fall back to the database.
+        Blob.objects.discard(stored)
+
+        if verbosity:
+            action = 'Would move' if dry_run else 'Moved'
+            self.stdout.write(f'{action} {moved} blobs into {destination}.')
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from ....accounts.models import Account
+from ....folders.models import Folder
+from ...models import Document, Tally
+
+
+class Command(BaseCommand):
+    help = 'Recount documents and content bytes, repairing any tallies that have drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+            help='Number of accounts to recount in each transaction.')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Report drift, without repairing it.')
+
+    def handle(self, batch_size, dry_run, verbosity, **options):
+        drifted = 0
+        last = 0
+        while True:
+            batch = list(Account.all_objects.filter(id__gt=last).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not batch:
+                break
+            last = batch[-1]
+
+            with transaction.atomic():
+                # Locking the tallies first holds writers back until the recount commits,
+                # so that each of their changes is either counted here or added afterwards.
+                tallies = Tally.objects.select_for_update().filter(account_id__in=batch)
+                tallies = {(tally.account_id, tally.folder_id): tally for tally in tallies}
+                actual = self.count(batch)
+
+                now = timezone.now()
+                changed = []
+                for key in sorted(tallies.keys() | actual.keys(), key=lambda key: (key[0], key[1] or 0)):
+                    tally = tallies.get(key) or Tally(account_id=key[0], folder_id=key[1])
+                    documents, size = actual.get(key, (0, 0))
+                    if (tally.documents, tally.bytes) == (documents, size):
+                        continue
+                    drifted += 1
+                    if verbosity > 1:
+                        owner = Folder.encode(key[1]) if key[1] else Account.encode(key[0])
+                        self.stdout.write(f'{owner}: counted {tally.documents} documents and {tally.bytes} bytes,'
+                            f' but has {documents} and {size}.')
+                    tally.documents, tally.bytes, tally.modified = documents, size, now
+                    changed.append(tally)
+
+                if not dry_run:
+                    # Rows created by writers in the meantime are left for the next run.
+                    Tally.objects.bulk_create([tally for tally in changed if tally.pk is None], ignore_conflicts=True)
+                    Tally.objects.bulk_update([tally for tally in changed if tally.pk], ['documents', 'bytes', 'modified'])
+
+        if verbosity:
+            action = 'Found' if dry_run else 'Repaired'
+            self.stdout.write(f'{action} {drifted} drifted tallies.')
+
+    def count(self, account_ids):
+        # Live documents and their bytes, for each account and folder among them.
+        documents = Document.objects.filter(account_id__in=account_ids).order_by()
+        totals = {'total': Count('id'), 'size': Sum('blob__size')}
+        counts = {}
+        for row in documents.values('account_id').annotate(**totals):
+            counts[row['account_id'], None] = (row['total'], row['size'])
+        for row in documents.exclude(folder=None).values('account_id', 'folder_id').annotate(**totals):
+            counts[row['account_id'], row['folder_id']] = (row['total'], row['size'])
+        return counts
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import docstore.libs.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0002_document_live_account_idx'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='document',
+            old_name='content',
+            new_name='plain_content',
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='plain_content',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='content',
+            field=docstore.libs.fields.CompressedTextField(null=True),
+        ),
+    ]
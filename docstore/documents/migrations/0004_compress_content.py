@@ -0,0 +1,41 @@
+from django.db import migrations, transaction
+
+
+# Rows converted per transaction; keeps locks and memory use short.
+BATCH_SIZE = 200
+
+
+def copy_content(Document, source, target):
+    last = 0
+    while True:
+        with transaction.atomic():
+            batch = Document.objects.filter(id__gt=last).order_by('id').only('id', source)[:BATCH_SIZE]
+            batch = list(batch)
+            if not batch:
+                break
+            for document in batch:
+                setattr(document, target, getattr(document, source))
+            Document.objects.bulk_update(batch, [target])
+        last = batch[-1].id
+
+
+def compress_content(apps, schema_editor):
+    copy_content(apps.get_model('documents', 'Document'), 'plain_content', 'content')
+
+
+def decompress_content(apps, schema_editor):
+    copy_content(apps.get_model('documents', 'Document'), 'content', 'plain_content')
+
+
+class Migration(migrations.Migration):
+
+    # Each batch commits separately, so large tables aren't locked throughout.
+    atomic = False
+
+    dependencies = [
+        ('documents', '0003_document_packed_content'),
+    ]
+
+    operations = [
+        migrations.RunPython(compress_content, decompress_content),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+import docstore.libs.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0004_compress_content'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='document',
+            name='plain_content',
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='content',
+            field=docstore.libs.fields.CompressedTextField(),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import docstore.libs.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0005_remove_document_plain_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('content', docstore.libs.fields.CompressedTextField()),
+                ('references', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='content',
+            field=docstore.libs.fields.CompressedTextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='documents', to='documents.blob'),
+        ),
+    ]
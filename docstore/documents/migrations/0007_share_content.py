@@ -0,0 +1,63 @@
+from hashlib import sha256
+
+from django.db import migrations, transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+# Rows converted per transaction; keeps locks and memory use short.
+BATCH_SIZE = 200
+
+
+def share_content(apps, schema_editor):
+    Blob = apps.get_model('documents', 'Blob')
+    Document = apps.get_model('documents', 'Document')
+    last = 0
+    while True:
+        with transaction.atomic():
+            batch = list(Document.objects.filter(id__gt=last).order_by('id').only('id', 'content')[:BATCH_SIZE])
+            if not batch:
+                break
+            
+            digests = {document.id: sha256(document.content.encode('utf-8')).hexdigest() for document in batch}
+            blobs = {blob.digest: blob for blob in Blob.objects.filter(digest__in=set(digests.values())).only('id', 'digest')}
+            for document in batch:
+                digest = digests[document.id]
+                if digest not in blobs:
+                    size = len(document.content.encode('utf-8'))
+                    blobs[digest] = Blob.objects.create(digest=digest, size=size, content=document.content)
+                document.blob = blobs[digest]
+            Document.objects.bulk_update(batch, ['blob'])
+        last = batch[-1].id
+    
+    # Count references once at the end, instead of once per document.
+    counts = Document.objects.filter(blob=OuterRef('pk')).values('blob').annotate(total=Count('id')).values('total')
+    Blob.objects.update(references=Coalesce(Subquery(counts, output_field=IntegerField()), 0))
+
+
+def unshare_content(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    last = 0
+    while True:
+        with transaction.atomic():
+            batch = list(Document.objects.filter(id__gt=last).order_by('id').select_related('blob').only('id', 'blob__content')[:BATCH_SIZE])
+            if not batch:
+                break
+            for document in batch:
+                document.content = document.blob.content
+            Document.objects.bulk_update(batch, ['content'])
+        last = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    # Each batch commits separately, so large tables aren't locked throughout.
+    atomic = False
+
+    dependencies = [
+        ('documents', '0006_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(share_content, unshare_content),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0007_share_content'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='document',
+            name='content',
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='documents', to='documents.blob'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('folders', '0001_initial'),
+        ('documents', '0009_document_changes_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='folder',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='documents', to='folders.folder'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(condition=models.Q(('deleted', None)), fields=['folder', 'id'], name='document_live_folder_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def count_documents(apps, schema_editor):
+    # Later changes keep these up to date; reconciletallies repairs any drift.
+    Document = apps.get_model('documents', 'Document')
+    Tally = apps.get_model('documents', 'Tally')
+    live = Document.objects.filter(deleted=None).order_by()
+    rows = []
+    for group in [('account',), ('account', 'folder')]:
+        documents = live if len(group) == 1 else live.exclude(folder=None)
+        for row in documents.values(*group).annotate(total=Count('id'), size=Sum('blob__size')):
+            rows.append(Tally(account_id=row['account'], folder_id=row.get('folder'), documents=row['total'], bytes=row['size']))
+    Tally.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('folders', '0001_initial'),
+        ('accounts', '0002_token_live_uuid_key'),
+        ('documents', '0010_document_folder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tally',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('documents', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.account')),
+                ('folder', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='folders.folder')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='tally',
+            constraint=models.UniqueConstraint(condition=models.Q(('folder', None)), fields=('account',), name='tally_account_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='tally',
+            constraint=models.UniqueConstraint(fields=('folder',), name='tally_folder_key'),
+        ),
+        migrations.RunPython(count_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0011_tally'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='storage',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
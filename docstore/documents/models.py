@@ -1,15 +1,338 @@
+from collections import Counter, defaultdict
+from hashlib import sha256
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Index, Manager, Model, Q, UniqueConstraint, Value, When
 from django.db.models.deletion import PROTECT
-from django.db.models.fields import CharField, TextField
+from django.db.models.fields import BigIntegerField, CharField, DateTimeField, IntegerField
 from django.db.models.fields.related import ForeignKey
+from django.utils import timezone
 
 from ..accounts.models import Account
+from ..libs.fields import CompressedTextField
 from ..libs.models import BasicModel
+from ..libs.storage import backend as storage_backend
+from .events import notify
+
+
+def content_digest(text):
+    return sha256(text.encode('utf-8')).hexdigest()
+
+
+class BlobManager(Manager):
+    def acquire(self, text, current=None):
+        r'''Find or create the blob holding some text, and add a reference to it.
+            If that's the blob with the `current` id, it is returned untouched,
+            because the caller already holds a reference to it.
+        '''#"""#'''
+        
+        digest = content_digest(text)
+        return self.claim(digest, lambda: self.build(digest, text), current)
+    
+    def claim(self, digest, build, current=None):
+        r'''Add a reference to the blob with some digest, as acquire() does,
+            calling build() for an unsaved blob only if there isn't one yet.
+        '''#"""#'''
+        
+        while True:
+            blob = self.only('id', 'digest', 'size').filter(digest=digest).first()
+            if blob is not None:
+                if blob.id == current:
+                    return blob
+                # The blob might have been collected in the meantime.
+                if self.filter(id=blob.id).update(references=F('references') + 1, modified=timezone.now()):
+                    return blob
+            try:
+                with transaction.atomic():
+                    blob = build()
+                    blob.references = 1
+                    blob.save(force_insert=True)
+                    return blob
+            except IntegrityError:
+                # Created by another request since our check; try again.
+                pass
+    
+    def build(self, digest, text):
+        r'''An unsaved blob for some text, its body saved to the storage backend
+            first if that takes bodies of its size.
+        '''#"""#'''
+        
+        data = text.encode('utf-8')
+        storage = storage_backend()
+        if storage is not None and storage.accepts(len(data)):
+            storage.save(digest, data)
+            return self.model(digest=digest, size=len(data), content='', storage=storage.name)
+        return self.model(digest=digest, size=len(data), content=text)
+    
+    def discard(self, stored, before=None):
+        r'''Delete the stored bodies of blobs that were collected, or moved
+            back into the database, given as (storage, digest) pairs.
+            Bodies still in use, or saved since `before` for a new blob
+            that might not be committed yet, are kept.
+        '''#"""#'''
+        
+        discarded = 0
+        for name, digest in stored:
+            if not self.filter(digest=digest, storage=name).exists():
+                discarded += storage_backend(name).discard(digest, before)
+        return discarded
+    
+    def release(self, blob_id):
+        r'''Drop a reference to a blob, leaving it for garbage collection.
+        '''#"""#'''
+        
+        self.filter(id=blob_id).update(references=F('references') - 1, modified=timezone.now())
+    
+    def acquire_many(self, texts):
+        r'''Acquire a reference to the blob for each text, in bulk.
+            Returns the blobs in the same order as the texts.
+            Costs a few queries per batch, instead of a few per text.
+        '''#"""#'''
+        
+        digests = [content_digest(text) for text in texts]
+        blobs = {blob.digest: blob for blob in self.only('id', 'digest', 'size').filter(digest__in=set(digests))}
+        missing = {}
+        for digest, text in zip(digests, texts):
+            if digest not in blobs and digest not in missing:
+                missing[digest] = self.build(digest, text)
+        if missing:
+            # Blobs created by another request in the meantime are skipped,
+            # so the ids are collected afterwards instead of from the inserts.
+            self.bulk_create(missing.values(), ignore_conflicts=True)
+            blobs.update((blob.digest, blob) for blob in self.only('id', 'digest', 'size').filter(digest__in=missing))
+        self._adjust(Counter(blobs[digest].id for digest in digests), 1)
+        return [blobs[digest] for digest in digests]
+    
+    def release_many(self, blob_ids):
+        self._adjust(Counter(blob_ids), -1)
+    
+    def _adjust(self, counts, sign):
+        # Blobs gaining the same number of references can share an UPDATE.
+        groups = defaultdict(list)
+        for blob_id, count in counts.items():
+            groups[count].append(blob_id)
+        now = timezone.now()
+        for count, blob_ids in groups.items():
+            self.filter(id__in=blob_ids).update(references=F('references') + sign * count, modified=now)
+
+
+class Blob(Model):
+    r'''Document content, stored once no matter how many documents share it.
+        References are counted for every document row, including soft-deleted
+        ones, so that deleted documents keep their content until purged.
+        Large content can live in a storage backend instead, named by
+        `storage` and keyed by digest, leaving `content` empty.
+    '''#"""#'''
+    
+    digest = CharField(max_length=64, unique=True)
+    size = BigIntegerField()
+    content = CompressedTextField()
+    storage = CharField(max_length=16, blank=True, default='')
+    references = IntegerField(default=0)
+    created = DateTimeField(default=timezone.now, editable=False)
+    modified = DateTimeField(auto_now=True, editable=False)
+    
+    objects = BlobManager()
+    
+    def __str__(self):
+        return '%s #%s (%s)' % (self.__class__.__name__, self.pk, self.digest)
+    
+    def read(self):
+        r'''The content, from wherever it's stored.
+        '''#"""#'''
+        
+        if not self.storage:
+            return self.content
+        try:
+            return storage_backend(self.storage).read(self.digest).decode('utf-8')
+        except FileNotFoundError:
+            # Moved back into the database since this row was loaded?
+            current = Blob.objects.get(id=self.id)
+            if current.storage == self.storage:
+                raise
+            return current.read()
 
 
 class Document(BasicModel):
     account = ForeignKey(Account, on_delete=PROTECT)
     name = CharField(max_length=127)
-    content = TextField()
+    blob = ForeignKey(Blob, on_delete=PROTECT, related_name='documents')
+    folder = ForeignKey('folders.Folder', null=True, blank=True, on_delete=PROTECT, related_name='documents')
+    
+    class Meta:
+        indexes = [
+            # Serves account listings through the soft-delete manager.
+            Index(fields=['account', 'id'], condition=Q(deleted=None), name='document_live_account_idx'),
+            # Serves the change feed, which includes deleted rows.
+            Index(fields=['account', 'modified', 'id'], name='document_changes_idx'),
+            # Serves folder listings, and subtree listings joined through folder paths.
+            Index(fields=['folder', 'id'], condition=Q(deleted=None), name='document_live_folder_idx'),
+        ]
     
     def __str__(self):
         return super().__str__() + ': ' + repr(self.name)
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        document = super().from_db(db, field_names, values)
+        document.remember_tally()
+        return document
+    
+    def remember_tally(self):
+        # Note what the tallies already count, unless some of it wasn't loaded.
+        if {'account_id', 'folder_id', 'blob_id', 'deleted'} <= self.__dict__.keys():
+            self._tallied = self.tally_key
+    
+    @property
+    def tally_key(self):
+        r'''What this document adds to the tallies: None when deleted,
+            or else its (account_id, folder_id, blob_id).
+        '''#"""#'''
+        
+        if self.deleted is not None:
+            return None
+        return (self.account_id, self.folder_id, self.blob_id)
+    
+    @property
+    def content(self):
+        if '_content' not in self.__dict__:
+            self._content = self.blob.read()
+        return self._content
+    
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._content_changed = True
+    
+    def refresh_from_db(self, *args, **kwargs):
+        self.__dict__.pop('_content', None)
+        self.__dict__.pop('_content_changed', None)
+        self.__dict__.pop('_tallied', None)
+        super().refresh_from_db(*args, **kwargs)
+        self.remember_tally()
+    
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self._state.adding:
+                tallied = None
+            elif '_tallied' in self.__dict__:
+                tallied = self._tallied
+            else:
+                row = Document.all_objects.values('account_id', 'folder_id', 'blob_id', 'deleted').get(pk=self.pk)
+                tallied = None if row['deleted'] else (row['account_id'], row['folder_id'], row['blob_id'])
+            
+            # Loaded blobs save looking up their sizes, old and new.
+            blobs = [self.blob] if Document.blob.is_cached(self) else []
+            previous = self.blob_id
+            if self.__dict__.get('_content_changed'):
+                self.blob = Blob.objects.acquire(self._content, current=previous)
+                blobs.append(self.blob)
+                if kwargs.get('update_fields') is not None:
+                    kwargs['update_fields'] = list({'blob', *kwargs['update_fields']})
+            super().save(*args, **kwargs)
+            if self.__dict__.pop('_content_changed', False) and previous is not None and previous != self.blob_id:
+                Blob.objects.release(previous)
+            Tally.objects.record([(tallied, self.tally_key)], blobs)
+            self._tallied = self.tally_key
+        notify(self.account_id)
+
+
+class TallyManager(Manager):
+    def totals(self, account_id, folder_id=None):
+        r'''The number of live documents and their content bytes,
+            for an account or for one of its folders, from a single row.
+        '''#"""#'''
+        
+        row = self.filter(account_id=account_id, folder_id=folder_id).values('documents', 'bytes').first()
+        return row or {'documents': 0, 'bytes': 0}
+    
+    def record(self, changes, blobs=()):
+        r'''Count documents moving from one tally key to another.
+            Each change is a pair of Document.tally_key values, from before and after;
+            None on either side means the document wasn't counted there.
+            Content sizes are taken from the given blobs when they have them,
+            or else found with one query.
+        '''#"""#'''
+        
+        changes = [(before, after) for before, after in changes if before != after]
+        if not changes:
+            return
+        sizes = {blob.id: blob.size for blob in blobs if 'size' in blob.__dict__}
+        wanted = {key[2] for pair in changes for key in pair if key is not None} - sizes.keys()
+        if wanted:
+            sizes.update(Blob.objects.filter(id__in=wanted).values_list('id', 'size'))
+        
+        deltas = defaultdict(lambda: [0, 0])
+        for before, after in changes:
+            for key, sign in [(before, -1), (after, 1)]:
+                if key is not None:
+                    account_id, folder_id, blob_id = key
+                    for row in {(account_id, None), (account_id, folder_id)}:
+                        deltas[row][0] += sign
+                        deltas[row][1] += sign * sizes[blob_id]
+        self.adjust(deltas)
+    
+    def adjust(self, deltas):
+        r'''Add to tally rows, creating them as needed, in a single UPDATE when they exist.
+            `deltas` maps (account_id, folder_id) keys to [documents, bytes] changes;
+            a folder_id of None means the row for the whole account.
+        '''#"""#'''
+        
+        deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+        if not deltas:
+            return
+        now = timezone.now()
+        rows = self.matching(deltas)
+        changed = rows.update(
+            documents = F('documents') + self.amounts(deltas, 0),
+            bytes = F('bytes') + self.amounts(deltas, 1),
+            modified = now,
+        )
+        if changed < len(deltas):
+            # Rows are created empty, so that racing requests add to them instead of
+            # overwriting each other; those just updated are known by their timestamp.
+            updated = set(rows.filter(modified=now).values_list('account_id', 'folder_id'))
+            missing = {key: delta for key, delta in deltas.items() if key not in updated}
+            self.bulk_create([self.model(account_id=account_id, folder_id=folder_id)
+                for account_id, folder_id in missing], ignore_conflicts=True)
+            self.adjust(missing)
+    
+    def matching(self, keys):
+        accounts = [account_id for account_id, folder_id in keys if folder_id is None]
+        folders = [folder_id for account_id, folder_id in keys if folder_id is not None]
+        return self.filter(Q(folder=None, account_id__in=accounts) | Q(folder_id__in=folders))
+    
+    @staticmethod
+    def amounts(deltas, index):
+        return Case(*[
+            When(Q(account_id=account_id, folder_id=folder_id), then=Value(delta[index]))
+            for (account_id, folder_id), delta in deltas.items()
+        ], default=Value(0), output_field=BigIntegerField())
+
+
+class Tally(Model):
+    r'''Running totals of live documents and their content bytes.
+        Each account has a row for all of its documents, and each folder
+        has one for the documents filed directly in it; every change to
+        a document adjusts them in the same transaction, so they can be
+        read without counting anything.  Writes within an account queue
+        up on its row, though only until each transaction commits.
+        The reconciletallies command repairs any drift.
+    '''#"""#'''
+    
+    account = ForeignKey(Account, on_delete=PROTECT)
+    folder = ForeignKey('folders.Folder', null=True, blank=True, on_delete=PROTECT)
+    documents = BigIntegerField(default=0)
+    bytes = BigIntegerField(default=0)
+    modified = DateTimeField(auto_now=True, editable=False)
+    
+    objects = TallyManager()
+    
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['account'], condition=Q(folder=None), name='tally_account_key'),
+            UniqueConstraint(fields=['folder'], name='tally_folder_key'),
+        ]
+    
+    def __str__(self):
+        return '%s #%s (%s, %s)' % (self.__class__.__name__, self.pk, self.account_id, self.folder_id)
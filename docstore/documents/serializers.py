@@ -1,13 +1,94 @@
 from ..accounts.models import Account
+from ..folders.models import Folder
+from ..libs.views import ApiException
+from .models import Document
 
 
-def serialize_document(document):
-    return {
-        'id': document.code,
-        'name': document.name,
-        'content': document.content,
-        'account': Account.encode(document.account_id),
-        'created': document.created,
-        'modified': document.modified,
-        'deleted': document.deleted,
-    }
+# Serialized keys, with the model fields required to produce each one.
+document_attributes = {
+    'id': (['id'], lambda document: document.code),
+    'name': (['name'], lambda document: document.name),
+    'content': (['blob', 'blob__content', 'blob__storage', 'blob__digest'], lambda document: document.content),
+    'account': (['account'], lambda document: Account.encode(document.account_id)),
+    'folder': (['folder'], lambda document: Folder.encode(document.folder_id) if document.folder_id else None),
+    'created': (['created'], lambda document: document.created),
+    'modified': (['modified'], lambda document: document.modified),
+    'deleted': (['deleted'], lambda document: document.deleted),
+}
+
+summary_fields = [field for field in document_attributes if field != 'content']
+
+# Enough to tell sync clients that a document is gone, and when.
+tombstone_fields = ['id', 'modified', 'deleted']
+
+
+def document_fields(params):
+    r'''Determine which keys the client wants for each document.
+        Accepts either `fields=name,modified` or `view=summary`;
+        returns None when the full document was requested.
+        The `id` key is always included, to keep documents identifiable.
+    '''#"""#'''
+    
+    if params.get('fields'):
+        fields = ['id']
+        for field in params['fields'].split(','):
+            field = field.strip()
+            if field not in document_attributes:
+                raise ApiException([f'Unknown field: {field}'])
+            if field not in fields:
+                fields.append(field)
+        return fields
+    
+    view = params.get('view', 'full')
+    if view == 'summary':
+        return summary_fields
+    if view != 'full':
+        raise ApiException([f'Unknown view: {view}'])
+    return None
+
+
+def project_documents(documents, fields):
+    r'''Restrict a document queryset to the columns needed for the given keys.
+        Keeps large content in the database when it wasn't requested,
+        and joins it into the same query when it was.
+    '''#"""#'''
+    
+    if fields is None:
+        return documents.select_related('blob')
+    
+    # The modification time is always needed, for cache validation.
+    columns = ['modified']
+    for field in fields:
+        columns.extend(document_attributes[field][0])
+    if 'content' in fields:
+        documents = documents.select_related('blob')
+    return documents.only(*columns)
+
+
+def serialize_document(document, fields=None):
+    if fields is None:
+        fields = document_attributes
+    return {field: document_attributes[field][1](document) for field in fields}
+
+
+def serialize_documents(documents, fields=None):
+    r'''Serialize a list of documents, encoding their identifiers in bulk.
+    '''#"""#'''
+    
+    if fields is None:
+        fields = list(document_attributes)
+    columns = []
+    for field in fields:
+        if field == 'id':
+            column = Document.encode_many([document.pk for document in documents])
+        elif field == 'account':
+            column = Account.encode_many([document.account_id for document in documents])
+        elif field == 'folder':
+            folder_ids = [document.folder_id for document in documents]
+            codes = iter(Folder.encode_many([folder_id for folder_id in folder_ids if folder_id]))
+            column = [next(codes) if folder_id else None for folder_id in folder_ids]
+        else:
+            getter = document_attributes[field][1]
+            column = [getter(document) for document in documents]
+        columns.append(column)
+    return [dict(zip(fields, row)) for row in zip(*columns)]
@@ -1,15 +1,25 @@
-from json import dumps as json_encode
+import os
+from datetime import timedelta
+from json import dumps as json_encode, loads as json_decode
 from random import choice
 from uuid import uuid4
 
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from factory.faker import Faker as FakeAttribute
 
 from ..libs.factories import ListFactory, fake
+from ..libs.metrics import collector
+from ..libs.pagination import encode_cursor
+from ..libs.storage import backend as storage_backend
 from ..libs.tests import CustomTestCase, Timestamp
 from ..accounts.factories import TokenFactory
 from .factories import DocumentFactory
-from .models import Document
+from .models import Blob, Document, Tally, content_digest
+from .serializers import summary_fields
 
 
 class DocumentCreationTests(CustomTestCase):
@@ -30,6 +40,7 @@ class DocumentCreationTests(CustomTestCase):
             'name': data['name'],
             'content': data['content'],
             'account': token.account.code,
+            'folder': None,
             'created': Timestamp(document.created),
             'modified': Timestamp(document.modified),
             'deleted': None,
@@ -77,6 +88,7 @@ class DocumentListTests(CustomTestCase):
             'name': document.name,
             'content': document.content,
             'account': token.account.code,
+            'folder': None,
             'created': Timestamp(document.created),
             'modified': Timestamp(document.modified),
             'deleted': None,
@@ -89,7 +101,7 @@ class DocumentListTests(CustomTestCase):
         # The number of queries should not depend on the number of documents.
         token = TokenFactory()
         documents = ListFactory(DocumentFactory, account=token.account)
-        with self.assertNumQueries(2):
+        with self.assertQueryBudget(exact=2):
             response = self.call_api('GET', '/documents/', token=token.uuid)
     
     def test_foreign(self):
@@ -112,6 +124,110 @@ class DocumentListTests(CustomTestCase):
         result = self.assertJsonResponse(response)
         collected = [doc['id'] for doc in result['documents']]
         self.assertCountEqual(collected, [doc.code for doc in documents])
+    
+    def test_pagination(self):
+        # Following the next cursor should visit every document exactly once.
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(7, account=token.account)
+        collected = []
+        path = '/documents/?limit=3'
+        for n in range(3):
+            response = self.call_api('GET', path, token=token.uuid)
+            result = self.assertJsonResponse(response)
+            self.assertLessEqual(len(result['documents']), 3)
+            collected.extend(doc['id'] for doc in result['documents'])
+            path = f"/documents/?limit=3&cursor={result['next']}"
+        self.assertIsNone(result['next'])
+        self.assertEqual(collected, [doc.code for doc in documents])
+    
+    @override_settings(MAX_PAGE_SIZE=2)
+    def test_max_limit(self):
+        # The server should refuse to return pages larger than its maximum.
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(3, account=token.account)
+        response = self.call_api('GET', '/documents/?limit=50', token=token.uuid)
+        result = self.assertJsonResponse(response)
+        self.assertEqual(len(result['documents']), 2)
+        self.assertIsNotNone(result['next'])
+    
+    @override_settings(STREAM_CHUNK_SIZE=2)
+    def test_stream(self):
+        # A streamed list should include every document, across several chunks.
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(5, account=token.account)
+        with self.assertNumQueries(1):
+            response = self.call_api('GET', '/documents/?stream=1&view=summary', token=token.uuid)
+        self.assertTrue(response.streaming)
+        with self.assertNumQueries(3):
+            result = self.assertJsonResponse(response)
+        collected = [doc['id'] for doc in result['documents']]
+        self.assertEqual(collected, [doc.code for doc in documents])
+        self.assertNotIn('content', result['documents'][0])
+    
+    def test_summary(self):
+        # The summary view should leave content in the database.
+        token = TokenFactory()
+        documents = ListFactory(DocumentFactory, account=token.account)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.call_api('GET', '/documents/?view=summary', token=token.uuid)
+        result = self.assertJsonResponse(response)
+        
+        expected = [{
+            'id': document.code,
+            'name': document.name,
+            'account': token.account.code,
+            'folder': None,
+            'created': Timestamp(document.created),
+            'modified': Timestamp(document.modified),
+            'deleted': None,
+        } for document in documents]
+        self.assertCountEqual(result.get('documents'), expected)
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"content"', queries[-1]['sql'])
+    
+    def test_fields(self):
+        token = TokenFactory()
+        documents = ListFactory(DocumentFactory, account=token.account)
+        response = self.call_api('GET', '/documents/?fields=name', token=token.uuid)
+        result = self.assertJsonResponse(response)
+        expected = [{'id': doc.code, 'name': doc.name} for doc in documents]
+        self.assertCountEqual(result.get('documents'), expected)
+    
+    def test_unknown_field(self):
+        token = TokenFactory()
+        response = self.call_api('GET', '/documents/?fields=name,secret', token=token.uuid)
+        result = self.assertJsonResponse(response, status_code=400)
+        self.assertIsNone(result)
+    
+    def test_ids(self):
+        # Documents should be fetched by code, in order, with a single query.
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(4, account=token.account)
+        foreign = DocumentFactory()
+        deleted = DocumentFactory(account=token.account)
+        deleted.delete()
+        wanted = [documents[2], documents[0], documents[3]]
+        codes = [doc.code for doc in wanted] + [foreign.code, deleted.code, 'd-' + fake.word()]
+        
+        with self.assertNumQueries(2):
+            response = self.call_api('GET', '/documents/?view=summary&ids=' + ','.join(codes), token=token.uuid)
+        result = self.assertJsonResponse(response)
+        self.assertEqual([doc['id'] for doc in result['documents']], [doc.code for doc in wanted])
+        self.assertEqual(result['missing'], codes[3:])
+    
+    def test_no_ids(self):
+        # An empty list of codes should match nothing, not everything.
+        token = TokenFactory()
+        documents = ListFactory(DocumentFactory, account=token.account)
+        response = self.call_api('GET', '/documents/?ids=', token=token.uuid)
+        result = self.assertJsonResponse(response)
+        self.assertEqual(result, {'documents': [], 'missing': []})
+    
+    def test_invalid_cursor(self):
+        token = TokenFactory()
+        response = self.call_api('GET', f'/documents/?cursor={fake.word()}!', token=token.uuid)
+        result = self.assertJsonResponse(response, status_code=400)
+        self.assertIsNone(result)
 
 
 class DocumentReadTests(CustomTestCase):
@@ -127,11 +243,24 @@ class DocumentReadTests(CustomTestCase):
             'name': document.name,
             'content': document.content,
             'account': token.account.code,
+            'folder': None,
             'created': Timestamp(document.created),
             'modified': Timestamp(document.modified),
             'deleted': None,
         }})
     
+    def test_fields(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        path = f'/documents/{document.code}/?fields=name,modified'
+        response = self.call_api('GET', path, token=token.uuid)
+        result = self.assertJsonResponse(response)
+        self.assertEqual(result, {'document': {
+            'id': document.code,
+            'name': document.name,
+            'modified': Timestamp(document.modified),
+        }})
+    
     def test_foreign(self):
         token = TokenFactory()
         document = DocumentFactory()
@@ -171,6 +300,7 @@ class DocumentUpdateTests(CustomTestCase):
             'name': data['name'],
             'content': data['content'],
             'account': token.account.code,
+            'folder': None,
             'created': Timestamp(document.created),
             'modified': Timestamp(revised.modified),
             'deleted': None,
@@ -206,6 +336,102 @@ class DocumentUpdateTests(CustomTestCase):
         self.assertIsNone(result)
 
 
+class DocumentPatchTests(CustomTestCase):
+    def test_name(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        response = self.call_api('PATCH', f'/documents/{document.code}/', {'name': 'Renamed'}, token=token.uuid)
+        result = self.assertJsonResponse(response)
+        
+        revised = Document.objects.get(id=document.id)
+        self.assertEqual(revised.name, 'Renamed')
+        self.assertEqual(revised.content, document.content)
+        self.assertEqual(revised.blob_id, document.blob_id)
+        self.assertTimestamped(revised.modified)
+        self.assertIn('ETag', response)
+        
+        # The content isn't read, so it isn't included.
+        self.assertEqual(result, {'document': {
+            'id': document.code,
+            'name': 'Renamed',
+            'account': token.account.code,
+            'folder': None,
+            'created': Timestamp(document.created),
+            'modified': Timestamp(revised.modified),
+            'deleted': None,
+        }})
+    
+    def test_content(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        content = "\n".join(fake.paragraphs())
+        response = self.call_api('PATCH', f'/documents/{document.code}/', {'content': content}, token=token.uuid)
+        self.assertJsonResponse(response)
+        
+        revised = Document.objects.get(id=document.id)
+        self.assertEqual(revised.name, document.name)
+        self.assertEqual(revised.content, content)
+        self.assertEqual(Blob.objects.get(id=revised.blob_id).references, 1)
+        self.assertEqual(Blob.objects.get(id=document.blob_id).references, 0)
+        self.assertEqual(Tally.objects.totals(token.account_id), {'documents': 1, 'bytes': len(content.encode('utf-8'))})
+    
+    def test_folder(self):
+        from ..folders.factories import FolderFactory
+        token = TokenFactory()
+        folder = FolderFactory(account=token.account)
+        document = DocumentFactory(account=token.account)
+        path = f'/documents/{document.code}/'
+        
+        result = self.assertJsonResponse(self.call_api('PATCH', path, {'folder': folder.code}, token=token.uuid))
+        self.assertEqual(result['document']['folder'], folder.code)
+        self.assertEqual(Tally.objects.totals(token.account_id, folder.id)['documents'], 1)
+        
+        result = self.assertJsonResponse(self.call_api('PATCH', path, {'folder': ''}, token=token.uuid))
+        self.assertIsNone(result['document']['folder'])
+        self.assertEqual(Tally.objects.totals(token.account_id, folder.id)['documents'], 0)
+        
+        response = self.call_api('PATCH', path, {'folder': FolderFactory().code}, token=token.uuid)
+        self.assertJsonResponse(response, status_code=400)
+    
+    def test_invalid(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        for data in [{'name': ''}, {'name': 'x' * 128}, {'content': ''}]:
+            response = self.call_api('PATCH', f'/documents/{document.code}/', data, token=token.uuid)
+            self.assertJsonResponse(response, status_code=400)
+        revised = Document.objects.get(id=document.id)
+        self.assertEqual((revised.name, revised.modified), (document.name, document.modified))
+    
+    def test_empty(self):
+        # Without any recognized fields, nothing is written or announced.
+        from unittest import mock
+        from ..libs.broker import broker
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        for data in [{}, {'title': 'Unknown'}]:
+            with mock.patch.object(broker(), 'publish') as publish:
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.call_api('PATCH', f'/documents/{document.code}/', data, token=token.uuid)
+            self.assertJsonResponse(response, status_code=400)
+            self.assertEqual(json_decode(response.content)['errors'], ['No changes'])
+            publish.assert_not_called()
+        self.assertEqual(Document.objects.get(id=document.id).modified, document.modified)
+    
+    def test_foreign(self):
+        token = TokenFactory()
+        foreign = DocumentFactory()
+        deleted = DocumentFactory(account=token.account)
+        deleted.delete()
+        for document in [foreign, deleted]:
+            for data in [{'name': 'x'}, {'content': 'x'}]:
+                response = self.call_api('PATCH', f'/documents/{document.code}/', data, token=token.uuid)
+                self.assertIsNone(self.assertJsonResponse(response, status_code=403))
+            self.assertEqual(Document.all_objects.get(id=document.id).name, document.name)
+        
+        # The blob acquired for the failed write was given back.
+        self.assertFalse(Blob.objects.filter(content='x', references__gt=0).exists())
+
+
 class DocumentDeleteTests(CustomTestCase):
     def test_delete(self):
         token = TokenFactory()
@@ -216,14 +442,16 @@ class DocumentDeleteTests(CustomTestCase):
         
         revised = Document.all_objects.get(id=document.id)
         self.assertTimestamped(revised.deleted)
+        self.assertEqual(revised.modified, revised.deleted)
         
+        # The content isn't read, so it isn't included.
         self.assertEqual(result, {'document': {
             'id': document.code,
             'name': document.name,
-            'content': document.content,
             'account': token.account.code,
+            'folder': None,
             'created': Timestamp(document.created),
-            'modified': Timestamp(document.modified),
+            'modified': Timestamp(revised.modified),
             'deleted': Timestamp(revised.deleted),
         }})
         
@@ -248,3 +476,1063 @@ class DocumentDeleteTests(CustomTestCase):
         response = self.call_api('DELETE', f'/documents/d-{fake.word()}/', token=token.uuid)
         result = self.assertJsonResponse(response, status_code=403)
         self.assertIsNone(result)
+
+
+class DocumentBatchTests(CustomTestCase):
+    def test_batch(self):
+        token = TokenFactory()
+        changed, removed = DocumentFactory.create_batch(2, account=token.account)
+        content = "\n".join(fake.paragraphs())
+        operations = [
+            {'op': 'create', 'name': fake.bs(), 'content': content},
+            {'op': 'update', 'id': changed.code, 'name': fake.bs(), 'content': content},
+            {'op': 'delete', 'id': removed.code},
+            {'op': 'create', 'name': fake.bs(), 'content': content},
+        ]
+        response = self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid)
+        result = self.assertJsonResponse(response)
+        results = [item['document'] for item in result['results']]
+        
+        created = self.assertCreated(Document, results[0]['id'], name=operations[0]['name'], content=content)
+        self.assertEqual(results[0]['content'], content)
+        self.assertEqual(results[1]['id'], changed.code)
+        self.assertEqual(results[1]['name'], operations[1]['name'])
+        self.assertEqual(results[2], {
+            'id': removed.code,
+            'name': removed.name,
+            'account': token.account.code,
+            'folder': None,
+            'created': Timestamp(removed.created),
+            'modified': Timestamp(timezone.now()),
+            'deleted': Timestamp(timezone.now()),
+        })
+        
+        revised = Document.objects.get(id=changed.id)
+        self.assertEqual(revised.name, operations[1]['name'])
+        self.assertEqual(revised.content, content)
+        self.assertTimestamped(revised.modified)
+        self.assertTimestamped(Document.all_objects.get(id=removed.id).deleted)
+        
+        # All three copies of the content should share one blob.
+        self.assertEqual(revised.blob_id, created.blob_id)
+        self.assertEqual(Blob.objects.get(id=created.blob_id).references, 3)
+        self.assertEqual(Blob.objects.get(id=changed.blob_id).references, 0)
+    
+    def test_invalid(self):
+        # A batch with any invalid operation should change nothing.
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        foreign = DocumentFactory()
+        operations = [
+            {'op': 'create', 'name': fake.bs(), 'content': fake.text()},
+            {'op': 'delete', 'id': document.code},
+            {'op': 'delete', 'id': foreign.code},
+            {'op': 'update', 'id': document.code, 'name': fake.bs(), 'content': fake.text()},
+            {'op': 'create', 'name': fake.bs()},
+            {'op': 'rename'},
+        ]
+        count = Document.all_objects.count()
+        response = self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid)
+        self.assertJsonResponse(response, status_code=400)
+        errors = json_decode(response.content)['errors']
+        self.assertEqual(errors[:2], [None, None])
+        self.assertEqual(errors[2], ['Permission Denied'])
+        self.assertEqual(errors[3], ['Duplicate document'])
+        self.assertIn('content', errors[4])
+        self.assertEqual(errors[5], ['Unknown operation'])
+        self.assertEqual(Document.all_objects.count(), count)
+        self.assertIsNone(Document.all_objects.get(id=document.id).deleted)
+    
+    @override_settings(MAX_BATCH_SIZE=2)
+    def test_limit(self):
+        token = TokenFactory()
+        operations = [{'op': 'create', 'name': fake.bs(), 'content': fake.text()} for n in range(3)]
+        response = self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid)
+        self.assertJsonResponse(response, status_code=400)
+        self.assertEqual(Document.objects.filter(account=token.account).count(), 0)
+
+
+class DocumentConditionalTests(CustomTestCase):
+    def test_read(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        path = f'/documents/{document.code}/'
+        response = self.call_api('GET', path, token=token.uuid)
+        self.assertJsonResponse(response)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+        
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, HTTP_AUTHORIZATION=f"Bearer {token.uuid}", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"content"', queries[-1]['sql'])
+        
+        response = self.client.get(path, HTTP_AUTHORIZATION=f"Bearer {token.uuid}",
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        
+        document.update(name=fake.catch_phrase())
+        response = self.client.get(path, HTTP_AUTHORIZATION=f"Bearer {token.uuid}", HTTP_IF_NONE_MATCH=etag)
+        result = self.assertJsonResponse(response)
+        self.assertEqual(result['document']['name'], document.name)
+        self.assertNotEqual(response['ETag'], etag)
+    
+    def test_if_match(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        path = f'/documents/{document.code}/'
+        etag = self.call_api('GET', path + '?view=summary', token=token.uuid)['ETag']
+        
+        # Any projection names the same version.
+        response = self.call_api('PATCH', path, {'name': 'First'}, token=token.uuid, HTTP_IF_MATCH=etag)
+        self.assertJsonResponse(response)
+        current = response['ETag']
+        self.assertNotEqual(current, etag)
+        
+        # A write based on the old version is lost, not applied.
+        for method, data in [('PATCH', {'name': 'Lost'}), ('PUT', {'name': 'Lost', 'content': 'Lost'}), ('DELETE', None)]:
+            response = self.call_api(method, path, data, token=token.uuid, HTTP_IF_MATCH=etag)
+            self.assertJsonResponse(response, status_code=412)
+        revised = Document.objects.get(id=document.id)
+        self.assertEqual((revised.name, revised.content), ('First', document.content))
+        
+        response = self.call_api('PUT', path, {'name': 'Second', 'content': 'Second'}, token=token.uuid,
+            HTTP_IF_MATCH=f'"0.0", {current}')
+        self.assertJsonResponse(response)
+        self.assertEqual(Document.objects.get(id=document.id).content, 'Second')
+        
+        response = self.call_api('DELETE', path, token=token.uuid, HTTP_IF_MATCH=response['ETag'])
+        self.assertJsonResponse(response)
+        self.assertEqual(Tally.objects.totals(token.account_id)['documents'], 0)
+    
+    def test_if_match_any(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        path = f'/documents/{document.code}/'
+        self.assertJsonResponse(self.call_api('PATCH', path, {'name': 'x'}, token=token.uuid, HTTP_IF_MATCH='*'))
+        for etag in ['W/"1.x"', '"garbage"']:
+            response = self.call_api('PATCH', path, {'name': 'y'}, token=token.uuid, HTTP_IF_MATCH=etag)
+            self.assertJsonResponse(response, status_code=412)
+        
+        document.delete()
+        response = self.call_api('PATCH', path, {'name': 'z'}, token=token.uuid, HTTP_IF_MATCH='*')
+        self.assertJsonResponse(response, status_code=403)
+    
+    def test_projection(self):
+        # Different projections of the same document are different representations.
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        full = self.call_api('GET', f'/documents/{document.code}/', token=token.uuid)
+        summary = self.call_api('GET', f'/documents/{document.code}/?view=summary', token=token.uuid)
+        self.assertNotEqual(full['ETag'], summary['ETag'])
+    
+    def test_list(self):
+        token = TokenFactory()
+        documents = ListFactory(DocumentFactory, account=token.account)
+        response = self.call_api('GET', '/documents/', token=token.uuid)
+        self.assertJsonResponse(response)
+        etag = response['ETag']
+        
+        response = self.client.get('/documents/', HTTP_AUTHORIZATION=f"Bearer {token.uuid}", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        
+        choice(documents).delete()
+        response = self.client.get('/documents/', HTTP_AUTHORIZATION=f"Bearer {token.uuid}", HTTP_IF_NONE_MATCH=etag)
+        result = self.assertJsonResponse(response)
+        self.assertEqual(len(result['documents']), len(documents) - 1)
+
+
+class DocumentStorageTests(CustomTestCase):
+    def stored(self, document):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT content FROM documents_blob WHERE id = %s', [document.blob_id])
+            return bytes(cursor.fetchone()[0])
+    
+    def test_compressed(self):
+        # Large content should be compressed in the database.
+        content = "\n".join(fake.paragraphs(nb=50))
+        document = DocumentFactory(content=content)
+        stored = self.stored(document)
+        self.assertEqual(stored[:1], b'z')
+        self.assertLess(len(stored), len(content.encode('utf-8')))
+        self.assertEqual(Document.objects.get(id=document.id).content, content)
+    
+    def test_small(self):
+        # Small content should be stored as-is.
+        content = fake.word()
+        document = DocumentFactory(content=content)
+        self.assertEqual(self.stored(document), b'=' + content.encode('utf-8'))
+        self.assertEqual(Document.objects.get(id=document.id).content, content)
+    
+    @override_settings(CONTENT_COMPRESSION='lzma')
+    def test_settings(self):
+        # Content stored under one setting should be readable under another.
+        content = "\n".join(fake.paragraphs(nb=50))
+        document = DocumentFactory(content=content)
+        self.assertEqual(self.stored(document)[:1], b'x')
+        with self.settings(CONTENT_COMPRESSION='none'):
+            self.assertEqual(Document.objects.get(id=document.id).content, content)
+    
+    def test_lazy(self):
+        # Content should not be decompressed until it gets used.
+        content = "\n".join(fake.paragraphs(nb=50))
+        document = DocumentFactory(content=content)
+        blob = Blob.objects.get(id=document.blob_id)
+        blob.save()
+        self.assertNotIsInstance(blob.__dict__['content'], str)
+        self.assertEqual(blob.content, content)
+        self.assertEqual(Document.objects.get(id=document.id).content, content)
+    
+    def test_shared(self):
+        # Documents with identical content should share a single blob.
+        content = "\n".join(fake.paragraphs())
+        first = DocumentFactory(content=content)
+        second = DocumentFactory(content=content)
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(Blob.objects.get(id=first.blob_id).references, 2)
+    
+    def test_replaced(self):
+        # Replacing content should move the reference to the new blob.
+        token = TokenFactory()
+        content = "\n".join(fake.paragraphs())
+        first = DocumentFactory(content=content, account=token.account)
+        second = DocumentFactory(content=content, account=token.account)
+        data = {'name': first.name, 'content': "\n".join(fake.paragraphs())}
+        response = self.call_api('PUT', f'/documents/{first.code}/', data, token=token.uuid)
+        self.assertJsonResponse(response)
+        
+        revised = Document.objects.get(id=first.id)
+        self.assertNotEqual(revised.blob_id, second.blob_id)
+        self.assertEqual(Blob.objects.get(id=revised.blob_id).references, 1)
+        self.assertEqual(Blob.objects.get(id=second.blob_id).references, 1)
+        
+        # Writing the same content again should leave the counts alone.
+        response = self.call_api('PUT', f'/documents/{first.code}/', data, token=token.uuid)
+        self.assertJsonResponse(response)
+        self.assertEqual(Blob.objects.get(id=revised.blob_id).references, 1)
+    
+    def test_collection(self):
+        # Unreferenced blobs should be collected, but not those of deleted documents.
+        from django.core.management import call_command
+        document = DocumentFactory()
+        deleted = DocumentFactory()
+        deleted.delete()
+        orphan = document.blob_id
+        document.content = "\n".join(fake.paragraphs())
+        document.save()
+        Blob.objects.filter(id=deleted.blob_id).update(references=5)
+        
+        call_command('collectblobs', grace=0, verbosity=0)
+        self.assertEqual(Blob.objects.get(id=deleted.blob_id).references, 1)
+        self.assertFalse(Blob.objects.filter(id=orphan).exists())
+        self.assertTrue(Blob.objects.filter(id=document.blob_id).exists())
+        self.assertEqual(Document.all_objects.get(id=deleted.id).content, deleted.content)
+
+
+class DocumentFileStorageTests(CustomTestCase):
+    def setUp(self):
+        from tempfile import TemporaryDirectory
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = self.settings(CONTENT_STORAGE='files', CONTENT_STORAGE_DIRECTORY=directory.name,
+            CONTENT_STORAGE_THRESHOLD=100)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.storage = storage_backend('files')
+    
+    def large(self):
+        return 'Ünïcode ' + "\n".join(fake.paragraphs(nb=20))
+    
+    def raw(self, token, document, **headers):
+        response = self.call_api('GET', f'/documents/{document.code}/content', token=token.uuid, **headers)
+        if response.streaming:
+            return response, b''.join(response.streaming_content)
+        return response, response.content
+    
+    def test_stored(self):
+        # Large content goes to a file, leaving the row with a reference; small content stays in the row.
+        token = TokenFactory()
+        content = self.large()
+        data = {'name': fake.bs(), 'content': content}
+        result = self.assertJsonResponse(self.call_api('POST', '/documents/', data, token=token.uuid))
+        document = Document.objects.get(code=result['document']['id'])
+        blob = Blob.objects.get(id=document.blob_id)
+        self.assertEqual((blob.storage, blob.content, blob.size), ('files', '', len(content.encode('utf-8'))))
+        self.assertEqual(self.storage.read(blob.digest), content.encode('utf-8'))
+        self.assertEqual(document.content, content)
+        
+        result = self.assertJsonResponse(self.call_api('GET', f'/documents/{document.code}/', token=token.uuid))
+        self.assertEqual(result['document']['content'], content)
+        page = self.assertJsonResponse(self.call_api('GET', '/documents/', token=token.uuid))
+        self.assertEqual(page['documents'][0]['content'], content)
+        
+        small = DocumentFactory(content='Short.')
+        self.assertEqual(Blob.objects.get(id=small.blob_id).storage, '')
+        
+        # Shared content is stored once.
+        operations = [{'op': 'create', 'name': fake.bs(), 'content': content}]
+        self.assertJsonResponse(self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid))
+        self.assertEqual(Blob.objects.get(id=blob.id).references, 2)
+    
+    def test_content(self):
+        token = TokenFactory()
+        content = self.large()
+        for document in [DocumentFactory(account=token.account, content=content),
+                DocumentFactory(account=token.account, content='Ünïcode, inline.')]:
+            expected = document.content.encode('utf-8')
+            response, body = self.raw(token, document)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body, expected)
+            self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+            self.assertEqual(response['Content-Length'], str(len(expected)))
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            self.assertNotIn('Content-Disposition', response)
+            
+            etag = response['ETag']
+            response, body = self.raw(token, document, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual((response.status_code, body), (304, b''))
+    
+    def test_range(self):
+        token = TokenFactory()
+        content = self.large()
+        for document in [DocumentFactory(account=token.account, content=content),
+                DocumentFactory(account=token.account, content='Ünïcode, inline.')]:
+            expected = document.content.encode('utf-8')
+            size = len(expected)
+            etag = self.raw(token, document)[0]['ETag']
+            for header, start, stop in [('bytes=0-9', 0, 10), ('bytes=3-', 3, size), ('bytes=-5', size - 5, size),
+                    (f'bytes=4-{size * 2}', 4, size), (f'bytes={size - 1}-', size - 1, size)]:
+                response, body = self.raw(token, document, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206, header)
+                self.assertEqual(body, expected[start:stop], header)
+                self.assertEqual(response['Content-Range'], f'bytes {start}-{stop - 1}/{size}')
+                self.assertEqual(response['Content-Length'], str(stop - start))
+            
+            # Past the end, nothing can be sent.
+            response, body = self.raw(token, document, HTTP_RANGE=f'bytes={size}-')
+            self.assertJsonResponse(response, status_code=416)
+            self.assertEqual(response['Content-Range'], f'bytes */{size}')
+            
+            # Several ranges, or ranges of another version, get the whole body.
+            for headers in [{'HTTP_RANGE': 'bytes=0-1,4-5'}, {'HTTP_RANGE': 'bytes=0-1', 'HTTP_IF_RANGE': '"other"'},
+                    {'HTTP_RANGE': 'lines=1-2'}, {'HTTP_RANGE': 'bytes=5-2'}]:
+                response, body = self.raw(token, document, **headers)
+                self.assertEqual((response.status_code, body), (200, expected))
+            response, body = self.raw(token, document, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag)
+            self.assertEqual((response.status_code, body), (206, expected[:2]))
+    
+    def test_foreign(self):
+        token = TokenFactory()
+        deleted = DocumentFactory(account=token.account, content=self.large())
+        deleted.delete()
+        for document in [DocumentFactory(content=self.large()), deleted]:
+            response = self.call_api('GET', f'/documents/{document.code}/content', token=token.uuid)
+            self.assertJsonResponse(response, status_code=403)
+        response = self.call_api('GET', f'/documents/{deleted.code}/content')
+        self.assertJsonResponse(response, status_code=401)
+    
+    def test_move(self):
+        from io import StringIO
+        from django.core.management import call_command
+        with self.settings(CONTENT_STORAGE=''):
+            documents = [DocumentFactory(content=self.large()) for n in range(3)] + [DocumentFactory(content='Short.')]
+        self.assertFalse(Blob.objects.exclude(storage='').exists())
+        
+        out = StringIO()
+        call_command('movecontent', dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'Would move 3 blobs into files.\n')
+        self.assertFalse(Blob.objects.exclude(storage='').exists())
+        
+        call_command('movecontent', batch_size=2, stdout=out)
+        self.assertIn('Moved 3 blobs into files.', out.getvalue())
+        blobs = {blob.id: blob for blob in Blob.objects.all()}
+        for document in documents[:3]:
+            blob = blobs[document.blob_id]
+            self.assertEqual((blob.storage, blob.content), ('files', ''))
+            self.assertEqual(self.storage.read(blob.digest), document.content.encode('utf-8'))
+        self.assertEqual(blobs[documents[3].blob_id].storage, '')
+        
+        # Rows loaded before moving back out still find their content.
+        stale = [Document.objects.select_related('blob').get(id=document.id) for document in documents]
+        call_command('movecontent', out=True, stdout=out)
+        self.assertIn('Moved 3 blobs into the database.', out.getvalue())
+        self.assertFalse(Blob.objects.exclude(storage='').exists())
+        for document, loaded in zip(documents, stale):
+            self.assertFalse(os.path.exists(self.storage.path(loaded.blob.digest)))
+            self.assertEqual(loaded.content, document.content)
+            self.assertEqual(Document.objects.get(id=document.id).content, document.content)
+        
+        with self.settings(CONTENT_STORAGE=''):
+            with self.assertRaises(CommandError):
+                call_command('movecontent', stdout=out)
+    
+    def test_collect(self):
+        from io import StringIO
+        from django.core.management import call_command
+        kept = DocumentFactory(content=self.large())
+        orphan = Blob.objects.acquire(self.large())
+        Blob.objects.release(orphan.id)
+        self.assertTrue(os.path.exists(self.storage.path(orphan.digest)))
+        
+        out = StringIO()
+        call_command('collectblobs', grace=0, stdout=out)
+        self.assertIn('Collected 1 unreferenced blobs.', out.getvalue())
+        self.assertIn('Discarded 1 stored bodies.', out.getvalue())
+        self.assertFalse(os.path.exists(self.storage.path(orphan.digest)))
+        self.assertEqual(Document.objects.get(id=kept.id).content, kept.content)
+        
+        # Bodies saved again since the cutoff might belong to a new blob.
+        self.storage.save(orphan.digest, b'Recent')
+        self.assertFalse(Blob.objects.discard([('files', orphan.digest)], before=timezone.now() - timedelta(minutes=1)))
+        self.assertTrue(os.path.exists(self.storage.path(orphan.digest)))
+    
+    def test_sweep(self):
+        # Files left by rolled back writes have no rows, but go once they're old enough.
+        from io import StringIO
+        from django.core.management import call_command
+        kept = DocumentFactory(content=self.large())
+        kept_path = self.storage.path(Document.objects.get(id=kept.id).blob.digest)
+        stray = content_digest('Rolled back')
+        self.storage.save(stray, b'Rolled back')
+        temporary, stream = self.storage.spool()
+        with stream:
+            stream.write(b'Abandoned')
+        
+        out = StringIO()
+        call_command('collectblobs', stdout=out)
+        self.assertNotIn('stray', out.getvalue())
+        self.assertTrue(os.path.exists(temporary))
+        
+        old = (timezone.now() - timedelta(hours=2)).timestamp()
+        for path in [kept_path, self.storage.path(stray), temporary]:
+            os.utime(path, (old, old))
+        out = StringIO()
+        call_command('collectblobs', dry_run=True, stdout=out)
+        self.assertIn('Would sweep 2 stray files.', out.getvalue())
+        self.assertTrue(os.path.exists(temporary))
+        
+        out = StringIO()
+        call_command('collectblobs', batch_size=1, stdout=out)
+        self.assertIn('Swept 2 stray files.', out.getvalue())
+        self.assertFalse(os.path.exists(self.storage.path(stray)))
+        self.assertFalse(os.path.exists(temporary))
+        self.assertTrue(os.path.exists(kept_path))
+        self.assertEqual(Document.objects.get(id=kept.id).content, kept.content)
+    
+    def test_queries(self):
+        # Serving content costs one query beyond authentication, wherever it's stored.
+        for content in [self.large(), 'Short.']:
+            token = TokenFactory()
+            document = DocumentFactory(account=token.account, content=content)
+            with self.assertQueryBudget(exact=2):
+                self.assertEqual(self.raw(token, document)[1], content.encode('utf-8'))
+
+
+class DocumentUploadTests(CustomTestCase):
+    def upload(self, token, document, body, content_type='text/plain', **headers):
+        return self.client.generic('PUT', f'/documents/{document.code}/content', body, content_type=content_type,
+            HTTP_AUTHORIZATION=f'Bearer {token.uuid}', **headers)
+    
+    def test_upload(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        content = 'Ünïcode ' + "\n".join(fake.paragraphs(nb=50)) + '\n'
+        with self.settings(UPLOAD_CHUNK_SIZE=7):
+            response = self.upload(token, document, content.encode('utf-8'))
+        result = self.assertJsonResponse(response)
+        self.assertEqual(set(result['document']), set(summary_fields))
+        self.assertIn('ETag', response)
+        
+        # Stored exactly as sent, whitespace and all, and compressed like any other content.
+        revised = Document.objects.get(id=document.id)
+        self.assertEqual(revised.content, content)
+        blob = Blob.objects.get(id=revised.blob_id)
+        self.assertEqual((blob.digest, blob.size, blob.references), (content_digest(content), len(content.encode('utf-8')), 1))
+        self.assertEqual(pack_blob(blob)[:1], b'z')
+        self.assertEqual(Blob.objects.get(id=document.blob_id).references, 0)
+        self.assertEqual(Tally.objects.totals(token.account_id)['bytes'], blob.size)
+        
+        # The same content again shares the blob.
+        other = DocumentFactory(account=token.account)
+        self.assertJsonResponse(self.upload(token, other, content.encode('utf-8'), 'application/octet-stream'))
+        self.assertEqual(Document.objects.get(id=other.id).blob_id, blob.id)
+    
+    def test_storage(self):
+        from tempfile import TemporaryDirectory
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        large = "\n".join(fake.paragraphs(nb=20)).encode('utf-8')
+        with TemporaryDirectory() as directory, self.settings(CONTENT_STORAGE='files',
+                CONTENT_STORAGE_DIRECTORY=directory, CONTENT_STORAGE_THRESHOLD=100, UPLOAD_CHUNK_SIZE=64):
+            storage = storage_backend('files')
+            self.assertJsonResponse(self.upload(token, document, large))
+            blob = Document.objects.select_related('blob').get(id=document.id).blob
+            self.assertEqual((blob.storage, blob.content), ('files', ''))
+            self.assertEqual(storage.read(blob.digest), large)
+            
+            self.assertJsonResponse(self.upload(token, document, b'Short.'))
+            self.assertEqual(Document.objects.get(id=document.id).content, 'Short.')
+            self.assertEqual(Document.objects.get(id=document.id).blob.storage, '')
+            
+            # Nothing spooled is left behind, whether kept, refused, or unused.
+            self.assertJsonResponse(self.upload(token, DocumentFactory(account=token.account), large))
+            self.assertJsonResponse(self.upload(token, document, b'\xff' * 200), status_code=400)
+            self.assertEqual([name for name in os.listdir(directory) if name.startswith('.')], [])
+    
+    def test_invalid(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        for body, content_type, status in [
+            (b'Caf\xe9', 'text/plain', 400),
+            (b'Truncated \xc3', 'text/plain', 400),
+            (b'x' * 21, 'text/plain', 413),
+            (b'{"content": "x"}', 'application/json', 415),
+            (b'Latin', 'text/plain; charset=latin-1', 415),
+        ]:
+            with self.settings(MAX_UPLOAD_SIZE=20, UPLOAD_CHUNK_SIZE=3):
+                response = self.upload(token, document, body, content_type)
+            self.assertJsonResponse(response, status_code=status)
+        
+        # The test client sends neither header for an empty body, so add them back one by one.
+        self.assertJsonResponse(self.upload(token, document, b''), status_code=415)
+        self.assertJsonResponse(self.upload(token, document, b'', CONTENT_TYPE='text/plain'), status_code=411)
+        response = self.upload(token, document, b'', CONTENT_TYPE='text/plain', CONTENT_LENGTH='0')
+        self.assertJsonResponse(response, status_code=400)
+        
+        response = self.upload(token, document, 'Fine', 'text/plain; charset=UTF-8')
+        self.assertJsonResponse(response)
+        self.assertEqual(Document.objects.get(id=document.id).content, 'Fine')
+    
+    def test_foreign(self):
+        token = TokenFactory()
+        deleted = DocumentFactory(account=token.account)
+        deleted.delete()
+        for document in [DocumentFactory(), deleted]:
+            with self.assertQueryBudget(maximum=2):
+                self.assertJsonResponse(self.upload(token, document, b'Taken over'), status_code=403)
+            self.assertEqual(Document.all_objects.get(id=document.id).content, document.content)
+        self.assertFalse(Blob.objects.filter(digest=content_digest('Taken over')).exists())
+    
+    def test_if_match(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        etag = self.call_api('GET', f'/documents/{document.code}/?view=summary', token=token.uuid)['ETag']
+        response = self.upload(token, document, b'First', HTTP_IF_MATCH=etag)
+        self.assertEqual(self.assertJsonResponse(response)['document']['id'], document.code)
+        self.assertJsonResponse(self.upload(token, document, b'Second', HTTP_IF_MATCH=etag), status_code=412)
+        self.assertEqual(Document.objects.get(id=document.id).content, 'First')
+    
+    def test_packer(self):
+        # Packing in pieces matches packing the whole.
+        from ..libs.fields import Packer, pack, unpack
+        for compression in ['zlib', 'lzma', 'none']:
+            with self.settings(CONTENT_COMPRESSION=compression):
+                for content in ['Short.', "\n".join(fake.paragraphs(nb=50))]:
+                    data = content.encode('utf-8')
+                    packer = Packer()
+                    for start in range(0, len(data), 100):
+                        packer.write(data[start:start + 100])
+                    packed = packer.packed()
+                    self.assertEqual(packed[:1], pack(content)[:1])
+                    self.assertEqual(unpack(packed), content)
+
+
+def pack_blob(blob):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT content FROM documents_blob WHERE id = %s', [blob.id])
+        return bytes(cursor.fetchone()[0])
+
+
+@override_settings(CHANGES_SETTLE_TIME=0)
+class DocumentChangesTests(CustomTestCase):
+    def sync(self, token, since=None, limit=None):
+        params = [f'{key}={value}' for key, value in [('since', since), ('limit', limit)] if value]
+        response = self.call_api('GET', '/documents/changes/?' + '&'.join(params), token=token.uuid)
+        return self.assertJsonResponse(response)
+    
+    def test_changes(self):
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(3, account=token.account)
+        foreign = DocumentFactory()
+        result = self.sync(token)
+        self.assertEqual([doc['id'] for doc in result['documents']], [doc.code for doc in documents])
+        self.assertEqual(result['documents'][0]['content'], documents[0].content)
+        self.assertEqual(result['deleted'], [])
+        self.assertFalse(result['more'])
+        
+        # Nothing new means nothing to send, and the same cursor to keep.
+        since = result['next']
+        result = self.sync(token, since)
+        self.assertEqual(result, {'documents': [], 'deleted': [], 'next': since, 'more': False})
+        
+        data = {'name': fake.bs(), 'content': fake.text()}
+        self.assertJsonResponse(self.call_api('PUT', f'/documents/{documents[1].code}/', data, token=token.uuid))
+        self.assertJsonResponse(self.call_api('DELETE', f'/documents/{documents[2].code}/', token=token.uuid))
+        result = self.sync(token, since)
+        self.assertEqual([doc['id'] for doc in result['documents']], [documents[1].code])
+        self.assertEqual(result['documents'][0]['content'], data['content'])
+        deleted = Document.all_objects.get(id=documents[2].id)
+        self.assertEqual(result['deleted'], [{
+            'id': documents[2].code,
+            'modified': Timestamp(deleted.modified),
+            'deleted': Timestamp(deleted.deleted),
+        }])
+        self.assertEqual(self.sync(token, result['next'])['documents'], [])
+    
+    def test_ties(self):
+        # Rows sharing a timestamp should each be reported once, across pages.
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(7, account=token.account)
+        Document.objects.filter(id__in=[doc.id for doc in documents[1:5]]).update(modified=documents[0].modified)
+        collected = []
+        since = None
+        for n in range(3):
+            result = self.sync(token, since, limit=3)
+            collected.extend(doc['id'] for doc in result['documents'])
+            since = result['next']
+        self.assertFalse(result['more'])
+        self.assertEqual(collected, [doc.code for doc in documents])
+    
+    def test_fields(self):
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(2, account=token.account)
+        documents[0].delete()
+        response = self.call_api('GET', '/documents/changes/?view=summary', token=token.uuid)
+        result = self.assertJsonResponse(response)
+        self.assertEqual([doc['id'] for doc in result['documents']], [documents[1].code])
+        self.assertNotIn('content', result['documents'][0])
+        self.assertIsNone(result['documents'][0]['deleted'])
+        self.assertEqual([doc['id'] for doc in result['deleted']], [documents[0].code])
+    
+    @override_settings(CHANGES_SETTLE_TIME=60)
+    def test_settle(self):
+        # Recent changes wait, in case an earlier transaction has yet to commit.
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(2, account=token.account)
+        Document.objects.filter(id=documents[0].id).update(modified=timezone.now() - timedelta(minutes=5))
+        result = self.sync(token)
+        self.assertEqual([doc['id'] for doc in result['documents']], [documents[0].code])
+        self.assertFalse(result['more'])
+    
+    def test_open_transaction(self):
+        # Changes wait for older transactions still open, which could yet commit earlier changes.
+        from unittest import mock
+        from ..libs.models import oldest_transaction
+        self.assertIsNone(oldest_transaction(connection))
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(2, account=token.account)
+        Document.objects.filter(id=documents[0].id).update(modified=timezone.now() - timedelta(minutes=5))
+        began = timezone.now() - timedelta(minutes=1)
+        with mock.patch('docstore.documents.views.oldest_transaction', return_value=began):
+            result = self.sync(token)
+        self.assertEqual([doc['id'] for doc in result['documents']], [documents[0].code])
+        result = self.sync(token, result['next'])
+        self.assertEqual([doc['id'] for doc in result['documents']], [documents[1].code])
+    
+    def test_invalid_cursor(self):
+        token = TokenFactory()
+        # Cursors from the document list don't carry a timestamp.
+        for since in [fake.word() + '!', encode_cursor(1)]:
+            response = self.call_api('GET', f'/documents/changes/?since={since}', token=token.uuid)
+            self.assertIsNone(self.assertJsonResponse(response, status_code=400))
+
+
+@override_settings(CHANGES_SETTLE_TIME=0)
+class DocumentEventsTests(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        collector.clear()
+    
+    def test_notify(self):
+        # Every way of changing documents should notify the account's subscribers.
+        from unittest import mock
+        from ..libs.broker import broker
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        changes = [
+            ('POST', '/documents/', {'name': fake.bs(), 'content': fake.text()}),
+            ('PUT', f'/documents/{document.code}/', {'name': fake.bs(), 'content': fake.text()}),
+            ('DELETE', f'/documents/{document.code}/', None),
+            ('POST', '/documents/batch/', {'operations': [{'op': 'create', 'name': fake.bs(), 'content': fake.text()}]}),
+        ]
+        for method, path, data in changes:
+            with self.subTest(method=method, path=path):
+                with mock.patch.object(broker(), 'publish') as publish:
+                    with self.captureOnCommitCallbacks(execute=True):
+                        self.assertJsonResponse(self.call_api(method, path, data, token=token.uuid))
+                publish.assert_called_with(token.account.id)
+    
+    async def test_events(self):
+        import asyncio
+        from asgiref.sync import sync_to_async
+        from ..libs.broker import broker
+        from .events import events
+        token = await sync_to_async(TokenFactory)()
+        
+        def create():
+            with self.captureOnCommitCallbacks(execute=True):
+                DocumentFactory(account=token.account)
+        
+        messages = asyncio.Queue()
+        requests = asyncio.Queue()
+        scope = {
+            'type': 'http', 'method': 'GET', 'scheme': 'https', 'path': '/documents/events/',
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token.uuid}'.encode('ascii'))],
+        }
+        task = asyncio.ensure_future(events(scope, requests.get, messages.put))
+        start = await asyncio.wait_for(messages.get(), 1)
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+        self.assertEqual((await asyncio.wait_for(messages.get(), 1))['body'], b'retry: 5000\n\n')
+        self.assertEqual(broker().subscribers(), 1)
+        
+        await sync_to_async(create)()
+        message = await asyncio.wait_for(messages.get(), 1)
+        self.assertEqual(message['body'], b'event: changes\ndata: {}\n\n')
+        self.assertTrue(message['more_body'])
+        
+        await requests.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(task, 1)
+        self.assertEqual(broker().subscribers(), 0)
+        
+        # Streams show up in the metrics like views, timed up to their headers.
+        row = collector.snapshot()[('document-event-stream', 'GET', 200)]
+        self.assertEqual(row[0], 1)
+    
+    def test_poll(self):
+        from threading import Thread
+        from time import sleep
+        from ..libs.broker import broker
+        token = TokenFactory()
+        
+        def poll(query, status_code=200):
+            response = self.call_api('GET', f'/documents/events/poll/?{query}', token=token.uuid)
+            return self.assertJsonResponse(response, status_code=status_code)
+        
+        DocumentFactory(account=token.account)
+        since = self.assertJsonResponse(self.call_api('GET', '/documents/changes/', token=token.uuid))['next']
+        self.assertEqual(poll('timeout=0'), {'changed': False})
+        self.assertEqual(poll(f'since={since}&timeout=0'), {'changed': False})
+        
+        # Changes already past the cursor return at once.
+        DocumentFactory(account=token.account)
+        self.assertEqual(poll(f'since={since}&timeout=0'), {'changed': True})
+        
+        # Otherwise, the poll waits for a notification.
+        def publish():
+            while not broker().subscribers():
+                sleep(0.01)
+            broker().publish(token.account.id)
+        
+        thread = Thread(target=publish)
+        thread.start()
+        self.assertEqual(poll('timeout=5'), {'changed': True})
+        thread.join()
+        self.assertEqual(broker().subscribers(), 0)
+        
+        for timeout in ['soon', '-1', 'nan']:
+            self.assertIsNone(poll(f'timeout={timeout}', status_code=400))
+        self.assertIsNone(poll('since=bogus!&timeout=0', status_code=400))
+    
+    def test_polling(self):
+        from .events import DocumentPollingBroker
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(2, account=token.account)
+        documents[0].delete()
+        latest = max(Document.all_objects.filter(account=token.account).values_list('modified', flat=True))
+        other = TokenFactory()
+        changed = DocumentPollingBroker().changed([token.account.id, other.account.id])
+        self.assertEqual(changed, {token.account.id: latest})
+    
+    async def test_unauthorized(self):
+        import asyncio
+        from .events import events
+        messages = []
+        
+        async def send(message):
+            messages.append(message)
+        
+        scope = {'type': 'http', 'method': 'GET', 'scheme': 'https', 'path': '/documents/events/',
+            'headers': [(b'host', b'testserver')]}
+        await asyncio.wait_for(events(scope, None, send), 1)
+        self.assertEqual(messages[0]['status'], 401)
+        self.assertFalse(messages[1]['more_body'])
+        self.assertIn(('document-event-stream', 'GET', 401), collector.snapshot())
+    
+    @override_settings(ALLOWED_HOSTS=['docs.example.com'])
+    async def test_host(self):
+        # Hosts are checked against ALLOWED_HOSTS, as Django would, before anything else.
+        import asyncio
+        from .events import events
+        messages = []
+        
+        async def send(message):
+            messages.append(message)
+        
+        for host in [b'evil.example.com', b'']:
+            messages.clear()
+            scope = {'type': 'http', 'method': 'GET', 'scheme': 'https', 'path': '/documents/events/',
+                'headers': [(b'host', host), (b'authorization', f'Bearer {uuid4()}'.encode('ascii'))]}
+            await asyncio.wait_for(events(scope, None, send), 1)
+            self.assertEqual(messages[0]['status'], 400)
+        self.assertNotIn(('document-event-stream', 'GET', 401), collector.snapshot())
+
+
+class DocumentTallyTests(CustomTestCase):
+    def totals(self, token, folder=None):
+        path = '/documents/totals/' + (f'?folder={folder.code}' if folder else '')
+        return self.assertJsonResponse(self.call_api('GET', path, token=token.uuid))
+    
+    def expected(self, *documents):
+        return {'documents': len(documents), 'bytes': sum(len(doc.content.encode('utf-8')) for doc in documents)}
+    
+    def assertReconciled(self):
+        from io import StringIO
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('reconciletallies', dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'Found 0 drifted tallies.\n')
+    
+    def test_batch_race(self):
+        # Documents changed between validating a batch and applying it are validated again.
+        from unittest import mock
+        from django.conf import settings
+        from ..folders.factories import FolderFactory
+        from .views import DocumentBatch
+        token = TokenFactory()
+        folder = FolderFactory(account=token.account)
+        moved, removed, stale = DocumentFactory.create_batch(3, account=token.account)
+        validate = DocumentBatch.validate
+        races = []
+        
+        def racing(view, request, operations):
+            result = validate(view, request, operations)
+            if races:
+                method, document, data = races.pop(0)
+                self.assertJsonResponse(self.call_api(method, f'/documents/{document.code}/', data, token=token.uuid))
+            return result
+        
+        def batch(*operations):
+            with mock.patch.object(DocumentBatch, 'validate', autospec=True, side_effect=racing):
+                return self.call_api('POST', '/documents/batch/', {'operations': list(operations)}, token=token.uuid)
+        
+        # Moved and given new content first, then updated by the batch.
+        content = fake.text()
+        races.append(('PATCH', moved, {'folder': folder.code, 'content': fake.text()}))
+        self.assertJsonResponse(batch({'op': 'update', 'id': moved.code, 'name': 'Batched', 'content': content}))
+        revised = Document.objects.get(id=moved.id)
+        self.assertEqual((revised.name, revised.content, revised.folder_id), ('Batched', content, folder.id))
+        
+        # Deleted first, so the batch can no longer find it.
+        races.append(('DELETE', removed, None))
+        self.assertJsonResponse(batch({'op': 'delete', 'id': removed.code}), status_code=400)
+        
+        # Changed before every attempt.
+        races.extend(('PATCH', stale, {'content': fake.text()}) for n in range(settings.WRITE_ATTEMPTS))
+        self.assertJsonResponse(batch({'op': 'update', 'id': stale.code, 'name': 'Lost', 'content': 'Lost'}), status_code=409)
+        self.assertNotEqual(Document.objects.get(id=stale.id).name, 'Lost')
+        self.assertFalse(Blob.objects.filter(digest=content_digest('Lost'), references__gt=0).exists())
+        
+        self.assertReconciled()
+        self.assertEqual(self.totals(token), self.expected(*Document.objects.filter(account=token.account)))
+        self.assertEqual(self.totals(token, folder), self.expected(revised))
+        for blob in Blob.objects.all():
+            self.assertEqual(blob.references, Document.all_objects.filter(blob=blob).count())
+    
+    def test_changes(self):
+        from ..folders.factories import FolderFactory
+        token = TokenFactory()
+        folder = FolderFactory(account=token.account)
+        self.assertEqual(self.totals(token), {'documents': 0, 'bytes': 0})
+        
+        data = {'name': fake.bs(), 'content': 'Ünïcode counts bytes.', 'folder': folder.code}
+        result = self.assertJsonResponse(self.call_api('POST', '/documents/', data, token=token.uuid))
+        document = Document.objects.get(code=result['document']['id'])
+        self.assertEqual(self.totals(token), self.expected(document))
+        self.assertEqual(self.totals(token, folder), self.expected(document))
+        
+        # New content changes the bytes; leaving the folder empties it.
+        data = {'name': fake.bs(), 'content': fake.text(), 'folder': ''}
+        self.assertJsonResponse(self.call_api('PUT', f'/documents/{document.code}/', data, token=token.uuid))
+        document = Document.objects.get(id=document.id)
+        self.assertEqual(self.totals(token), self.expected(document))
+        self.assertEqual(self.totals(token, folder), self.expected())
+        
+        self.assertJsonResponse(self.call_api('DELETE', f'/documents/{document.code}/', token=token.uuid))
+        self.assertEqual(self.totals(token), self.expected())
+        
+        Document.all_objects.get(id=document.id).restore()
+        self.assertEqual(self.totals(token), self.expected(document))
+        self.assertReconciled()
+    
+    def test_shared_content(self):
+        # Every document counts its content, even when it's stored only once.
+        token = TokenFactory()
+        first = DocumentFactory(account=token.account)
+        second = DocumentFactory(account=token.account, content=first.content)
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(self.totals(token), self.expected(first, second))
+    
+    def test_batch(self):
+        from ..folders.factories import FolderFactory
+        token = TokenFactory()
+        folders = FolderFactory.create_batch(2, account=token.account)
+        documents = DocumentFactory.create_batch(3, account=token.account, folder=folders[0])
+        operations = [
+            {'op': 'create', 'name': fake.bs(), 'content': fake.text(), 'folder': folders[1].code},
+            {'op': 'create', 'name': fake.bs(), 'content': fake.text()},
+            {'op': 'update', 'id': documents[0].code, 'name': fake.bs(), 'content': fake.text()},
+            {'op': 'update', 'id': documents[1].code, 'name': fake.bs(), 'content': fake.text(), 'folder': folders[1].code},
+            {'op': 'delete', 'id': documents[2].code},
+        ]
+        response = self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid)
+        self.assertJsonResponse(response)
+        
+        live = list(Document.objects.filter(account=token.account))
+        self.assertEqual(len(live), 4)
+        self.assertEqual(self.totals(token), self.expected(*live))
+        for folder in folders:
+            self.assertEqual(self.totals(token, folder), self.expected(*[doc for doc in live if doc.folder_id == folder.id]))
+        self.assertReconciled()
+    
+    def test_isolation(self):
+        token = TokenFactory()
+        DocumentFactory()
+        self.assertEqual(self.totals(token), {'documents': 0, 'bytes': 0})
+    
+    def test_reconcile(self):
+        from io import StringIO
+        from django.core.management import call_command
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(2, account=token.account)
+        Tally.objects.filter(account=token.account).update(documents=7)
+        other = DocumentFactory()
+        Tally.objects.filter(account=other.account).delete()
+        
+        out = StringIO()
+        call_command('reconciletallies', dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'Found 2 drifted tallies.\n')
+        self.assertEqual(self.totals(token)['documents'], 7)
+        
+        call_command('reconciletallies', batch_size=1, verbosity=2, stdout=out)
+        self.assertIn(f'{token.account.code}: counted 7 documents', out.getvalue())
+        self.assertIn('Repaired 2 drifted tallies.', out.getvalue())
+        self.assertEqual(self.totals(token), self.expected(*documents))
+        self.assertEqual(Tally.objects.totals(other.account_id), self.expected(other))
+        self.assertReconciled()
+    
+    def test_queries(self):
+        # Reading the totals costs one query beyond authentication, however many documents there are.
+        def seed(size):
+            token = TokenFactory()
+            DocumentFactory.create_batch(size, account=token.account)
+            return token
+        self.assertScaleInvariant(seed, self.totals)
+        token = seed(1)
+        with self.assertQueryBudget(exact=2):
+            self.totals(token)
+
+
+class DocumentQueryTests(CustomTestCase):
+    # Query counts for each endpoint, which should not grow with the data.
+    
+    def seed(self, size):
+        token = TokenFactory()
+        documents = DocumentFactory.create_batch(size, account=token.account)
+        return token, documents
+    
+    def test_list(self):
+        for query in ['', '?view=summary', '?fields=name,content', '?stream=1']:
+            with self.subTest(query=query):
+                self.assertScaleInvariant(self.seed, lambda seeded: self.assertJsonResponse(
+                    self.call_api('GET', '/documents/' + query, token=seeded[0].uuid)))
+    
+    def test_ids(self):
+        def call(seeded):
+            token, documents = seeded
+            codes = ','.join(document.code for document in documents)
+            self.assertJsonResponse(self.call_api('GET', '/documents/?ids=' + codes, token=token.uuid))
+        self.assertScaleInvariant(self.seed, call)
+    
+    def test_batch(self):
+        def call(seeded):
+            token, documents = seeded
+            operations = [{'op': 'update', 'id': doc.code, 'name': doc.name, 'content': fake.text()}
+                for doc in documents[1:]]
+            operations.append({'op': 'delete', 'id': documents[0].code})
+            operations.append({'op': 'create', 'name': fake.bs(), 'content': fake.text()})
+            self.assertJsonResponse(self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid))
+        # Blobs are looked up by digest both before and after inserting new ones.
+        self.assertScaleInvariant(self.seed, call, repeats=2)
+    
+    @override_settings(CHANGES_SETTLE_TIME=0)
+    def test_changes(self):
+        def call(seeded):
+            token, documents = seeded
+            result = self.assertJsonResponse(self.call_api('GET', '/documents/changes/', token=token.uuid))
+            self.assertEqual(len(result['documents']), len(documents))
+        self.assertScaleInvariant(self.seed, call)
+    
+    def test_read(self):
+        token, documents = self.seed(1)
+        with self.assertQueryBudget(exact=2):
+            self.assertJsonResponse(self.call_api('GET', f'/documents/{documents[0].code}/', token=token.uuid))
+    
+    def test_update(self):
+        # New content costs a blob lookup, insert, and release, with their savepoints,
+        # a look at the current blob and folder, the update itself, and the tallies.
+        token, documents = self.seed(1)
+        data = {'name': fake.bs(), 'content': fake.text()}
+        with self.assertQueryBudget(exact=11):
+            self.assertJsonResponse(self.call_api('PUT', f'/documents/{documents[0].code}/', data, token=token.uuid))
+    
+    def test_rename(self):
+        # Authentication, then a single UPDATE that returns the new row.
+        from ..libs.models import returns_from_update
+        token, documents = self.seed(1)
+        with self.assertQueryBudget(exact=2) as budget:
+            self.assertJsonResponse(self.call_api('PATCH', f'/documents/{documents[0].code}/', {'name': 'x'}, token=token.uuid))
+        if returns_from_update(connection):
+            self.assertRegex(budget.queries[-1][0], r'^UPDATE .* RETURNING ')
+    
+    def test_delete(self):
+        # One UPDATE for the document, then the tallies need its content size, within a savepoint.
+        token, documents = self.seed(1)
+        with self.assertQueryBudget(exact=6):
+            self.assertJsonResponse(self.call_api('DELETE', f'/documents/{documents[0].code}/', token=token.uuid))
+
+
+class DocumentIndexTests(CustomTestCase):
+    def test_list(self):
+        token = TokenFactory()
+        documents = ListFactory(DocumentFactory, account=token.account)
+        with CaptureQueriesContext(connection) as queries:
+            for path in ['/documents/', '/documents/?view=summary', '/documents/?stream=1']:
+                response = self.call_api('GET', path, token=token.uuid)
+                self.assertJsonResponse(response)
+        listings = [query['sql'] for query in queries if 'documents_document' in query['sql']]
+        self.assertEqual(len(listings), 3)
+        for sql in listings:
+            self.assertUsesIndex(sql, 'document_live_account_idx')
+    
+    def test_read(self):
+        token = TokenFactory()
+        document = DocumentFactory(account=token.account)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.call_api('GET', f'/documents/{document.code}/', token=token.uuid)
+            self.assertJsonResponse(response)
+        # Single rows are best found by primary key, wherever the database puts it.
+        self.assertUsesIndex(queries[-1]['sql'], 'INTEGER PRIMARY KEY', 'documents_document_pkey')
+    
+    def test_changes(self):
+        token = TokenFactory()
+        documents = ListFactory(DocumentFactory, account=token.account)
+        cursor = encode_cursor(0, 0)
+        with CaptureQueriesContext(connection) as queries:
+            for path in ['/documents/changes/', f'/documents/changes/?since={cursor}']:
+                self.assertJsonResponse(self.call_api('GET', path, token=token.uuid))
+        listings = [query['sql'] for query in queries if 'documents_document' in query['sql']]
+        self.assertEqual(len(listings), 2)
+        for sql in listings:
+            self.assertUsesIndex(sql, 'document_changes_idx')
@@ -0,0 +1,110 @@
+r'''Document content uploaded as a raw request body.
+    The body is read a chunk at a time, validated as UTF-8 and hashed as it
+    arrives, and written straight to where it will be stored: a temporary
+    file beside the storage backend's bodies, or packed for the database.
+    So it never needs to be held as a whole, let alone decoded into a str.
+'''#"""#'''
+
+import os
+from codecs import getincrementaldecoder
+from hashlib import sha256
+
+from django.conf import settings
+
+from ..libs.fields import Packer
+from ..libs.storage import backend as storage_backend
+from .models import Blob
+
+
+class UploadError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ContentUpload(object):
+    r'''Content read from a stream, ready to become a blob.
+        Close it once done, to remove anything spooled but not kept.
+    '''#"""#'''
+    
+    def __init__(self):
+        self.storage = storage_backend()
+        self.size = 0
+        self.digest = None
+        self.spooled = None
+        self.packed = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def receive(self, stream, length):
+        r'''Read `length` bytes of UTF-8 content from a stream.
+            Raises UploadError for bodies that are empty, too large, or not UTF-8.
+        '''#"""#'''
+        
+        if not length:
+            raise UploadError(400, 'Empty content')
+        if length > settings.MAX_UPLOAD_SIZE:
+            raise UploadError(413, 'Content too large')
+        
+        decoder = getincrementaldecoder('utf-8')()
+        hasher = sha256()
+        if self.storage is not None:
+            self.spooled, output = self.storage.spool()
+        else:
+            output = Packer()
+        try:
+            while self.size < length:
+                chunk = stream.read(min(settings.UPLOAD_CHUNK_SIZE, length - self.size))
+                if not chunk:
+                    raise UploadError(400, 'Incomplete content')
+                self.size += len(chunk)
+                try:
+                    decoder.decode(chunk)
+                except UnicodeDecodeError:
+                    raise UploadError(400, 'Content must be UTF-8')
+                hasher.update(chunk)
+                output.write(chunk)
+            try:
+                decoder.decode(b'', final=True)
+            except UnicodeDecodeError:
+                raise UploadError(400, 'Content must be UTF-8')
+        finally:
+            if self.spooled is not None:
+                output.close()
+        
+        if self.storage is None:
+            self.packed = output.packed()
+        # The same digest as content_digest(), since valid UTF-8 decodes and encodes back unchanged.
+        self.digest = hasher.hexdigest()
+        return self
+    
+    def acquire(self, current=None):
+        r'''Add a reference to the blob for this content, as Blob.objects.acquire() would.
+        '''#"""#'''
+        
+        return Blob.objects.claim(self.digest, self.build, current)
+    
+    def build(self):
+        blob = Blob(digest=self.digest, size=self.size)
+        if self.storage is None:
+            blob.content = self.packed
+        elif self.storage.accepts(self.size):
+            if self.spooled is not None:
+                self.storage.keep(self.spooled, self.digest)
+                self.spooled = None
+            blob.content = ''
+            blob.storage = self.storage.name
+        else:
+            # Under the threshold, so small enough to read back.
+            with open(self.spooled, 'rb') as stream:
+                blob.content = stream.read().decode('utf-8')
+        return blob
+    
+    def close(self):
+        if self.spooled is not None:
+            os.unlink(self.spooled)
+            self.spooled = None
@@ -1,21 +1,117 @@
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, transaction
+from django.utils import timezone
 
-from ..libs.views import ApiResponse, ApiView
+from ..folders.models import Folder
+from ..libs.pagination import EPOCH, flatten_async, iterate_batches, paginate, paginate_changes
+from ..libs.models import oldest_transaction
+from ..libs.settings import boolean
+from ..libs.views import ApiException, ApiResponse, ApiStreamingResponse, AsyncApiView
+from ..libs.storage import backend as storage_backend
+from ..libs.views import conditional_response, content_response, is_conditional, make_etag, matched_versions
+from ..libs.views import set_validators, version_etag
 
-from .forms import DocumentCreationForm
-from .models import Document
-from .serializers import serialize_document
+from .events import notify, wait_for_changes
+from .forms import DocumentCreationForm, DocumentPatchForm
+from .models import Blob, Document, Tally
+from .serializers import document_fields, project_documents, serialize_document, serialize_documents
+from .serializers import summary_fields, tombstone_fields
+from .uploads import ContentUpload, UploadError
 
 
-class DocumentList(ApiView):
+class DocumentList(AsyncApiView):
     def get(self, request):
-        documents = Document.objects.filter(account=request.account)
+        fields = document_fields(request.GET)
+        documents = self.in_folder(request, Document.objects.filter(account=request.account))
+        if 'ids' in request.GET:
+            return self.collect(request, project_documents(documents, fields), fields)
+        
+        if self.streaming(request):
+            batches = iterate_batches(project_documents(documents, fields), request.GET)
+            pages = (serialize_documents(batch, fields) for batch in batches)
+            if isinstance(request, ASGIRequest):
+                # Streams are consumed in the event loop under ASGI, where queries aren't allowed.
+                return ApiStreamingResponse('documents', flatten_async(pages))
+            return ApiStreamingResponse('documents', chain.from_iterable(pages))
+        
+        if is_conditional(request):
+            # Check the client's copy without reading any content.
+            versions, cursor = paginate(documents.only('id', 'modified'), request.GET)
+            response = conditional_response(request, etag=self.etag(fields, versions, cursor))
+            if response is not None:
+                return response
+        
+        page, cursor = paginate(project_documents(documents, fields), request.GET)
+        response = ApiResponse({
+            'documents': serialize_documents(page, fields),
+            'next': cursor,
+        })
+        return set_validators(response, etag=self.etag(fields, page, cursor))
+    
+    def in_folder(self, request, documents):
+        r'''Restrict documents to the `folder` parameter's folder,
+            or to anywhere within the `subtree` parameter's folder.
+            Either way, one indexed query finds them, however deep the folder.
+        '''#"""#'''
+        
+        if request.GET.get('subtree'):
+            try:
+                path = Folder.objects.field('path', code=request.GET['subtree'], account=request.account)
+            except Folder.DoesNotExist:
+                raise PermissionDenied
+            return documents.filter(folder__path__startswith=path)
+        if request.GET.get('folder'):
+            return documents.filter(folder_id=Folder.decode(request.GET['folder'], -1))
+        return documents
+    
+    def collect(self, request, documents, fields):
+        r'''Fetch the documents listed in the `ids` parameter, in one query.
+            Codes that are malformed, unknown, deleted, or belong to another
+            account are listed as missing, instead of failing the request.
+        '''#"""#'''
+        
+        codes = list(dict.fromkeys(code for code in request.GET['ids'].split(',') if code))
+        if len(codes) > settings.MAX_PAGE_SIZE:
+            raise ApiException([f'At most {settings.MAX_PAGE_SIZE} ids are allowed'])
+        
+        found = {document.id: document for document in documents.filter(code__in=codes)}
+        results = []
+        missing = []
+        for code, document_id in zip(codes, Document.decode_many(codes)):
+            if document_id in found:
+                results.append(found[document_id])
+            else:
+                missing.append(code)
         return {
-            'documents': [serialize_document(document) for document in documents],
+            'documents': serialize_documents(results, fields),
+            'missing': missing,
         }
     
+    def etag(self, fields, page, cursor):
+        r'''Identify one version of a page, from the versions of its documents.
+            Documents added, changed, or deleted within the page alter it,
+            as do additions that create a following page.
+        '''#"""#'''
+        
+        versions = ['%s@%s' % (document.pk, document.modified.isoformat()) for document in page]
+        return make_etag(fields, cursor, *versions)
+    
+    def streaming(self, request):
+        r'''Whether the client asked for the complete list as a single stream.
+        '''#"""#'''
+        
+        try:
+            return boolean(request.GET.get('stream', ''))
+        except TypeError:
+            raise ApiException(['Invalid stream flag'])
+    
     def post(self, request):
-        form = DocumentCreationForm(request.POST)
+        form = DocumentCreationForm(request.POST, account=request.account)
         if not form.is_valid():
             return ApiResponse(
                 status = 400,
@@ -29,23 +125,111 @@ class DocumentList(ApiView):
         }
 
 
-class DocumentView(ApiView):
-    def get(self, request, code):
-        try:
-            document = Document.objects.get(code=code, account=request.account)
-        except Document.DoesNotExist:
-            raise PermissionDenied
+class DocumentChanges(AsyncApiView):
+    r'''Report documents created, modified, or deleted since a cursor.
+        Sync clients start without a cursor, then send back the `next` value
+        from each response as `since`; each call costs the same few queries,
+        however large the account, reading only the rows that changed.
+        Deleted documents are listed separately, without their content.
+        Changes show up once settings.CHANGES_SETTLE_TIME has passed.
+        
+        Modification times are taken before their transactions commit, so the
+        cursor must never pass a time that a transaction still open could
+        yet commit. On PostgreSQL, the feed stops short of the oldest open
+        transaction, however long it takes; the settle time then only covers
+        clock differences between servers, and the moment between stamping
+        a change and beginning its transaction. Elsewhere, the settle time
+        must also exceed the longest transaction that modifies documents.
+    '''#"""#'''
+    
+    def get(self, request):
+        fields = document_fields(request.GET)
+        # Tombstones are told apart by their deletion time.
+        columns = None if fields is None else [*fields, 'deleted']
+        documents = project_documents(Document.all_objects.filter(account=request.account), columns)
+        
+        settle = timedelta(seconds=settings.CHANGES_SETTLE_TIME)
+        settled = timezone.now() - settle
+        oldest = oldest_transaction(connection)
+        if oldest is not None:
+            settled = min(settled, oldest - settle)
+        page, cursor, more = paginate_changes(documents, request.GET, settled)
         return {
-            'document': serialize_document(document),
+            'documents': serialize_documents([doc for doc in page if doc.deleted is None], fields),
+            'deleted': serialize_documents([doc for doc in page if doc.deleted is not None], tombstone_fields),
+            'next': cursor,
+            'more': more,
         }
+
+
+class DocumentEvents(AsyncApiView):
+    r'''Wait for the account's documents to change, for clients that can't
+        hold open the event stream at /documents/events/, as under WSGI.
+        Clients send the `next` cursor from the change feed as `since`, and get
+        `changed` as soon as the feed has something past it, or false after
+        `timeout` seconds, at most settings.EVENTS_POLL_TIMEOUT.
+    '''#"""#'''
     
-    def put(self, request, code):
+    async def get(self, request):
+        try:
+            timeout = float(request.GET.get('timeout') or settings.EVENTS_POLL_TIMEOUT)
+        except ValueError:
+            timeout = None
+        if timeout is None or not 0 <= timeout:
+            raise ApiException(['Invalid timeout'])
+        timeout = min(timeout, settings.EVENTS_POLL_TIMEOUT)
+        since = request.GET.get('since') or None
+        return {'changed': await wait_for_changes(request.account.id, since, timeout)}
+
+
+class DocumentTotals(AsyncApiView):
+    def get(self, request):
+        r'''Count the account's documents and content bytes, or just those
+            filed directly in the `folder` parameter's folder.
+            Reads one row of running totals, however many documents there are.
+        '''#"""#'''
+        
+        folder_id = None
+        if request.GET.get('folder'):
+            folder_id = Folder.decode(request.GET['folder'], -1)
+        return Tally.objects.totals(request.account.id, folder_id)
+
+
+class DocumentView(AsyncApiView):
+    def get(self, request, code):
+        fields = document_fields(request.GET)
+        if is_conditional(request):
+            # Check the client's copy without reading any content.
+            try:
+                modified = Document.objects.field('modified', code=code, account=request.account)
+            except Document.DoesNotExist:
+                raise PermissionDenied
+            etag = self.etag(code, modified, fields)
+            response = conditional_response(request, etag=etag, last_modified=modified)
+            if response is not None:
+                return response
+        
+        documents = project_documents(Document.objects.all(), fields)
         try:
-            document = Document.objects.get(code=code, account=request.account)
+            document = documents.get(code=code, account=request.account)
         except Document.DoesNotExist:
             raise PermissionDenied
-        
-        form = DocumentCreationForm(request.POST, instance=document)
+        response = ApiResponse({
+            'document': serialize_document(document, fields),
+        })
+        etag = self.etag(code, document.modified, fields)
+        return set_validators(response, etag=etag, last_modified=document.modified)
+    
+    def etag(self, code, modified, fields):
+        return version_etag(self.version(modified), code, fields)
+    
+    @staticmethod
+    def version(modified):
+        # Modification times, in microseconds, tell versions apart.
+        return (modified - EPOCH) // timedelta(microseconds=1)
+    
+    def put(self, request, code):
+        form = DocumentCreationForm(request.POST, account=request.account)
         if not form.is_valid():
             return ApiResponse(
                 status = 400,
@@ -53,18 +237,306 @@ class DocumentView(ApiView):
                 errors = form.errors,
             )
         
-        revised = form.save()
-        return {
-            'document': serialize_document(revised),
-        }
+        changes = {name: form.cleaned_data[name] for name in ['name', 'content', 'folder'] if name in form.data}
+        return self.write(request, code, changes, None)
+    
+    def patch(self, request, code):
+        r'''Change only the fields sent, responding with the summary view.
+        '''#"""#'''
+        
+        form = DocumentPatchForm(request.POST, account=request.account)
+        if not form.is_valid():
+            return ApiResponse(status=400, errors=form.errors)
+        changes = form.changes()
+        if not changes:
+            # An empty write would still bump the modification time and show up in the change feed.
+            raise ApiException(['No changes'])
+        return self.write(request, code, changes, summary_fields)
     
     def delete(self, request, code):
+        r'''Soft-delete a document with a single conditional UPDATE.
+            Responds with the summary view, as the content isn't read.
+        '''#"""#'''
+        
+        now = timezone.now()
+        with transaction.atomic():
+            rows = self.target(request, code).update_returning(deleted=now, modified=now)
+            if not rows:
+                return self.missing(request, code)
+            document = rows[0]
+            account, folder, blob = document.account_id, document.folder_id, document.blob_id
+            Tally.objects.record([((account, folder, blob), None)])
+        notify(document.account_id)
+        return self.written(code, document, summary_fields)
+    
+    def target(self, request, code):
+        # The live document, if it's still the version named by If-Match.
+        documents = Document.objects.filter(code=code, account=request.account)
+        versions = matched_versions(request)
+        if versions is not None:
+            documents = documents.filter(modified__in=[EPOCH + timedelta(microseconds=v) for v in versions])
+        return documents
+    
+    def missing(self, request, code):
+        if matched_versions(request) is not None and Document.objects.filter(code=code, account=request.account).exists():
+            return ApiResponse(status=412, errors=['Precondition Failed'])
+        raise PermissionDenied
+    
+    def write(self, request, code, changes, fields):
+        r'''Apply changes with a conditional UPDATE, instead of reading the document first.
+            A rename takes that one statement.  New content or folders also
+            need the current blob and folder, for reference counts and tallies;
+            those are read without locking, and the UPDATE only applies
+            if they're still current, trying again a few times otherwise.
+        '''#"""#'''
+        
+        now = timezone.now()
+        values = {'modified': now}
+        for name in ['name', 'folder']:
+            if name in changes:
+                values[name] = changes[name]
+        
+        documents = self.target(request, code)
+        if 'content' not in changes and 'folder' not in changes:
+            rows = documents.update_returning(**values)
+            if not rows:
+                return self.missing(request, code)
+            notify(request.account.id)
+            return self.written(code, rows[0], fields)
+        
+        with transaction.atomic():
+            blob = None
+            content = changes.get('content')
+            if isinstance(content, ContentUpload):
+                blob = values['blob'] = content.acquire()
+            elif content is not None:
+                blob = values['blob'] = Blob.objects.acquire(content)
+            rows = current = None
+            for attempt in range(settings.WRITE_ATTEMPTS):
+                current = documents.values('blob_id', 'folder_id', 'blob__size').first()
+                if current is None:
+                    break
+                rows = documents.filter(blob_id=current['blob_id'], folder_id=current['folder_id']).update_returning(**values)
+                if rows:
+                    break
+            
+            if rows:
+                document = rows[0]
+                if blob is not None:
+                    Blob.objects.release(current['blob_id'])
+                if isinstance(content, str):
+                    document._content = content
+                previous = Blob(id=current['blob_id'], size=current['blob__size'])
+                account = document.account_id
+                Tally.objects.record([
+                    ((account, current['folder_id'], current['blob_id']), (account, document.folder_id, document.blob_id)),
+                ], [previous] + ([blob] if blob else []))
+            else:
+                # Give back the blob reference, too.
+                transaction.set_rollback(True)
+        
+        if not rows:
+            if current is None:
+                return self.missing(request, code)
+            return ApiResponse(status=409, errors=['Conflict'])
+        notify(account)
+        return self.written(code, document, fields)
+    
+    def written(self, code, document, fields):
+        # Send the new version's validators, ready for the next If-Match.
+        response = ApiResponse({
+            'document': serialize_document(document, fields),
+        })
+        return set_validators(response, etag=self.etag(code, document.modified, fields), last_modified=document.modified)
+
+
+class DocumentContent(AsyncApiView):
+    def get(self, request, code):
+        r'''Serve a document's content as plain UTF-8 text, outside the JSON envelope.
+            Content in a storage backend goes straight from its file to the server,
+            which can send it without copying; byte ranges let large downloads resume.
+            The content digest serves as the entity tag.
+        '''#"""#'''
+        
+        documents = Document.objects.select_related('blob').only(
+            'modified', 'blob__digest', 'blob__size', 'blob__storage', 'blob__content')
         try:
-            document = Document.objects.get(code=code, account=request.account)
+            document = documents.get(code=code, account=request.account)
         except Document.DoesNotExist:
             raise PermissionDenied
         
-        document.delete()
+        blob = document.blob
+        etag = '"%s"' % blob.digest
+        response = conditional_response(request, etag=etag, last_modified=document.modified)
+        if response is not None:
+            return response
+        
+        source = None
+        if blob.storage:
+            try:
+                source = storage_backend(blob.storage).open(blob.digest)
+            except FileNotFoundError:
+                pass
+        if source is None:
+            source = blob.read().encode('utf-8')
+        response = content_response(request, source, blob.size, etag, 'text/plain; charset=utf-8')
+        return set_validators(response, etag=etag, last_modified=document.modified)
+    
+    def put(self, request, code):
+        r'''Replace a document's content with a raw text/plain or application/octet-stream body.
+            The body streams through in chunks of settings.UPLOAD_CHUNK_SIZE bytes,
+            up to settings.MAX_UPLOAD_SIZE, instead of being read whole and decoded.
+            Responds with the summary view, like a PATCH.
+        '''#"""#'''
+        
+        if request.content_type not in ('text/plain', 'application/octet-stream'):
+            return ApiResponse(status=415, errors=['Send content as text/plain or application/octet-stream'])
+        if request.content_params.get('charset', 'utf-8').lower() not in ('utf-8', 'utf8'):
+            return ApiResponse(status=415, errors=['Content must be UTF-8'])
+        try:
+            length = int(request.META['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return ApiResponse(status=411, errors=['Length Required'])
+        
+        # Refuse foreign documents before reading a large body for nothing.
+        if not Document.objects.filter(code=code, account=request.account).exists():
+            raise PermissionDenied
+        with ContentUpload() as upload:
+            try:
+                upload.receive(request, length)
+            except UploadError as err:
+                return ApiResponse(status=err.status, errors=[str(err)])
+            return DocumentView.instance.write(request, code, {'content': upload}, summary_fields)
+
+
+class DocumentBatch(AsyncApiView):
+    r'''Apply many document changes in a single request and transaction.
+        Expects up to settings.MAX_BATCH_SIZE operations, each one of:
+            {"op": "create", "name": ..., "content": ...}
+            {"op": "update", "id": ..., "name": ..., "content": ...}
+            {"op": "delete", "id": ...}
+        Either every operation is applied, or none of them are;
+        results or errors are reported for each operation, in order.
+        Operations are validated without locking, then the documents they
+        target are locked and checked before anything is written; if any
+        changed in between, the batch is validated again, a few times.
+    '''#"""#'''
+    
+    def post(self, request):
+        operations = request.POST.get('operations')
+        if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+            raise ApiException(['Expected a list of operations'])
+        if len(operations) > settings.MAX_BATCH_SIZE:
+            raise ApiException([f'At most {settings.MAX_BATCH_SIZE} operations are allowed'])
+        
+        for attempt in range(settings.WRITE_ATTEMPTS):
+            plans, errors = self.validate(request, operations)
+            if any(errors):
+                return ApiResponse(errors=errors, status=400)
+            with transaction.atomic():
+                if self.lock(request, plans):
+                    results = self.apply(request, plans)
+                    break
+        else:
+            return ApiResponse(status=409, errors=['Conflict'])
         return {
-            'document': serialize_document(document),
+            'results': [{'document': result} for result in results],
         }
+    
+    def validate(self, request, operations):
+        # Find every existing document in one query.
+        ids = [Document.decode(op.get('id'), -1) for op in operations if op.get('op') in ('update', 'delete')]
+        targets = {document.id: document for document in Document.objects.filter(account=request.account, id__in=ids)}
+        codes = {op['folder'] for op in operations if isinstance(op.get('folder'), str) and op['folder']}
+        folders = {folder.code: folder for folder in Folder.objects.filter(account=request.account, code__in=codes)} if codes else {}
+        
+        plans = []
+        errors = []
+        seen = set()
+        for op in operations:
+            kind = op.get('op')
+            form = document = None
+            error = None
+            if kind in ('update', 'delete'):
+                document = targets.get(Document.decode(op.get('id'), -1))
+                if document is None:
+                    error = ['Permission Denied']
+                elif document.id in seen:
+                    error = ['Duplicate document']
+                else:
+                    seen.add(document.id)
+            elif kind != 'create':
+                error = ['Unknown operation']
+            
+            if error is None and kind != 'delete':
+                form = DocumentCreationForm(op, instance=document, account=request.account, folders=folders)
+                if not form.is_valid():
+                    error = form.errors
+            plans.append((kind, form, document))
+            errors.append(error)
+        return plans, errors
+    
+    def lock(self, request, plans):
+        r'''Lock the documents to be updated or deleted, in id order against deadlocks,
+            returning whether each still has the blob, folder, and version it was validated with.
+            Tallies and reference counts are adjusted from those.
+        '''#"""#'''
+        
+        expected = {document.id: (document.blob_id, document.folder_id, document.modified)
+            for kind, form, document in plans if document is not None and document.pk is not None}
+        if not expected:
+            return True
+        rows = Document.objects.select_for_update().filter(account=request.account, id__in=expected).order_by('id')
+        current = {row[0]: row[1:] for row in rows.values_list('id', 'blob_id', 'folder_id', 'modified')}
+        return current == expected
+    
+    def apply(self, request, plans):
+        now = timezone.now()
+        contents = [form.cleaned_data['content'] for kind, form, document in plans if form is not None]
+        acquired = Blob.objects.acquire_many(contents)
+        blobs = iter(acquired)
+        
+        created = []
+        updated = []
+        deleted = []
+        released = []
+        results = []
+        for kind, form, document in plans:
+            if kind == 'delete':
+                document.deleted = document.modified = now
+                deleted.append(document)
+            else:
+                if document is None:
+                    document = form.instance
+                    document.account = request.account
+                    created.append(document)
+                else:
+                    released.append(document.blob_id)
+                    document.modified = now
+                    updated.append(document)
+                document.blob = next(blobs)
+                if 'folder' in form.data:
+                    document.folder = form.cleaned_data['folder']
+                # Keep the content around for serialization.
+                document._content = form.cleaned_data['content']
+            results.append(document)
+        
+        if connection.features.can_return_rows_from_bulk_insert:
+            Document.objects.bulk_create(created)
+        else:
+            # Without RETURNING, bulk inserts can't tell us the new ids.
+            for document in created:
+                document.save()
+        if updated:
+            Document.objects.bulk_update(updated, ['name', 'blob', 'folder', 'modified'])
+        if deleted:
+            Document.objects.filter(id__in=[doc.id for doc in deleted]).update(deleted=now, modified=now)
+        Blob.objects.release_many(released)
+        # Documents saved one at a time above have already been counted.
+        Tally.objects.record([(getattr(document, '_tallied', None), document.tally_key) for document in results], acquired)
+        notify(request.account.id)
+        
+        return [
+            serialize_document(document, summary_fields if document.deleted else None)
+            for document in results
+        ]
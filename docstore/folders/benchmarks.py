@@ -0,0 +1,85 @@
+from itertools import cycle
+from json import dumps as json_encode
+
+from django.db import connection
+from django.db.models import Max
+from django.test import Client
+from django.utils import timezone
+
+from ..accounts.factories import TokenFactory
+from ..documents.models import Blob, Document
+from ..libs.benchmarks import benchmark, measure
+from .models import Folder, segment
+
+
+def deep_tree(account, folders, depth):
+    r'''Seed chains of nested folders, returning each chain from the top down.
+        Ids are assigned up front, so that paths can be too, for a single bulk insert.
+    '''#"""#'''
+    
+    now = timezone.now()
+    start = (Folder.all_objects.aggregate(last=Max('id'))['last'] or 0) + 1
+    chains = []
+    rows = []
+    for top in range(start, start + folders, depth):
+        chain = []
+        path = ''
+        for pk in range(top, min(top + depth, start + folders)):
+            path += segment(pk)
+            parent = chain[-1] if chain else None
+            chain.append(Folder(id=pk, account=account, parent=parent, name=f'folder {pk}', path=path,
+                created=now, modified=now))
+        chains.append(chain)
+        rows.extend(chain)
+    Folder.objects.bulk_create(rows, batch_size=1000)
+    
+    # Explicit ids leave sequences behind, on databases that have them.
+    from django.core.management.color import no_style
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Folder]):
+            cursor.execute(sql)
+    return chains
+
+
+@benchmark
+def folders(repeat, folders=10000, depth=100, documents=1000000):
+    # List and move folders within a deep tree, full of documents.
+    token = TokenFactory()
+    account = token.account
+    chains = deep_tree(account, folders, depth)
+    
+    # Documents share one blob; it's the folder queries being measured here.
+    blob = Blob.objects.acquire('Filed away.')
+    now = timezone.now()
+    everywhere = cycle(folder for chain in chains for folder in chain)
+    batch = []
+    for n in range(documents):
+        batch.append(Document(account=account, name=f'document {n}', blob=blob, folder=next(everywhere),
+            created=now, modified=now))
+        if len(batch) == 10000:
+            Document.objects.bulk_create(batch)
+            batch = []
+    Document.objects.bulk_create(batch)
+    Blob.objects.filter(id=blob.id).update(references=documents)
+    
+    client = Client(HTTP_AUTHORIZATION=f'Bearer {token.uuid}')
+    middle = chains[0][len(chains[0]) // 2]
+    top = chains[0][0].code
+    
+    # Move the bottom half of one chain back and forth between the middle of two others.
+    targets = cycle([chains[1][len(chains[1]) // 2].code, chains[2][len(chains[2]) // 2].code])
+    
+    def move():
+        data = json_encode({'name': middle.name, 'parent': next(targets)})
+        client.put(f'/folders/{middle.code}/', data, content_type='application/json', secure=True)
+    
+    return {
+        'folders': folders,
+        'depth': depth,
+        'documents': documents,
+        'children': measure(lambda: client.get(f'/folders/?parent={middle.code}', secure=True), repeat),
+        'subtree': measure(lambda: client.get(f'/folders/?subtree={top}', secure=True), repeat),
+        'folder_documents': measure(lambda: client.get(f'/documents/?folder={middle.code}', secure=True), repeat),
+        'subtree_documents': measure(lambda: client.get(f'/documents/?subtree={middle.code}&view=summary', secure=True), repeat),
+        'move': measure(move, repeat),
+    }
@@ -0,0 +1,16 @@
+from django.utils import timezone
+from factory import SubFactory
+from factory.django import DjangoModelFactory
+from factory.faker import Faker as FakeAttribute
+
+from ..accounts.factories import AccountFactory
+
+
+class FolderFactory(DjangoModelFactory):
+    class Meta:
+        model = 'folders.Folder'
+    
+    account = SubFactory(AccountFactory)
+    name = FakeAttribute('word')
+    created = FakeAttribute('date_time_this_month', before_now=True, tzinfo=timezone.utc)
+    modified = FakeAttribute('date_time_this_month', before_now=True, tzinfo=timezone.utc)
@@ -0,0 +1,38 @@
+from django.core.exceptions import ValidationError
+from django.forms import CharField, ModelForm
+
+from .models import Folder
+
+
+class FolderForm(ModelForm):
+    # The parent folder's code, or nothing for the top level.
+    parent = CharField(required=False)
+    
+    class Meta:
+        model = Folder
+        fields = [
+            'name',
+        ]
+    
+    def __init__(self, *args, account=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.account = account
+    
+    def clean_parent(self):
+        code = self.cleaned_data.get('parent')
+        if not code:
+            return None
+        try:
+            return Folder.objects.get(code=code, account=self.account)
+        except Folder.DoesNotExist:
+            raise ValidationError('Unknown folder')
+    
+    def save(self, commit=True):
+        r'''Save the name, and the parent for new folders.
+            Existing folders change parents through Folder.move() instead.
+        '''#"""#'''
+        
+        if self.instance.pk is None:
+            self.instance.account = self.account
+            self.instance.parent = self.cleaned_data['parent']
+        return super().save(commit=commit)
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('accounts', '0002_token_live_uuid_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Folder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('deleted', models.DateTimeField(blank=True, default=None, editable=False, null=True)),
+                ('name', models.CharField(max_length=127)),
+                ('path', models.CharField(default='', editable=False, max_length=1024)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.account')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='children', to='folders.folder')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(condition=models.Q(('deleted', None)), fields=['account', 'parent', 'id'], name='folder_live_parent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['path'], name='folder_path_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
@@ -0,0 +1,134 @@
+from django.db import transaction
+from django.db.models import Count, Index, Max, Q, Sum, Value
+from django.db.models.deletion import PROTECT
+from django.db.models.fields import CharField
+from django.db.models.fields.related import ForeignKey
+from django.db.models.functions import Coalesce, Concat, Length, Substr
+from django.utils import timezone
+
+from ..accounts.models import Account
+from ..libs.models import BasicModel
+from ..libs.views import ApiException
+
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def segment(folder_id):
+    r'''One path segment: a folder id in base 36, with its separator.
+    '''#"""#'''
+    
+    text = ''
+    while True:
+        folder_id, digit = divmod(folder_id, 36)
+        text = DIGITS[digit] + text
+        if not folder_id:
+            return text + '/'
+
+
+def path_ids(path):
+    r'''The folder ids along a path, from the root down.
+    '''#"""#'''
+    
+    return [int(part, 36) for part in path.split('/') if part]
+
+
+class Folder(BasicModel):
+    r'''A folder of documents, within a tree of folders for each account.
+        Each folder stores its materialized path: the ids of its ancestors and
+        itself, so a whole subtree can be found with a single prefix match.
+        Moving a folder rewrites the paths below it in one statement.
+    '''#"""#'''
+    
+    account = ForeignKey(Account, on_delete=PROTECT)
+    parent = ForeignKey('self', null=True, blank=True, on_delete=PROTECT, related_name='children')
+    name = CharField(max_length=127)
+    path = CharField(max_length=1024, editable=False, default='')
+    
+    class Meta:
+        indexes = [
+            # Serves listings of a folder's children, or of the account's top level.
+            Index(fields=['account', 'parent', 'id'], condition=Q(deleted=None), name='folder_live_parent_idx'),
+            # Serves subtree prefix matches; the pattern operator class is for PostgreSQL.
+            Index(fields=['path'], opclasses=['varchar_pattern_ops'], name='folder_path_idx'),
+        ]
+    
+    def __str__(self):
+        return super().__str__() + ': ' + repr(self.name)
+    
+    @property
+    def ancestor_ids(self):
+        return path_ids(self.path)[:-1]
+    
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            return super().save(*args, **kwargs)
+        
+        # The path includes the folder's own id, which only exists after the insert.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.path = (self.parent.path if self.parent_id else '') + segment(self.pk)
+            self.check_depth(len(self.path))
+            self.fast_update(path=self.path)
+    
+    def check_depth(self, length):
+        if length > self._meta.get_field('path').max_length:
+            raise ApiException(['Folders are nested too deeply'])
+    
+    def subtree(self, queryset=None):
+        r'''Filter a folder queryset down to this folder and its descendants.
+        '''#"""#'''
+        
+        if queryset is None:
+            queryset = Folder.all_objects
+        return queryset.filter(account_id=self.account_id, path__startswith=self.path)
+    
+    def move(self, parent):
+        r'''Move this folder and everything within it under another folder,
+            or to the top level when the parent is None.
+            Costs the same few statements however large or deep the subtree.
+            Paths are read afresh under lock, so concurrent moves queue up:
+            any two that could form a cycle both lock the higher folder.
+        '''#"""#'''
+        
+        with transaction.atomic():
+            while True:
+                # This folder, and the new parent with all its ancestors; in path order, against deadlocks.
+                ids = {self.pk, *(path_ids(parent.path) if parent is not None else [])}
+                locked = Folder.all_objects.select_for_update().filter(id__in=ids).order_by('path')
+                locked = {folder.pk: folder for folder in locked}
+                if parent is None or locked[parent.pk].path == parent.path:
+                    break
+                # The parent moved since it was loaded, so its ancestors have changed.
+                parent = locked[parent.pk]
+            
+            self.path = old = locked[self.pk].path
+            if parent is not None and parent.path.startswith(old):
+                raise ApiException(['Folders cannot be moved into themselves'])
+            new = (parent.path if parent is not None else '') + segment(self.pk)
+            deepest = self.subtree().aggregate(length=Max(Length('path')))['length']
+            self.check_depth(deepest - len(old) + len(new))
+            self.subtree().update(path=Concat(Value(new), Substr('path', len(old) + 1)), modified=timezone.now())
+            self.parent = parent
+            self.path = new
+            self.save(update_fields=['parent', 'modified'])
+    move.alters_data = True
+    
+    def delete(self):
+        r'''Soft-delete this folder, its descendants, and every document within them.
+        '''#"""#'''
+        
+        from ..documents.models import Document, Tally
+        from ..documents.events import notify
+        now = timezone.now()
+        with transaction.atomic():
+            folders = self.subtree(Folder.objects)
+            documents = Document.objects.filter(account_id=self.account_id, folder__in=folders)
+            totals = documents.aggregate(documents=Count('id'), bytes=Coalesce(Sum('blob__size'), 0))
+            documents.update(deleted=now, modified=now)
+            Tally.objects.filter(folder__in=folders).update(documents=0, bytes=0, modified=now)
+            Tally.objects.adjust({(self.account_id, None): [-totals['documents'], -totals['bytes']]})
+            folders.update(deleted=now, modified=now)
+            self.deleted = self.modified = now
+        notify(self.account_id)
+    delete.alters_data = True
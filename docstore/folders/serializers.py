@@ -0,0 +1,15 @@
+from ..accounts.models import Account
+from .models import Folder
+
+
+def serialize_folder(folder):
+    return {
+        'id': folder.code,
+        'name': folder.name,
+        'parent': Folder.encode(folder.parent_id) if folder.parent_id else None,
+        'ancestors': Folder.encode_many(folder.ancestor_ids),
+        'account': Account.encode(folder.account_id),
+        'created': folder.created,
+        'modified': folder.modified,
+        'deleted': folder.deleted,
+    }
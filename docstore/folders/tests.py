@@ -0,0 +1,239 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ..accounts.factories import TokenFactory
+from ..documents.factories import DocumentFactory
+from ..documents.models import Document, Tally
+from ..libs.factories import fake
+from ..libs.tests import CustomTestCase
+from ..libs.views import ApiException
+from .factories import FolderFactory
+from .models import Folder, segment
+
+
+def chain(account, depth, parent=None):
+    # Nest folders inside each other, returning them from the top down.
+    folders = []
+    for n in range(depth):
+        parent = FolderFactory(account=account, parent=parent)
+        folders.append(parent)
+    return folders
+
+
+class FolderTests(CustomTestCase):
+    def test_create(self):
+        token = TokenFactory()
+        response = self.call_api('POST', '/folders/', {'name': 'top'}, token=token.uuid)
+        top = self.assertJsonResponse(response)['folder']
+        self.assertEqual(top['parent'], None)
+        self.assertEqual(top['ancestors'], [])
+        
+        response = self.call_api('POST', '/folders/', {'name': 'inner', 'parent': top['id']}, token=token.uuid)
+        inner = self.assertJsonResponse(response)['folder']
+        self.assertEqual(inner['parent'], top['id'])
+        self.assertEqual(inner['ancestors'], [top['id']])
+        folder = self.assertCreated(Folder, inner['id'], name='inner', account_id=token.account_id)
+        self.assertEqual(folder.path, segment(Folder.decode(top['id'])) + segment(folder.id))
+    
+    def test_foreign_parent(self):
+        token = TokenFactory()
+        foreign = FolderFactory()
+        response = self.call_api('POST', '/folders/', {'name': 'x', 'parent': foreign.code}, token=token.uuid)
+        self.assertJsonResponse(response, status_code=400)
+        self.assertFalse(Folder.objects.filter(account=token.account).exists())
+    
+    def test_list(self):
+        token = TokenFactory()
+        top = chain(token.account, 3)
+        other = FolderFactory(account=token.account)
+        FolderFactory()
+        
+        def listed(query):
+            response = self.call_api('GET', '/folders/' + query, token=token.uuid)
+            return [folder['id'] for folder in self.assertJsonResponse(response)['folders']]
+        
+        self.assertEqual(listed(''), [top[0].code, other.code])
+        self.assertEqual(listed(f'?parent={top[0].code}'), [top[1].code])
+        self.assertEqual(listed(f'?subtree={top[1].code}'), [top[1].code, top[2].code])
+    
+    def test_move(self):
+        token = TokenFactory()
+        source = chain(token.account, 3)
+        target = chain(token.account, 2)
+        DocumentFactory(account=token.account, folder=source[2])
+        
+        response = self.call_api('PUT', f'/folders/{source[1].code}/',
+            {'name': 'moved', 'parent': target[1].code}, token=token.uuid)
+        result = self.assertJsonResponse(response)['folder']
+        self.assertEqual(result['ancestors'], [target[0].code, target[1].code])
+        self.assertEqual(result['name'], 'moved')
+        
+        innermost = Folder.objects.get(id=source[2].id)
+        self.assertEqual(innermost.ancestor_ids, [target[0].id, target[1].id, source[1].id])
+        response = self.call_api('GET', f'/documents/?subtree={target[0].code}', token=token.uuid)
+        self.assertEqual(len(self.assertJsonResponse(response)['documents']), 1)
+        
+        # Back out to the top level.
+        response = self.call_api('PUT', f'/folders/{source[1].code}/', {'name': 'moved', 'parent': ''}, token=token.uuid)
+        self.assertEqual(self.assertJsonResponse(response)['folder']['ancestors'], [])
+        self.assertEqual(Folder.objects.get(id=source[2].id).ancestor_ids, [source[1].id])
+    
+    def test_move_inside(self):
+        token = TokenFactory()
+        folders = chain(token.account, 3)
+        response = self.call_api('PUT', f'/folders/{folders[0].code}/',
+            {'name': 'loop', 'parent': folders[2].code}, token=token.uuid)
+        self.assertJsonResponse(response, status_code=400)
+        revised = Folder.objects.get(id=folders[0].id)
+        self.assertEqual((revised.name, revised.parent_id), (folders[0].name, None))
+    
+    def test_move_stale(self):
+        # Moves work from the paths as they are, not as they were loaded.
+        token = TokenFactory()
+        folders = chain(token.account, 3)
+        other = FolderFactory(account=token.account)
+        loaded = Folder.objects.get(id=folders[0].id)
+        parent = Folder.objects.get(id=other.id)
+        
+        # The parent has since moved into the folder, so following it would form a cycle.
+        Folder.objects.get(id=other.id).move(Folder.objects.get(id=folders[2].id))
+        with self.assertRaises(ApiException):
+            loaded.move(parent)
+        self.assertEqual(Folder.objects.get(id=folders[0].id).path, folders[0].path)
+        
+        # The folder itself has since moved, along with everything within it.
+        moving = Folder.objects.get(id=folders[2].id)
+        Folder.objects.get(id=folders[1].id).move(None)
+        moving.move(None)
+        for folder in Folder.objects.filter(account=token.account):
+            expected = (folder.parent.path if folder.parent_id else '') + segment(folder.id)
+            self.assertEqual(folder.path, expected, folder)
+        self.assertEqual(Folder.objects.get(id=other.id).ancestor_ids, [folders[2].id])
+    
+    def test_rename(self):
+        # Without a parent, the folder stays where it is.
+        token = TokenFactory()
+        folders = chain(token.account, 2)
+        response = self.call_api('PUT', f'/folders/{folders[1].code}/', {'name': 'renamed'}, token=token.uuid)
+        self.assertEqual(self.assertJsonResponse(response)['folder']['parent'], folders[0].code)
+    
+    def test_delete(self):
+        token = TokenFactory()
+        folders = chain(token.account, 3)
+        inside = DocumentFactory(account=token.account, folder=folders[2])
+        outside = DocumentFactory(account=token.account, folder=folders[0])
+        response = self.call_api('DELETE', f'/folders/{folders[1].code}/', token=token.uuid)
+        self.assertIsNotNone(self.assertJsonResponse(response)['folder']['deleted'])
+        self.assertTimestamped(Folder.all_objects.get(id=folders[2].id).deleted)
+        self.assertEqual(list(Folder.objects.filter(account=token.account)), [folders[0]])
+        self.assertEqual(list(Document.objects.filter(account=token.account)), [outside])
+        self.assertIsNotNone(Document.all_objects.get(id=inside.id).deleted)
+        
+        # Only the surviving document is still counted.
+        size = len(outside.content.encode('utf-8'))
+        self.assertEqual(Tally.objects.totals(token.account_id), {'documents': 1, 'bytes': size})
+        self.assertEqual(Tally.objects.totals(token.account_id, folders[2].id), {'documents': 0, 'bytes': 0})
+    
+    def test_foreign(self):
+        token = TokenFactory()
+        folder = FolderFactory()
+        for method in ['GET', 'PUT', 'DELETE']:
+            response = self.call_api(method, f'/folders/{folder.code}/', {'name': 'x'}, token=token.uuid)
+            self.assertJsonResponse(response, status_code=403)
+
+
+class FolderDocumentTests(CustomTestCase):
+    def test_create(self):
+        token = TokenFactory()
+        folder = FolderFactory(account=token.account)
+        data = {'name': fake.bs(), 'content': fake.text(), 'folder': folder.code}
+        result = self.assertJsonResponse(self.call_api('POST', '/documents/', data, token=token.uuid))
+        self.assertEqual(result['document']['folder'], folder.code)
+        self.assertCreated(Document, result['document']['id'], folder=folder)
+        
+        operations = [dict(data, op='create', folder=FolderFactory().code)]
+        response = self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid)
+        self.assertJsonResponse(response, status_code=400)
+    
+    def test_update(self):
+        token = TokenFactory()
+        folder = FolderFactory(account=token.account)
+        document = DocumentFactory(account=token.account, folder=folder)
+        path = f'/documents/{document.code}/'
+        data = {'name': fake.bs(), 'content': fake.text()}
+        self.assertJsonResponse(self.call_api('PUT', path, data, token=token.uuid))
+        self.assertEqual(Document.objects.get(id=document.id).folder, folder)
+        self.assertJsonResponse(self.call_api('PUT', path, dict(data, folder=None), token=token.uuid))
+        self.assertIsNone(Document.objects.get(id=document.id).folder)
+    
+    def test_batch(self):
+        token = TokenFactory()
+        folders = FolderFactory.create_batch(2, account=token.account)
+        document = DocumentFactory(account=token.account)
+        operations = [
+            {'op': 'create', 'name': fake.bs(), 'content': fake.text(), 'folder': folders[0].code},
+            {'op': 'update', 'id': document.code, 'name': fake.bs(), 'content': fake.text(), 'folder': folders[1].code},
+        ]
+        response = self.call_api('POST', '/documents/batch/', {'operations': operations}, token=token.uuid)
+        results = self.assertJsonResponse(response)['results']
+        self.assertEqual([result['document']['folder'] for result in results], [folder.code for folder in folders])
+        self.assertEqual(Document.objects.get(id=document.id).folder, folders[1])
+    
+    def test_list(self):
+        token = TokenFactory()
+        folders = chain(token.account, 3)
+        documents = [DocumentFactory(account=token.account, folder=folder) for folder in folders]
+        DocumentFactory(account=token.account)
+        
+        def listed(query):
+            response = self.call_api('GET', '/documents/' + query, token=token.uuid)
+            return [document['id'] for document in self.assertJsonResponse(response)['documents']]
+        
+        self.assertEqual(listed(f'?folder={folders[1].code}'), [documents[1].code])
+        self.assertEqual(listed(f'?subtree={folders[1].code}'), [documents[1].code, documents[2].code])
+        self.assertEqual(listed(f'?subtree={folders[0].code}&view=summary'), [doc.code for doc in documents])
+        response = self.call_api('GET', f'/documents/?subtree={FolderFactory().code}', token=token.uuid)
+        self.assertJsonResponse(response, status_code=403)
+
+
+class FolderQueryTests(CustomTestCase):
+    # Folder operations should cost the same, however deep or large the tree.
+    
+    def seed(self, size):
+        token = TokenFactory()
+        folders = chain(token.account, size)
+        for folder in folders:
+            DocumentFactory(account=token.account, folder=folder)
+        return token, folders
+    
+    def test_list(self):
+        for query in ['?parent={}', '?subtree={}']:
+            with self.subTest(query=query):
+                self.assertScaleInvariant(self.seed, lambda seeded: self.assertJsonResponse(
+                    self.call_api('GET', '/folders/' + query.format(seeded[1][0].code), token=seeded[0].uuid)))
+    
+    def test_documents(self):
+        self.assertScaleInvariant(self.seed, lambda seeded: self.assertJsonResponse(
+            self.call_api('GET', f'/documents/?subtree={seeded[1][0].code}', token=seeded[0].uuid)))
+    
+    def test_move(self):
+        def call(seeded):
+            token, folders = seeded
+            target = FolderFactory(account=token.account)
+            response = self.call_api('PUT', f'/folders/{folders[1].code}/', {'name': 'x', 'parent': target.code}, token=token.uuid)
+            self.assertJsonResponse(response)
+        # Looking up the folder and its new parent share a query shape.
+        self.assertScaleInvariant(self.seed, call, repeats=2)
+    
+    def test_delete(self):
+        self.assertScaleInvariant(self.seed, lambda seeded: self.assertJsonResponse(
+            self.call_api('DELETE', f'/folders/{seeded[1][0].code}/', token=seeded[0].uuid)))
+    
+    def test_indexes(self):
+        token, folders = self.seed(3)
+        with CaptureQueriesContext(connection) as queries:
+            for path in [f'/folders/?parent={folders[0].code}', f'/documents/?folder={folders[0].code}']:
+                self.assertJsonResponse(self.call_api('GET', path, token=token.uuid))
+        listings = [query['sql'] for query in queries if 'LIMIT' in query['sql'] and 'ORDER BY' in query['sql']]
+        self.assertUsesIndex(listings[-2], 'folder_live_parent_idx')
+        self.assertUsesIndex(listings[-1], 'document_live_folder_idx')
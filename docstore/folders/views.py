@@ -0,0 +1,79 @@
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+
+from ..libs.pagination import paginate
+from ..libs.views import ApiResponse, ApiView
+
+from .forms import FolderForm
+from .models import Folder
+from .serializers import serialize_folder
+
+
+def find_folder(request, code):
+    try:
+        return Folder.objects.get(code=code, account=request.account)
+    except Folder.DoesNotExist:
+        raise PermissionDenied
+
+
+class FolderList(ApiView):
+    def get(self, request):
+        r'''List the children of the `parent` folder, or the top level without one.
+            With `subtree`, lists that folder and everything below it instead.
+        '''#"""#'''
+        
+        folders = Folder.objects.filter(account=request.account)
+        if request.GET.get('subtree'):
+            folders = find_folder(request, request.GET['subtree']).subtree(folders)
+        elif request.GET.get('parent'):
+            folders = folders.filter(parent_id=Folder.decode(request.GET['parent'], -1))
+        else:
+            folders = folders.filter(parent=None)
+        
+        page, cursor = paginate(folders, request.GET)
+        return {
+            'folders': [serialize_folder(folder) for folder in page],
+            'next': cursor,
+        }
+    
+    def post(self, request):
+        form = FolderForm(request.POST, account=request.account)
+        if not form.is_valid():
+            return ApiResponse(status=400, errors=form.errors)
+        
+        folder = form.save()
+        return {
+            'folder': serialize_folder(folder),
+        }
+
+
+class FolderView(ApiView):
+    def get(self, request, code):
+        return {
+            'folder': serialize_folder(find_folder(request, code)),
+        }
+    
+    def put(self, request, code):
+        r'''Rename a folder, and move it when a `parent` is given.
+            An empty parent moves it to the top level.
+        '''#"""#'''
+        
+        folder = find_folder(request, code)
+        form = FolderForm(request.POST, instance=folder, account=request.account)
+        if not form.is_valid():
+            return ApiResponse(status=400, errors=form.errors)
+        
+        with transaction.atomic():
+            folder = form.save()
+            if 'parent' in request.POST:
+                folder.move(form.cleaned_data['parent'])
+        return {
+            'folder': serialize_folder(folder),
+        }
+    
+    def delete(self, request, code):
+        folder = find_folder(request, code)
+        folder.delete()
+        return {
+            'folder': serialize_folder(folder),
+        }
@@ -0,0 +1,251 @@
+r'''Lightweight benchmarks for the service's hot paths.
+    Each app may provide a `benchmarks` module whose functions are registered
+    with @benchmark; every function takes a repeat count and returns a dict
+    of measurements. Run them all against a throwaway database with:
+
+        python manage.py bench
+'''#"""#'''
+
+import tracemalloc
+from time import perf_counter
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+registry = {}
+
+# Amount of synthetic data to seed, set for each run.
+scale = {
+    'accounts': 10,
+    'documents': 100,
+}
+
+# Fixture values, shared by the benchmarks within one run.
+fixtures = {}
+
+
+def benchmark(func):
+    registry['%s.%s' % (func.__module__.split('.')[-2], func.__name__)] = func
+    return func
+
+
+def fixture(func):
+    r'''Build some benchmark data on first use, then reuse it for the rest of the run.
+    '''#"""#'''
+
+    from functools import wraps
+
+    @wraps(func)
+    def wrapper():
+        if func not in fixtures:
+            fixtures[func] = func()
+        return fixtures[func]
+    return wrapper
+
+
+def percentile(timings, fraction):
+    # Nearest-rank percentile of a sorted list.
+    from math import ceil
+    return timings[max(0, ceil(fraction * len(timings)) - 1)]
+
+
+def measure(func, repeat=100):
+    r'''Call a function repeatedly, recording its latency and query count.
+        One untimed call comes first, to warm up caches and lazy imports,
+        and one more comes last, to find the peak memory allocated by a call
+        without slowing down the timed ones.
+    '''#"""#'''
+
+    func()
+    timings = []
+    queries = 0
+    for n in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            started = perf_counter()
+            func()
+            timings.append(perf_counter() - started)
+        queries += len(captured)
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'calls': repeat,
+        'mean_ms': sum(timings) * 1000 / repeat,
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'queries_per_call': queries / repeat,
+        'peak_kb': peak / 1024,
+    }
+
+
+def discover():
+    from importlib import import_module
+    from importlib.util import find_spec
+    from django.conf import settings
+    for app in settings.INSTALLED_APPS:
+        if app.startswith('docstore.') and find_spec(app + '.benchmarks'):
+            import_module(app + '.benchmarks')
+    return registry
+
+
+def run(names=None, repeat=100, **sizes):
+    r'''Run the selected benchmarks inside a freshly created test database.
+        Keyword arguments override the amount of seeded data in `scale`.
+    '''#"""#'''
+
+    from django.test.utils import setup_databases, teardown_databases
+    benchmarks = discover()
+    unknown = set(names or ()) - set(benchmarks)
+    if unknown:
+        raise KeyError('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+    scale.update(sizes)
+    fixtures.clear()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        return {
+            name: benchmarks[name](repeat)
+            for name in (names or sorted(benchmarks))
+        }
+    finally:
+        fixtures.clear()
+        teardown_databases(old_config, verbosity=0)
+
+
+def regressions(results, baseline, tolerance=0.2, path=()):
+    r'''Compare results against an earlier run of the same benchmarks.
+        Yields a description of each measurement whose p95 latency grew
+        by more than the tolerance, or whose query count grew at all.
+        Benchmarks missing from either run are ignored.
+    '''#"""#'''
+
+    for key, value in results.items():
+        old = baseline.get(key)
+        if not isinstance(value, dict) or not isinstance(old, dict):
+            continue
+        if 'p95_ms' in value and 'p95_ms' in old:
+            name = '.'.join(path + (key,))
+            if value['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+                yield '%s: p95 %.3fms -> %.3fms' % (name, old['p95_ms'], value['p95_ms'])
+            if value['queries_per_call'] > old['queries_per_call']:
+                yield '%s: %g -> %g queries' % (name, old['queries_per_call'], value['queries_per_call'])
+        else:
+            yield from regressions(value, old, tolerance, path + (key,))
+
+
+@benchmark
+def idencoder(repeat, size=100000):
+    # Compare scalar and batch encoding on a large list of ids.
+    from random import randrange
+    from . import idencoder
+    alphabet = idencoder.random_alphabet()
+    ids = [randrange(2 ** 24) for n in range(size)]
+    codes = idencoder.encode_many(ids, alphabet)
+    repeat = max(1, repeat // 20)
+    return {
+        'ids': size,
+        'numpy': idencoder.numpy is not None,
+        'encode': measure(lambda: [idencoder.encode(n, alphabet) for n in ids], repeat),
+        'encode_many': measure(lambda: idencoder.encode_many(ids, alphabet), repeat),
+        'decode': measure(lambda: [idencoder.decode(c, alphabet) for c in codes], repeat),
+        'decode_many': measure(lambda: idencoder.decode_many(codes, alphabet), repeat),
+    }
+
+
+@benchmark
+def json_encoding(repeat, size=1000):
+    # Compare the JSON backends on a large list response and batch request.
+    from datetime import timedelta
+    from django.utils import timezone
+    from .encoding import backend, backends, orjson
+    from .factories import fake
+    now = timezone.now()
+    documents = [{
+        'id': 'd-%07d' % n,
+        'name': fake.catch_phrase(),
+        'content': fake.text(),
+        'account': 'a-0000001',
+        'created': now - timedelta(days=n, microseconds=n),
+        'modified': now - timedelta(seconds=n),
+        'deleted': None,
+    } for n in range(size)]
+    body = backend('stdlib').encode({'operations': [
+        {'op': 'create', 'name': doc['name'], 'content': doc['content']} for doc in documents
+    ]})
+    repeat = max(1, repeat // 10)
+    results = {'documents': size, 'response_bytes': len(backend('stdlib').encode(documents))}
+    for name in backends:
+        if name == 'orjson' and orjson is None:
+            continue
+        encoder = backend(name)
+        results[name] = {
+            'encode': measure(lambda: encoder.encode({'result': {'documents': documents}, 'errors': None}), repeat),
+            'decode': measure(lambda: encoder.decode(body), repeat),
+        }
+
+    # The previous encoder, for comparison.
+    from json import dumps, loads
+    from decimal import Decimal
+    from django.core.serializers.json import DjangoJSONEncoder
+    results['django'] = {
+        'encode': measure(lambda: dumps({'result': {'documents': documents}, 'errors': None}, cls=DjangoJSONEncoder), repeat),
+        'decode': measure(lambda: loads(body.decode('utf-8'), parse_float=Decimal), repeat),
+    }
+    return results
+
+
+@benchmark
+def view_dispatch(repeat, size=1000):
+    # Route requests to a trivial view through its handler table,
+    # and through a fresh instance per request, as views used to be.
+    from logging import getLogger
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from .views import SimpleView
+    response = HttpResponse()
+    
+    class View(SimpleView):
+        def get(self, request, code):
+            return response
+    
+    class Previous(object):
+        http_method_names = View.http_method_names
+        
+        def __init__(self):
+            self.log = getLogger('%s.%s' % (self.__class__.__module__, self.__class__.__name__))
+        
+        def __call__(self, request, *args, **kwargs):
+            if hasattr(self, 'get') and not hasattr(self, 'head'):
+                self.head = self.get
+            self.request = request
+            self.args = args
+            self.kwargs = kwargs
+            handler = None
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), None)
+            return handler(request, *args, **kwargs)
+        
+        def get(self, request, code):
+            return response
+    
+    factory = RequestFactory()
+    requests = [factory.get('/') if n % 2 else factory.head('/') for n in range(size)]
+    repeat = max(1, repeat // 10)
+    return {
+        'requests': size,
+        'compiled': measure(lambda: [View(request, code='x') for request in requests], repeat),
+        'previous': measure(lambda: [Previous()(request, code='x') for request in requests], repeat),
+    }
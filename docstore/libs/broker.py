@@ -0,0 +1,169 @@
+r'''Publish/subscribe notifications for clients waiting on changes.
+    Messages carry no data: each one only tells the subscribers of a channel
+    that something changed, and they look up what changed themselves.
+    Subscribers wait in an event loop, so each one costs a few small objects
+    instead of a thread.
+
+    LocalBroker only reaches subscribers in the same process; PollingBroker
+    stands in for a shared broker when there are several, by also asking
+    the database every few seconds which channels have changed.
+    Select one with settings.BROKER.
+'''#"""#'''
+
+import asyncio
+from abc import ABCMeta, abstractmethod
+from threading import Lock, Thread
+
+
+class Subscription(object):
+    r'''A subscriber's interest in one channel, bound to its event loop.
+        Notifications arriving between waits aren't lost: the next
+        wait returns immediately instead.
+    '''#"""#'''
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def notify(self):
+        # Publishers may be in any thread.
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # The loop has already closed.
+            pass
+
+    async def wait(self, timeout=None):
+        r'''Wait for a notification, returning whether one arrived in time.
+        '''#"""#'''
+
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.event.clear()
+        return True
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    def __init__(self):
+        self.channels = {}
+        self.lock = Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.channels.get(subscription.channel, ())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.channels.pop(subscription.channel, None)
+
+    def publish(self, channel):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for subscription in subscribers:
+            subscription.notify()
+
+    def subscribers(self):
+        with self.lock:
+            return sum(len(subscribers) for subscribers in self.channels.values())
+
+
+class PollingBroker(LocalBroker, metaclass=ABCMeta):
+    r'''A LocalBroker that also finds changes made by other processes.
+        A background thread calls changed() every settings.BROKER_POLL_INTERVAL
+        seconds for the channels with subscribers here, and notifies them of
+        anything newer than they've already been told about.
+        Subclasses must implement changed() for their own kind of channel.
+    '''#"""#'''
+
+    def __init__(self):
+        from django.conf import settings
+        super().__init__()
+        self.interval = settings.BROKER_POLL_INTERVAL
+        self.latest = {}
+        self.thread = None
+
+    def subscribe(self, channel):
+        from django.utils import timezone
+        subscription = super().subscribe(channel)
+        with self.lock:
+            # Older changes were there for the subscriber to read already.
+            self.latest.setdefault(channel, timezone.now())
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='broker-poll', daemon=True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        super().unsubscribe(subscription)
+        with self.lock:
+            if subscription.channel not in self.channels:
+                self.latest.pop(subscription.channel, None)
+
+    @abstractmethod
+    def changed(self, channels):
+        r'''Map each of the given channels to the time it last changed.
+            Channels that have never changed may be left out.
+        '''#"""#'''
+
+    def poll(self):
+        with self.lock:
+            channels = list(self.latest)
+        if not channels:
+            return
+        for channel, modified in self.changed(channels).items():
+            with self.lock:
+                seen = self.latest.get(channel)
+                if seen is None or modified <= seen:
+                    continue
+                self.latest[channel] = modified
+            self.publish(channel)
+
+    def run(self):
+        from logging import getLogger
+        from time import sleep
+        from django.db import close_old_connections
+        log = getLogger('docstore')
+        while True:
+            sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                log.exception('Error polling for changes:')
+            finally:
+                close_old_connections()
+
+
+instances = {}
+instances_lock = Lock()
+
+
+def broker():
+    r'''The broker class named by settings.BROKER, created on first use.
+        Publishers and subscribers must share an instance, hence the lock.
+    '''#"""#'''
+
+    from django.conf import settings
+    from django.utils.module_loading import import_string
+    name = settings.BROKER
+    with instances_lock:
+        if name not in instances:
+            instances[name] = import_string(name)()
+        return instances[name]
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+MISSING = object()
+
+
+class ExpiringCache(object):
+    r'''A bounded, thread-safe LRU cache with per-entry expiration.
+        Intended for small, hot lookups shared by every thread of a process.
+        Values of None are allowed, for negative caching of missing rows.
+    '''#"""#'''
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        r'''Remove every entry whose value matches the predicate.
+            Linear in the size of the cache, so meant for rare events.
+        '''#"""#'''
+
+        with self.lock:
+            for key in [key for key, (expires, value) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,114 @@
+r'''JSON encoding and decoding for API requests and responses.
+    Uses orjson when it's installed, or the standard library otherwise.
+    Both backends produce the same values, differing only in whitespace
+    and in which characters get escaped, so clients can't tell them apart.
+'''#"""#'''
+
+from datetime import datetime
+from decimal import Decimal
+from json import JSONDecoder
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ApiJSONEncoder(DjangoJSONEncoder):
+    r'''Django's encoder, but keeping full datetime precision like orjson does.
+    '''#"""#'''
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            text = o.isoformat()
+            if text.endswith('+00:00'):
+                text = text[:-6] + 'Z'
+            return text
+        return super().default(o)
+
+
+class StdlibBackend(object):
+    name = 'stdlib'
+
+    def __init__(self):
+        self.encoder = ApiJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        self.decoder = JSONDecoder(parse_float=Decimal)
+
+    def encode(self, data):
+        return self.encoder.encode(data).encode('utf-8')
+
+    def decode(self, body):
+        return self.decoder.decode(body.decode('utf-8'))
+
+
+class OrjsonBackend(StdlibBackend):
+    r'''Encodes datetimes, UUIDs, and plain types natively in C.
+        Decoding falls back to the standard library whenever orjson's result
+        would differ from it: for floats, which must become Decimals,
+        and for anything orjson rejects, like huge integers or NaN.
+    '''#"""#'''
+
+    name = 'orjson'
+
+    def __init__(self):
+        super().__init__()
+        self.fallback = self.encoder.default
+        self.options = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+    def default(self, value):
+        if isinstance(value, Decimal):
+            return str(value)
+        return self.fallback(value)
+
+    def encode(self, data):
+        return orjson.dumps(data, default=self.default, option=self.options)
+
+    def decode(self, body):
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return super().decode(body)
+        if contains_float(data):
+            return super().decode(body)
+        return data
+
+
+def contains_float(data):
+    # orjson only produces exact builtin types, so type() checks are safe.
+    if type(data) is float:
+        return True
+    pending = [data] if type(data) in (dict, list) else []
+    while pending:
+        item = pending.pop()
+        for value in (item.values() if type(item) is dict else item):
+            kind = type(value)
+            if kind is float:
+                return True
+            if kind is dict or kind is list:
+                pending.append(value)
+    return False
+
+
+backends = {
+    'stdlib': StdlibBackend,
+    'orjson': OrjsonBackend,
+}
+
+instances = {}
+
+
+def backend(name=None):
+    r'''The JSON backend named by settings.JSON_BACKEND, or the given name.
+        'auto' picks orjson when it's installed.
+    '''#"""#'''
+
+    if name is None:
+        from django.conf import settings
+        name = settings.JSON_BACKEND
+    if name == 'auto':
+        name = 'stdlib' if orjson is None else 'orjson'
+    if name not in instances:
+        instances[name] = backends[name]()
+    return instances[name]
@@ -0,0 +1,142 @@
+import lzma
+import zlib
+
+from django.conf import settings
+from django.db.models.fields import TextField
+from django.db.models.query_utils import DeferredAttribute
+
+
+# Format markers, stored as the first byte of each value.
+RAW = b'='
+ZLIB = b'z'
+LZMA = b'x'
+
+compressors = {
+    'zlib': (ZLIB, lambda data: zlib.compress(data, 6)),
+    'lzma': (LZMA, lambda data: lzma.compress(data)),
+}
+
+# Incremental versions, producing the same formats.
+stream_compressors = {
+    'zlib': (ZLIB, lambda: zlib.compressobj(6)),
+    'lzma': (LZMA, lambda: lzma.LZMACompressor()),
+}
+
+decompressors = {
+    RAW: bytes,
+    ZLIB: zlib.decompress,
+    LZMA: lzma.decompress,
+}
+
+
+class PackedText(bytes):
+    r'''Stored bytes for a CompressedTextField, not yet decompressed.
+    '''#"""#'''
+
+
+def pack(text):
+    r'''Encode text for storage, compressing it if that's worthwhile.
+        Text shorter than settings.CONTENT_COMPRESSION_THRESHOLD bytes,
+        or that doesn't get any smaller, is stored as plain UTF-8.
+    '''#"""#'''
+
+    data = text.encode('utf-8')
+    if len(data) >= settings.CONTENT_COMPRESSION_THRESHOLD:
+        algorithm = compressors.get(settings.CONTENT_COMPRESSION)
+        if algorithm is not None:
+            marker, compress = algorithm
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                return marker + compressed
+    return RAW + data
+
+
+class Packer(object):
+    r'''Encode text for storage as pack() does, from UTF-8 chunks as they arrive.
+        Once past the threshold, chunks are compressed without keeping them,
+        so text that doesn't get any smaller is stored compressed anyway.
+    '''#"""#'''
+
+    def __init__(self):
+        self.plain = bytearray()
+        self.compressor = None
+        self.parts = []
+
+    def write(self, data):
+        if self.compressor is not None:
+            self.parts.append(self.compressor.compress(data))
+            return
+        self.plain += data
+        algorithm = stream_compressors.get(settings.CONTENT_COMPRESSION)
+        if algorithm is not None and len(self.plain) >= settings.CONTENT_COMPRESSION_THRESHOLD:
+            marker, start = algorithm
+            self.compressor = start()
+            self.parts = [marker, self.compressor.compress(bytes(self.plain))]
+            self.plain = None
+
+    def packed(self):
+        if self.compressor is None:
+            return PackedText(RAW + self.plain)
+        return PackedText(b''.join(self.parts + [self.compressor.flush()]))
+
+
+def unpack(value):
+    value = bytes(value)
+    return decompressors[value[:1]](value[1:]).decode('utf-8')
+
+
+class CompressedTextDescriptor(DeferredAttribute):
+    r'''Decompresses field values the first time they are read.
+        Rows can be loaded, and even saved, without paying for it.
+    '''#"""#'''
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, PackedText):
+            value = unpack(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(TextField):
+    r'''A text field stored in a binary column, compressed when large.
+        Each stored value starts with a marker byte naming its format,
+        so the compression settings can change without rewriting old rows.
+        Lookups other than isnull are not supported on the stored bytes.
+    '''#"""#'''
+
+    descriptor_class = CompressedTextDescriptor
+
+    def get_internal_type(self):
+        return 'BinaryField'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return PackedText(value)
+
+    def to_python(self, value):
+        if isinstance(value, PackedText):
+            return unpack(value)
+        return super().to_python(value)
+
+    def pre_save(self, model_instance, add):
+        # Avoid decompressing values that were never read.
+        return model_instance.__dict__.get(self.attname)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, PackedText):
+            return value
+        return pack(super().get_prep_value(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is not None:
+            return connection.Database.Binary(value)
+        return value
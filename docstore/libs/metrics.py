@@ -0,0 +1,186 @@
+r'''Request metrics, aggregated in-process and exposed in Prometheus text format.
+    Each thread records into a shard of its own, so the request path never
+    waits on a lock; shards are only merged when the metrics are scraped.
+'''#"""#'''
+
+from bisect import bisect_left
+from threading import Lock, local
+
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Other methods are counted together, to keep clients from inventing labels.
+KNOWN_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+# Positions of the totals that follow the bucket counts in each row.
+COUNT, SECONDS, QUERIES, QUERY_SECONDS, BYTES = range(len(LATENCY_BUCKETS) + 1, len(LATENCY_BUCKETS) + 6)
+
+
+class Collector(object):
+    r'''Per-view request statistics, kept in one shard per thread.
+        Rows are keyed by (view, method, status); each one holds the
+        latency bucket counts, followed by the request count and total
+        seconds, database queries and seconds, and response bytes.
+    '''#"""#'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.local = local()
+        self.shards = []
+        self.lock = Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            # Only a thread's first request needs the lock.
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def record(self, view, method, status, seconds, queries=0, query_seconds=0, size=0):
+        if method not in KNOWN_METHODS:
+            method = 'OTHER'
+        shard = self.shard()
+        key = (view, method, status)
+        row = shard.get(key)
+        if row is None:
+            row = shard[key] = [0] * (BYTES + 1)
+        # The overflow bucket sits at len(buckets), and counts toward +Inf only.
+        row[bisect_left(self.buckets, seconds)] += 1
+        row[COUNT] += 1
+        row[SECONDS] += seconds
+        row[QUERIES] += queries
+        row[QUERY_SECONDS] += query_seconds
+        row[BYTES] += size
+
+    def snapshot(self):
+        r'''Merge every thread's rows into one dict, without stopping them.
+            Copies of dicts and lists are atomic under the GIL,
+            so a row may miss a request in progress, but is never torn.
+        '''#"""#'''
+
+        with self.lock:
+            shards = list(self.shards)
+        totals = {}
+        for shard in shards:
+            for key, row in shard.copy().items():
+                row = list(row)
+                if key in totals:
+                    totals[key] = [a + b for a, b in zip(totals[key], row)]
+                else:
+                    totals[key] = row
+        return totals
+
+    def clear(self):
+        with self.lock:
+            for shard in self.shards:
+                shard.clear()
+
+    def exposition(self):
+        r'''Render the current totals in the Prometheus text format.
+        '''#"""#'''
+
+        rows = self.snapshot()
+        views = {}
+        for (view, method, status), row in rows.items():
+            merged = views.get((view, method))
+            views[(view, method)] = row if merged is None else [a + b for a, b in zip(merged, row)]
+
+        lines = [
+            '# HELP docstore_requests_total Requests handled, by view and status.',
+            '# TYPE docstore_requests_total counter',
+        ]
+        for (view, method, status), row in sorted(rows.items()):
+            lines.append('docstore_requests_total{%s,status="%s"} %d' % (labels(view, method), status, row[COUNT]))
+
+        lines.extend([
+            '# HELP docstore_request_duration_seconds Time spent producing responses.',
+            '# TYPE docstore_request_duration_seconds histogram',
+        ])
+        for (view, method), row in sorted(views.items()):
+            names = labels(view, method)
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                lines.append('docstore_request_duration_seconds_bucket{%s,le="%g"} %d' % (names, bound, cumulative))
+            lines.append('docstore_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (names, row[COUNT]))
+            lines.append('docstore_request_duration_seconds_sum{%s} %.6f' % (names, row[SECONDS]))
+            lines.append('docstore_request_duration_seconds_count{%s} %d' % (names, row[COUNT]))
+
+        for name, index, kind, description in [
+            ('docstore_db_queries_total', QUERIES, 'd', 'Database queries run while producing responses.'),
+            ('docstore_db_duration_seconds_total', QUERY_SECONDS, '.6f', 'Time spent in database queries.'),
+            ('docstore_response_bytes_total', BYTES, 'd', 'Size of response bodies, where known.'),
+        ]:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s counter' % name)
+            for (view, method), row in sorted(views.items()):
+                lines.append(('%s{%s} %' + kind) % (name, labels(view, method), row[index]))
+
+        from ..accounts.models import missing_token_cache, token_cache
+        for name, cache, description in [
+            ('token_cache', token_cache, 'Authentication tokens held in this process.'),
+            ('missing_token_cache', missing_token_cache, 'Unknown tokens remembered by this process.'),
+        ]:
+            stats = cache.stats()
+            lines.extend([
+                '# HELP docstore_%s_entries %s' % (name, description),
+                '# TYPE docstore_%s_entries gauge' % name,
+                'docstore_%s_entries %d' % (name, stats['size']),
+            ])
+            for key in ['hits', 'misses', 'evictions']:
+                lines.append('# TYPE docstore_%s_%s_total counter' % (name, key))
+                lines.append('docstore_%s_%s_total %d' % (name, key, stats[key]))
+        return '\n'.join(lines) + '\n'
+
+
+def labels(view, method):
+    view = view.replace('\\', '\\\\').replace('"', '\\"')
+    return 'view="%s",method="%s"' % (view, method)
+
+
+class QueryTimer(object):
+    r'''Database execute wrapper that counts queries and the time they take.
+    '''#"""#'''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        from time import perf_counter
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += perf_counter() - started
+            self.queries += 1
+
+
+collector = Collector()
+
+
+def metrics(request):
+    r'''Expose the collected metrics for scraping.
+        Scrapers must send settings.METRICS_TOKEN as a bearer token;
+        without one, the metrics are only served in DEBUG mode.
+    '''#"""#'''
+
+    from hmac import compare_digest
+    from django.conf import settings
+    from django.http import HttpResponse
+    if not settings.METRICS_TOKEN:
+        if not settings.DEBUG:
+            return HttpResponse('Not Found\n', status=404, content_type='text/plain')
+    else:
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if not compare_digest(auth.encode('utf-8'), ('Bearer ' + settings.METRICS_TOKEN).encode('utf-8')):
+            return HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+    return HttpResponse(collector.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Scrapers sending METRICS_TOKEN need no sessions.
+metrics.sessionless = True
@@ -31,3 +31,112 @@ class SecurityPolicyMiddleware(object):
             "script-src 'self'",
         ])
         return response
+
+
+class MetricsMiddleware(object):
+    r'''Record latency, database use, and response size for each view.
+        Belongs at the top of the middleware list, to time everything below.
+        Queries made while a streaming response is consumed are not counted.
+    '''#"""#'''
+    
+    def __init__(self, get_response):
+        from .metrics import collector
+        self.collector = collector
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        from time import perf_counter
+        from django.db import connection
+        from .metrics import QueryTimer
+        timer = QueryTimer()
+        started = perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        elapsed = perf_counter() - started
+        
+        if response.streaming:
+            size = int(response.get('Content-Length', 0))
+        else:
+            size = len(response.content)
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        self.collector.record(view, request.method, response.status_code, elapsed, timer.queries, timer.seconds, size)
+        
+        timing = 'app;dur=%.1f, db;dur=%.1f;desc="%d queries"' % (elapsed * 1000, timer.seconds * 1000, timer.queries)
+        if response.has_header('Server-Timing'):
+            timing = response['Server-Timing'] + ', ' + timing
+        response['Server-Timing'] = timing
+        return response
+
+
+class BrowserMiddleware(object):
+    r'''Run settings.BROWSER_MIDDLEWARE, except for token-authenticated API requests.
+        Sessions, CSRF checks, user authentication, messages, and frame options
+        only matter to browsers, so requests sending a bearer token to a view
+        marked as sessionless skip straight to the view instead.
+        Admin and other HTML routes get the full stack, hooks included.
+    '''#"""#'''
+    
+    def __init__(self, get_response):
+        from django.conf import settings
+        from django.core.exceptions import MiddlewareNotUsed
+        from django.core.handlers.exception import convert_exception_to_response
+        from django.utils.module_loading import import_string
+        self.get_response = get_response
+        self.view_hooks = []
+        self.template_hooks = []
+        self.exception_hooks = []
+        
+        # Chain the inner middleware the same way Django's handler does.
+        handler = get_response
+        for path in reversed(settings.BROWSER_MIDDLEWARE):
+            try:
+                instance = import_string(path)(handler)
+            except MiddlewareNotUsed:
+                continue
+            if hasattr(instance, 'process_view'):
+                self.view_hooks.insert(0, instance.process_view)
+            if hasattr(instance, 'process_template_response'):
+                self.template_hooks.append(instance.process_template_response)
+            if hasattr(instance, 'process_exception'):
+                self.exception_hooks.append(instance.process_exception)
+            handler = convert_exception_to_response(instance)
+        self.browser = handler
+    
+    def __call__(self, request):
+        request.sessionless = self.sessionless(request)
+        if request.sessionless:
+            return self.get_response(request)
+        return self.browser(request)
+    
+    def sessionless(self, request):
+        from django.urls import Resolver404, resolve
+        if not request.META.get('HTTP_AUTHORIZATION', '').startswith('Bearer '):
+            return False
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        return getattr(match.func, 'sessionless', False)
+    
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not request.sessionless:
+            for hook in self.view_hooks:
+                response = hook(request, view_func, view_args, view_kwargs)
+                if response is not None:
+                    return response
+        return None
+    
+    def process_template_response(self, request, response):
+        if not request.sessionless:
+            for hook in self.template_hooks:
+                response = hook(request, response)
+        return response
+    
+    def process_exception(self, request, exception):
+        if not request.sessionless:
+            for hook in self.exception_hooks:
+                response = hook(request, exception)
+                if response is not None:
+                    return response
+        return None
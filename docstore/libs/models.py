@@ -1,9 +1,37 @@
 from django.conf import settings
+from django.db import transaction
 from django.db.models import DateTimeField, Expression, Manager, Model, QuerySet
 from django.utils import timezone
 
 from .functional import cached_class_property
-from .idencoder import encode, decode
+from .idencoder import encode, encode_many, decode, decode_many
+
+
+def returns_from_update(connection):
+    r'''Whether a database can return columns from UPDATE statements.
+    '''#"""#'''
+    
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+def oldest_transaction(connection):
+    r'''When the oldest transaction still open on the database began, other
+        than the connection's own; None if there are none, or if the database
+        can't tell, as only PostgreSQL can.  Idle transactions count, too.
+    '''#"""#'''
+    
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT min(xact_start) FROM pg_stat_activity"
+            " WHERE datname = current_database() AND pid <> pg_backend_pid() AND backend_type = 'client backend'"
+        )
+        return cursor.fetchone()[0]
 
 
 class BasicQuerySet(QuerySet):
@@ -23,12 +51,56 @@ class BasicQuerySet(QuerySet):
         if 'code' in kwargs:
             kwargs['id'] = self.model.decode(kwargs.pop('code', -1))
         if 'code__in' in kwargs:
-            codes = []
-            for code in kwargs.pop('code__in'):
-                codes.append(self.model.decode(code, -1))
-                kwargs['id__in'] = codes
+            # Malformed codes can't match anything, so they're simply dropped.
+            ids = set(self.model.decode_many(kwargs.pop('code__in')))
+            ids.discard(None)
+            kwargs['id__in'] = ids
         return super().filter(*args, **kwargs)
     
+    def update_returning(self, fields=None, **kwargs):
+        r'''Update rows like update(), returning instances with the given fields
+            (or all of them) as they were written.  Where the database supports
+            UPDATE ... RETURNING, that takes a single statement.  Elsewhere,
+            the rows are found first and read back afterwards, so a concurrent
+            change could show up in the result.
+        '''#"""#'''
+        
+        from django.core.exceptions import EmptyResultSet
+        from django.db import connections
+        from django.db.models import sql
+        opts = self.model._meta
+        wanted = {opts.pk.name, *(fields or [field.name for field in opts.concrete_fields])}
+        columns = [field for field in opts.concrete_fields if field.name in wanted]
+        names = [field.attname for field in columns]
+        connection = connections[self.db]
+        
+        if not returns_from_update(connection):
+            ids = list(self.values_list('pk', flat=True))
+            if not ids or not self.filter(pk__in=ids).update(**kwargs):
+                return []
+            return list(self.model._base_manager.using(self.db).filter(pk__in=ids).only(*names))
+        
+        query = self.query.chain(sql.UpdateQuery)
+        query.add_update_values(kwargs)
+        query.annotations = {}
+        compiler = query.get_compiler(self.db)
+        try:
+            statement, params = compiler.as_sql()
+        except EmptyResultSet:
+            return []
+        if not statement:
+            return []
+        statement += ' RETURNING ' + ', '.join(connection.ops.quote_name(field.column) for field in columns)
+        with transaction.mark_for_rollback_on_error(using=self.db):
+            with connection.cursor() as cursor:
+                cursor.execute(statement, params)
+                rows = cursor.fetchall()
+        converters = compiler.get_converters([field.get_col(opts.db_table) for field in columns])
+        if converters:
+            rows = compiler.apply_converters(rows, converters)
+        return [self.model.from_db(self.db, names, row) for row in rows]
+    update_returning.alters_data = True
+    
     def vals(self, field):
         return self.values_list(field, flat=True)
     
@@ -95,13 +167,45 @@ class BasicModel(Model):
     def encode(cls, val):
         return cls.code_prefix + encode(val, cls.alphabet)
     
+    @classmethod
+    def decode_many(cls, codes, default=None):
+        prefix = cls.code_prefix
+        codes = [
+            code[len(prefix):] if isinstance(code, str) and code.startswith(prefix) else ''
+            for code in codes
+        ]
+        return decode_many(codes, cls.alphabet, default)
+    
+    @classmethod
+    def encode_many(cls, vals):
+        prefix = cls.code_prefix
+        return [prefix + code for code in encode_many(vals, cls.alphabet)]
+    
     def __str__(self):
         return '%s #%s (%s)' % (self.__class__.__name__, self.pk, self.code)
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.discard_cached()
+        transaction.on_commit(self.discard_cached)
+    
+    def discard_cached(self):
+        r'''Remove any cached copies of this row from in-process caches.
+            Called after every save, and again once the transaction commits,
+            so that other threads can't re-cache the old version in between.
+            Models that are cached anywhere should extend this.
+        '''#"""#'''
+        
+        pass
+    
     def delete(self):
         self.update(deleted=timezone.now())
     delete.alters_data = True
 
+    def restore(self):
+        self.update(deleted=None)
+    restore.alters_data = True
+
     def update(self, **kwargs):
         r'''Update field values both on the instance and in the database.
             Safer than .save() without parameters, because it doesn't
@@ -114,7 +218,8 @@ class BasicModel(Model):
             if isinstance(kwargs[field], Expression):
                 # Handle things like F(field) + 1, for example.
                 expressions.add(field)
-        self.save(update_fields=list(kwargs))
+        # Any change counts as a modification, for caching and sync clients.
+        self.save(update_fields=list({'modified', *kwargs}))
         if expressions:
             # Retrieve the actual values of any calculated fields.
             values = self.__class__._base_manager.values(*expressions).get(pk=self.pk)
@@ -129,7 +234,10 @@ class BasicModel(Model):
         '''#"""#'''
 
         objects = self.__class__._base_manager
-        return objects.filter(pk=self.pk).update(**kwargs)
+        result = objects.filter(pk=self.pk).update(**kwargs)
+        self.discard_cached()
+        transaction.on_commit(self.discard_cached)
+        return result
     fast_update.alters_data = True
     
     def get_admin_url(self):
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+from .idencoder import encode, decode
+from .views import ApiException
+
+
+# Change cursors count microseconds from here.
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(*numbers):
+    r'''Build an opaque cursor string from one or more non-negative integers.
+    '''#"""#'''
+    
+    alphabet = settings.ENCODER_ALPHABETS['Cursor']
+    return '-'.join(encode(number, alphabet) for number in numbers)
+
+
+def decode_cursor(cursor, count=1):
+    r'''Recover the integers from a cursor built by encode_cursor().
+        Raises an ApiException for malformed or foreign cursors.
+    '''#"""#'''
+    
+    alphabet = settings.ENCODER_ALPHABETS['Cursor']
+    parts = str(cursor).split('-')
+    numbers = tuple(decode(part, alphabet) for part in parts)
+    if len(numbers) != count or None in numbers:
+        raise ApiException(['Invalid cursor'])
+    return numbers
+
+
+def page_limit(params):
+    r'''Determine the page size requested by the client.
+        Requests larger than settings.MAX_PAGE_SIZE are silently truncated.
+    '''#"""#'''
+    
+    limit = params.get('limit')
+    if limit is None or limit == '':
+        return settings.PAGE_SIZE
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ApiException(['Invalid limit'])
+    if limit < 1:
+        raise ApiException(['Invalid limit'])
+    return min(limit, settings.MAX_PAGE_SIZE)
+
+
+def paginate(queryset, params):
+    r'''Select a single page of results, ordered by primary key.
+        Uses keyset pagination, so deep pages cost as little as the first.
+        Returns the items and a cursor for the next page, or None at the end.
+    '''#"""#'''
+    
+    limit = page_limit(params)
+    cursor = params.get('cursor')
+    if cursor:
+        after, = decode_cursor(cursor)
+        queryset = queryset.filter(pk__gt=after)
+    
+    # Fetch one extra row to find out whether there is another page.
+    items = list(queryset.order_by('pk')[:limit + 1])
+    if len(items) > limit:
+        del items[limit:]
+        return items, encode_cursor(items[-1].pk)
+    return items, None
+
+
+def iterate_batches(queryset, params, chunk_size=None):
+    r'''Iterate over every item after the requested cursor, by primary key,
+        in lists of up to chunk_size items. Each list is a separate keyset
+        query, which bounds memory use without holding a server-side cursor
+        or transaction open. The cursor is checked before iteration begins.
+    '''#"""#'''
+    
+    after = None
+    cursor = params.get('cursor')
+    if cursor:
+        after, = decode_cursor(cursor)
+    return _iterate_batches(queryset.order_by('pk'), after, chunk_size or settings.STREAM_CHUNK_SIZE)
+
+
+async def flatten_async(batches):
+    r'''Iterate over the items in each of an iterable of lists, from an
+        event loop, taking each list from the iterable in a worker thread,
+        where queries are allowed.
+    '''#"""#'''
+    
+    from asgiref.sync import sync_to_async
+    batches = iter(batches)
+    fetch = sync_to_async(next)
+    while True:
+        batch = await fetch(batches, None)
+        if batch is None:
+            return
+        for item in batch:
+            yield item
+
+
+def _iterate_batches(queryset, after, chunk_size):
+    while True:
+        batch = queryset if after is None else queryset.filter(pk__gt=after)
+        items = list(batch[:chunk_size])
+        if items:
+            yield items
+        if len(items) < chunk_size:
+            break
+        after = items[-1].pk
+
+
+def paginate_changes(queryset, params, settled):
+    r'''Select the next page of rows changed since the client's `since` cursor.
+        Rows are ordered by modification time, with the primary key breaking
+        ties, so rows sharing a timestamp are neither skipped nor repeated.
+        Only rows modified before `settled` are included: timestamps are set
+        before their transactions commit, so a row stamped just now could
+        still appear behind a cursor that has already passed it.
+        Returns the items, a cursor to send next time, and whether more rows
+        are ready; the cursor stays the same when nothing has changed.
+    '''#"""#'''
+    
+    limit = page_limit(params)
+    since = params.get('since') or None
+    queryset = queryset.filter(modified__lt=settled)
+    if since:
+        micros, after = decode_cursor(since, 2)
+        modified = EPOCH + timedelta(microseconds=micros)
+        # The redundant lower bound gives the database a range to scan.
+        queryset = queryset.filter(Q(modified__gt=modified) | Q(modified=modified, pk__gt=after), modified__gte=modified)
+    
+    items = list(queryset.order_by('modified', 'pk')[:limit + 1])
+    more = len(items) > limit
+    del items[limit:]
+    if items:
+        last = items[-1]
+        elapsed = last.modified - EPOCH
+        micros = (elapsed.days * 86400 + elapsed.seconds) * 1000000 + elapsed.microseconds
+        since = encode_cursor(micros, last.pk)
+    return items, since, more
@@ -0,0 +1,158 @@
+r'''Storage for document content too large to keep in database rows.
+    Backends are keyed by content digest, so each body is stored once,
+    and the row only records which backend holds it. Bodies are kept as
+    plain UTF-8, uncompressed, so they can be served straight from disk.
+
+    Content stays in the database unless settings.CONTENT_STORAGE names
+    a backend; that backend then takes new content from its threshold up.
+    Rows keep naming the backend they were written to, so changing the
+    setting doesn't strand anything; `manage.py movecontent` moves
+    existing content in and out.
+'''#"""#'''
+
+import os
+from tempfile import mkstemp
+
+
+class FileStorage(object):
+    r'''Content files in a local directory, fanned out by digest prefix.
+        Files are written to a temporary name and renamed into place,
+        so readers never see a partial body.
+    '''#"""#'''
+
+    name = 'files'
+
+    @property
+    def directory(self):
+        from django.conf import settings
+        return settings.CONTENT_STORAGE_DIRECTORY
+
+    @property
+    def threshold(self):
+        from django.conf import settings
+        return settings.CONTENT_STORAGE_THRESHOLD
+
+    def accepts(self, size):
+        return size >= self.threshold
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def save(self, digest, data):
+        if self.touch(digest):
+            return
+        temporary, stream = self.spool()
+        try:
+            with stream:
+                stream.write(data)
+            self.keep(temporary, digest)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def spool(self):
+        r'''A new temporary file, as its path and an open binary stream,
+            for writing a body of unknown digest; keep() moves it into place.
+        '''#"""#'''
+
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temporary = mkstemp(dir=self.directory, prefix='.')
+        return temporary, os.fdopen(handle, 'wb')
+
+    def keep(self, temporary, digest):
+        if self.touch(digest):
+            os.unlink(temporary)
+            return
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary, path)
+
+    def touch(self, digest):
+        # Mark a stored body as recently used, to keep it from being discarded.
+        try:
+            os.utime(self.path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def read(self, digest):
+        with self.open(digest) as stream:
+            return stream.read()
+
+    def discard(self, digest, before=None):
+        r'''Delete a stored body, unless it was saved or touched since `before`.
+            Returns whether the file was deleted.
+        '''#"""#'''
+
+        path = self.path(digest)
+        try:
+            if before is not None and os.stat(path).st_mtime >= before.timestamp():
+                return False
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def sweep(self, before, in_use, batch_size=1000, dry_run=False):
+        r'''Delete files not modified since `before` that no row records:
+            bodies whose digests are missing from the set `in_use` returns
+            for each batch of them, and temporary files from spools that
+            were never kept, as when a request failed part way.
+            Returns the number of files deleted, or that would be.
+        '''#"""#'''
+
+        swept = 0
+        batch = []
+
+        def collect():
+            unused = set(batch) - set(in_use(batch))
+            batch.clear()
+            if dry_run:
+                return len(unused)
+            return sum(self.discard(digest, before) for digest in unused)
+
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime >= before.timestamp():
+                        continue
+                    if name.startswith('.'):
+                        if not dry_run:
+                            os.unlink(path)
+                        swept += 1
+                        continue
+                except FileNotFoundError:
+                    continue
+                batch.append(name)
+                if len(batch) >= batch_size:
+                    swept += collect()
+        if batch:
+            swept += collect()
+        return swept
+
+
+backends = {
+    'files': FileStorage,
+}
+
+instances = {}
+
+
+def backend(name=None):
+    r'''The storage backend with the given name, or the one named by
+        settings.CONTENT_STORAGE for new content.
+        Returns None for the database itself, named by an empty string.
+    '''#"""#'''
+
+    if name is None:
+        from django.conf import settings
+        name = settings.CONTENT_STORAGE
+    if not name:
+        return None
+    if name not in instances:
+        instances[name] = backends[name]()
+    return instances[name]
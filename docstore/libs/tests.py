@@ -2,9 +2,13 @@ from datetime import datetime, timedelta
 from json import loads as json_decode, dumps as json_encode
 
 from dateutil.parser import parse as parse_datetime
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.client import AsyncClient as BaseAsyncClient, AsyncClientHandler as BaseAsyncClientHandler
+from django.urls import include, path
 from django.utils import timezone
 
+from .views import ApiView, AsyncApiView, AsyncViewRouting
+
 
 class Timestamp(object):
     def __init__(self, expected, delta=timedelta(seconds=1)):
@@ -49,7 +53,96 @@ class Timestamp(object):
         return parse_datetime(value)
 
 
+class QueryBudget(object):
+    r'''Context manager recording each query with the stack that ran it.
+        On exit, fails the test if the queries exceed the budget,
+        or if any query shape ran more than `repeats` times,
+        which usually means a query inside a loop.
+    '''#"""#'''
+    
+    # Transaction control is exempt from repetition checks.
+    exempt = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT', 'BEGIN', 'COMMIT', 'ROLLBACK')
+    
+    def __init__(self, test, exact=None, maximum=None, repeats=1, using='default'):
+        self.test = test
+        self.exact = exact
+        self.maximum = maximum
+        self.repeats = repeats
+        self.using = using
+        self.queries = []
+    
+    def __enter__(self):
+        from django.db import connections
+        self.wrapper = connections[self.using].execute_wrapper(self.record)
+        self.wrapper.__enter__()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wrapper.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self.check()
+    
+    def __len__(self):
+        return len(self.queries)
+    
+    def record(self, execute, sql, params, many, context):
+        from traceback import extract_stack
+        self.queries.append((sql, extract_stack()[:-1]))
+        return execute(sql, params, many, context)
+    
+    @staticmethod
+    def shape(sql):
+        # Lists of parameters, rows, and cases vary in length with the data, not the code.
+        import re
+        sql = re.sub(r'\((?:%s, )*%s\)', '(...)', sql)
+        sql = re.sub(r'\(\.\.\.\)(?:, \(\.\.\.\))+', '(...)', sql)
+        sql = re.sub(r'(?: UNION ALL SELECT (?:%s, )*%s)+', ' UNION ALL ...', sql)
+        sql = re.sub(r'(?:WHEN \([^()]*\) THEN (?:%s|NULL|CAST\(%s AS [^()]*\)) )+', 'WHEN ... ', sql)
+        return re.sub(r'"s\d+_x\d+"', '"s..."', sql)
+    
+    @staticmethod
+    def origin(stack):
+        # Only this project's frames, leaving out Django's.
+        from os.path import dirname
+        root = dirname(dirname(__file__))
+        frames = [frame for frame in stack if frame.filename.startswith(root)]
+        return ''.join('    %s:%s in %s\n      %s\n' % (frame.filename[len(root) + 1:], frame.lineno, frame.name, frame.line)
+            for frame in frames)
+    
+    def report(self, queries):
+        return '\n'.join('%d. %s\n%s' % (n, sql, self.origin(stack)) for n, (sql, stack) in enumerate(queries, 1))
+    
+    def check(self):
+        count = len(self.queries)
+        if self.exact is not None and count != self.exact:
+            self.test.fail('Expected %d queries, but %d were run:\n%s' % (self.exact, count, self.report(self.queries)))
+        if self.maximum is not None and count > self.maximum:
+            self.test.fail('Expected at most %d queries, but %d were run:\n%s' % (self.maximum, count, self.report(self.queries)))
+        
+        from collections import defaultdict
+        shapes = defaultdict(list)
+        for sql, stack in self.queries:
+            if not sql.upper().startswith(self.exempt):
+                shapes[self.shape(sql)].append((sql, stack))
+        for shape, queries in shapes.items():
+            if len(queries) > self.repeats:
+                self.test.fail('Query ran %d times; is it inside a loop?\n%s' % (len(queries), self.report(queries)))
+
+
+class AsyncClientHandler(AsyncViewRouting, BaseAsyncClientHandler):
+    pass
+
+
+class AsyncClient(BaseAsyncClient):
+    # Serves async views the way docstore.asgi does.
+    
+    def __init__(self, enforce_csrf_checks=False, **kwargs):
+        super().__init__(enforce_csrf_checks, **kwargs)
+        self.handler = AsyncClientHandler(enforce_csrf_checks)
+
+
 class CustomTestCase(TestCase):
+    async_client_class = AsyncClient
     maxDiff = 5000
     
     def __str__(self):
@@ -58,8 +151,13 @@ class CustomTestCase(TestCase):
     
     def setUp(self):
         from django.utils import timezone
+        from ..accounts.models import missing_token_cache, token_cache
         super().setUp()
         self.started = timezone.now()
+        
+        # Cached rows would outlive the test transaction.
+        token_cache.clear()
+        missing_token_cache.clear()
     
     def assertTimestamped(self, when, delta=timedelta()):
         from django.utils import timezone
@@ -70,8 +168,12 @@ class CustomTestCase(TestCase):
     def assertJsonResponse(self, response, status_code=200):
         self.assertEqual(response.status_code, status_code)
         self.assertEqual(response.get('Content-Type'), 'application/json')
-        self.assertEqual(response.content[0], b'{'[0])
-        return json_decode(response.content).get('result')
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        self.assertEqual(content[0], b'{'[0])
+        return json_decode(content).get('result')
     
     def assertCreated(self, model, code, **fields):
         self.assertIsInstance(code, str)
@@ -83,11 +185,645 @@ class CustomTestCase(TestCase):
             self.assertEqual(getattr(item, field), value)
         return item
     
-    def call_api(self, method, path, data=None, token=None):
+    def explain(self, sql):
+        r'''Collect the database's query plan for a captured SQL statement.
+            Sequential scans are discouraged on PostgreSQL,
+            so that tiny test tables still show which index would be used.
+        '''#"""#'''
+        
+        from django.db import connection
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql)
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+    
+    def assertUsesIndex(self, sql, *indexes):
+        r'''Assert that a query uses at least one of the named indexes.
+        '''#"""#'''
+        
+        plan = self.explain(sql)
+        if not any(index in plan for index in indexes):
+            self.fail('Query does not use %s:\n%s\n%s' % (' or '.join(indexes), sql, plan))
+    
+    def assertQueryBudget(self, exact=None, maximum=None, repeats=1):
+        r'''Pin the queries run within a block, reporting where any extras came from.
+            Identical query shapes are also limited to `repeats` runs each.
+        '''#"""#'''
+        
+        return QueryBudget(self, exact=exact, maximum=maximum, repeats=repeats)
+    
+    def assertScaleInvariant(self, seed, call, sizes=(5, 50), repeats=1):
+        r'''Assert that an operation costs the same queries regardless of data volume.
+            `seed(size)` creates that much data, returning what `call` needs;
+            `call(seeded)` is then run once per size, within a query budget.
+        '''#"""#'''
+        
+        costs = []
+        for size in sizes:
+            seeded = seed(size)
+            with self.assertQueryBudget(repeats=repeats) as budget:
+                call(seeded)
+            costs.append([QueryBudget.shape(sql) for sql, stack in budget.queries])
+        for size, cost in zip(sizes[1:], costs[1:]):
+            if cost != costs[0]:
+                self.fail('Queries differ between %d and %d items:\n%s\n---\n%s' % (
+                    sizes[0], size, '\n'.join(costs[0]), '\n'.join(cost)))
+    
+    def call_api(self, method, path, data=None, token=None, **headers):
         return self.client.generic(
             method = method,
             path = path,
             data = json_encode(data),
             content_type = 'application/json',
             HTTP_AUTHORIZATION = f"Bearer {token}",
+            **headers,
+        )
+
+
+class IdEncoderTests(CustomTestCase):
+    def sample_ids(self, count):
+        from random import randrange
+        limits = [50, 2 ** 24, 2 ** 40, 2 ** 61]
+        return [randrange(limits[n % len(limits)]) for n in range(count)]
+    
+    def sample_codes(self, alphabet, count):
+        from . import idencoder
+        # Mostly valid codes, with some foreign letters and odd lengths.
+        from random import choice, random, randrange
+        letters = alphabet + 'aeiou1-!\u00e9\0'
+        valid = [idencoder.encode(n, alphabet) for n in self.sample_ids(20)]
+        return ['', '\u00e9', '\0'] + [code + '\0' for code in valid] + [code + '\0\0' for code in valid] + [
+            ''.join(choice(letters if random() < 0.05 else alphabet) for n in range(randrange(20)))
+            for n in range(count)
+        ]
+    
+    def assertMatchesScalar(self, alphabet, ids, codes):
+        from . import idencoder
+        self.assertEqual(idencoder.encode_many(ids, alphabet), [idencoder.encode(n, alphabet) for n in ids])
+        self.assertEqual(idencoder.decode_many(codes, alphabet), [idencoder.decode(c, alphabet) for c in codes])
+    
+    def test_batches(self):
+        # Batch functions should be bit-identical to the scalar versions.
+        from unittest import mock
+        from . import idencoder
+        for n in range(5):
+            alphabet = idencoder.random_alphabet()
+            ids = self.sample_ids(3000)
+            codes = [idencoder.encode(n, alphabet) for n in ids] + self.sample_codes(alphabet, 3000)
+            with self.subTest('Default', alphabet=alphabet):
+                self.assertMatchesScalar(alphabet, ids, codes)
+            with self.subTest('Without NumPy', alphabet=alphabet), mock.patch.object(idencoder, 'numpy', None):
+                self.assertMatchesScalar(alphabet, ids, codes)
+    
+    def test_negative(self):
+        from . import idencoder
+        alphabet = idencoder.random_alphabet()
+        with self.assertRaises(ValueError):
+            idencoder.encode_many([1, -1], alphabet)
+        with self.assertRaises(ValueError):
+            idencoder.encode_many(list(range(-1, idencoder.VECTOR_THRESHOLD)), alphabet)
+
+
+class BenchmarkTests(CustomTestCase):
+    def test_measure(self):
+        from .benchmarks import measure
+        from ..accounts.models import Account
+        calls = []
+        
+        def func():
+            calls.append(list(Account.objects.all()))
+        
+        result = measure(func, 20)
+        self.assertEqual(len(calls), 22)
+        self.assertEqual(result['calls'], 20)
+        self.assertEqual(result['queries_per_call'], 1)
+        self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+        self.assertLessEqual(result['p95_ms'], result['p99_ms'])
+        self.assertGreater(result['peak_kb'], 0)
+    
+    def test_regressions(self):
+        from .benchmarks import regressions
+        def timing(p95, queries=1):
+            return {'p95_ms': p95, 'queries_per_call': queries}
+        baseline = {
+            'fast': {'get': timing(10), 'put': timing(10, 3)},
+            'gone': {'get': timing(10)},
+            'same': timing(10),
+        }
+        results = {
+            'fast': {'get': timing(11.9), 'put': timing(12.1, 4)},
+            'new': {'get': timing(50)},
+            'same': timing(10),
+        }
+        self.assertEqual(list(regressions(results, baseline, 0.2)), [
+            'fast.put: p95 10.000ms -> 12.100ms',
+            'fast.put: 3 -> 4 queries',
+        ])
+
+
+class MetricsTests(CustomTestCase):
+    def setUp(self):
+        from .metrics import collector
+        super().setUp()
+        collector.clear()
+    
+    def test_server_timing(self):
+        from ..accounts.factories import TokenFactory
+        token = TokenFactory()
+        response = self.client.get('/documents/', secure=True, HTTP_AUTHORIZATION=f'Bearer {token.uuid}')
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="2 queries"$')
+    
+    @override_settings(METRICS_TOKEN='secret')
+    def test_exposition(self):
+        from ..accounts.factories import TokenFactory
+        token = TokenFactory()
+        for n in range(3):
+            self.client.get('/documents/', secure=True, HTTP_AUTHORIZATION=f'Bearer {token.uuid}')
+        self.client.get('/documents/', secure=True)
+        
+        response = self.client.get('/metrics', secure=True, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertIn('docstore_requests_total{view="documents",method="GET",status="200"} 3', lines)
+        self.assertIn('docstore_requests_total{view="documents",method="GET",status="401"} 1', lines)
+        self.assertIn('docstore_request_duration_seconds_count{view="documents",method="GET"} 4', lines)
+        self.assertIn('docstore_request_duration_seconds_bucket{view="documents",method="GET",le="+Inf"} 4', lines)
+        # The token is cached after its first use.
+        self.assertIn('docstore_db_queries_total{view="documents",method="GET"} 4', lines)
+        self.assertIn('docstore_token_cache_entries 1', lines)
+    
+    def test_histogram(self):
+        from .metrics import Collector
+        collector = Collector(buckets=(0.1, 1))
+        collector.record('view', 'GET', 200, 0.05, 2, 0.01, 100)
+        collector.record('view', 'GET', 404, 0.5)
+        collector.record('view', 'GET', 200, 5)
+        collector.record('view', 'BREW', 418, 0.1)
+        lines = collector.exposition().splitlines()
+        self.assertIn('docstore_request_duration_seconds_bucket{view="view",method="GET",le="0.1"} 1', lines)
+        self.assertIn('docstore_request_duration_seconds_bucket{view="view",method="GET",le="1"} 2', lines)
+        self.assertIn('docstore_request_duration_seconds_bucket{view="view",method="GET",le="+Inf"} 3', lines)
+        self.assertIn('docstore_request_duration_seconds_sum{view="view",method="GET"} 5.550000', lines)
+        self.assertIn('docstore_requests_total{view="view",method="OTHER",status="418"} 1', lines)
+        self.assertIn('docstore_response_bytes_total{view="view",method="GET"} 100', lines)
+    
+    def test_threads(self):
+        from threading import Thread
+        from .metrics import Collector
+        collector = Collector()
+        
+        def work():
+            for n in range(1000):
+                collector.record('view', 'GET', 200, 0.001, 1)
+        
+        threads = [Thread(target=work) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        row = collector.snapshot()[('view', 'GET', 200)]
+        self.assertEqual(len(collector.shards), 4)
+        self.assertEqual(row[0], 4000)
+    
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics', secure=True).status_code, 401)
+        response = self.client.get('/metrics', secure=True, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+    
+    @override_settings(METRICS_TOKEN='')
+    def test_untokened(self):
+        # Without a token, metrics stay private outside of development.
+        self.assertEqual(self.client.get('/metrics', secure=True).status_code, 404)
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get('/metrics', secure=True).status_code, 200)
+
+
+class DispatchTests(CustomTestCase):
+    def test_handlers(self):
+        from django.test import RequestFactory
+        from .views import SimpleView
+        
+        class View(SimpleView):
+            def get(self, request, code):
+                return code
+        
+        factory = RequestFactory()
+        self.assertEqual(View(factory.get('/'), 'x'), 'x')
+        self.assertEqual(View(factory.head('/'), code='y'), 'y')
+        self.assertEqual(View(factory.options('/'))['Allow'], 'GET, HEAD, OPTIONS')
+        response = View(factory.post('/'))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response['Allow'], 'GET, HEAD, OPTIONS')
+        
+        # One instance serves every request, without keeping any of them.
+        self.assertIsInstance(View.instance, View)
+        self.assertEqual(list(vars(View.instance)), ['log'])
+    
+    def test_subclass(self):
+        from django.test import RequestFactory
+        from .views import SimpleView
+        
+        class Base(SimpleView):
+            def get(self, request):
+                return 'base'
+        
+        class View(Base):
+            def get(self, request):
+                return 'view'
+            
+            def delete(self, request):
+                return 'deleted'
+        
+        factory = RequestFactory()
+        self.assertEqual(Base(factory.get('/')), 'base')
+        self.assertEqual(View(factory.get('/')), 'view')
+        self.assertEqual(Base(factory.delete('/')).status_code, 405)
+        self.assertEqual(View(factory.delete('/')), 'deleted')
+        self.assertIsNot(View.instance, Base.instance)
+
+
+class BrokerTests(CustomTestCase):
+    async def test_local(self):
+        from threading import Thread
+        from .broker import LocalBroker
+        broker = LocalBroker()
+        with broker.subscribe('a') as first, broker.subscribe('a') as second, broker.subscribe('b') as other:
+            self.assertEqual(broker.subscribers(), 3)
+            thread = Thread(target=broker.publish, args=['a'])
+            thread.start()
+            thread.join()
+            self.assertTrue(await first.wait(1))
+            self.assertTrue(await second.wait(1))
+            self.assertFalse(await other.wait(0.01))
+            # Each notification wakes a subscriber once.
+            self.assertFalse(await first.wait(0.01))
+        self.assertEqual(broker.subscribers(), 0)
+        self.assertEqual(broker.channels, {})
+    
+    async def test_polling(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .broker import PollingBroker
+        with self.assertRaises(TypeError):
+            PollingBroker()
+        
+        class Broker(PollingBroker):
+            def changed(self, channels):
+                return {channel: changes[channel] for channel in channels if channel in changes}
+        
+        broker = Broker()
+        changes = {'a': timezone.now() - timedelta(minutes=1)}
+        with broker.subscribe('a') as subscription:
+            # Changes from before subscribing are old news.
+            broker.poll()
+            self.assertFalse(await subscription.wait(0.01))
+            changes['a'] = timezone.now()
+            broker.poll()
+            self.assertTrue(await subscription.wait(1))
+            broker.poll()
+            self.assertFalse(await subscription.wait(0.01))
+        self.assertEqual(broker.latest, {})
+
+
+class BrowserMiddlewareTests(CustomTestCase):
+    def test_api(self):
+        from ..accounts.factories import TokenFactory
+        token = TokenFactory()
+        response = self.client.get('/documents/', secure=True, HTTP_AUTHORIZATION=f'Bearer {token.uuid}')
+        self.assertJsonResponse(response)
+        self.assertTrue(response.wsgi_request.sessionless)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertNotIn('X-Frame-Options', response)
+        self.assertIn('Content-Security-Policy', response)
+    
+    def test_anonymous(self):
+        response = self.client.get('/documents/', secure=True)
+        self.assertJsonResponse(response, status_code=401)
+        self.assertFalse(response.wsgi_request.sessionless)
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+    
+    def test_admin(self):
+        # Bearer tokens mean nothing to the admin.
+        response = self.client.get('/admin/', secure=True, HTTP_AUTHORIZATION='Bearer nope')
+        self.assertRedirects(response, '/admin/login/?next=/admin/', fetch_redirect_response=False)
+        self.assertFalse(response.wsgi_request.sessionless)
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+    
+    def test_csrf(self):
+        from django.test import Client
+        client = Client(enforce_csrf_checks=True)
+        for headers in [{}, {'HTTP_AUTHORIZATION': 'Bearer nope'}]:
+            response = client.post('/', secure=True, **headers)
+            self.assertEqual(response.status_code, 403)
+
+
+class QueryBudgetTests(CustomTestCase):
+    def test_exact(self):
+        from ..accounts.factories import AccountFactory
+        from ..accounts.models import Account
+        AccountFactory()
+        with self.assertQueryBudget(exact=1):
+            list(Account.objects.all())
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertQueryBudget(exact=1):
+                list(Account.objects.all())
+                Account.objects.count()
+        # The report should point at the offending line.
+        self.assertIn('Expected 1 queries, but 2 were run', str(raised.exception))
+        self.assertIn('libs/tests.py', str(raised.exception))
+        self.assertIn('Account.objects.count()', str(raised.exception))
+    
+    def test_maximum(self):
+        from ..accounts.models import Account
+        with self.assertQueryBudget(maximum=2):
+            Account.objects.count()
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(maximum=0):
+                Account.objects.count()
+    
+    def test_loop(self):
+        # Repeating a query shape with different parameters should be caught.
+        from ..accounts.factories import TokenFactory
+        from ..accounts.models import Account
+        tokens = TokenFactory.create_batch(3)
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertQueryBudget():
+                for token in tokens:
+                    Account.objects.get(id=token.account_id)
+        self.assertIn('Query ran 3 times', str(raised.exception))
+        with self.assertQueryBudget(repeats=3):
+            for token in tokens:
+                Account.objects.get(id=token.account_id)
+    
+    def test_shape(self):
+        shape = QueryBudget.shape
+        self.assertEqual(shape('SELECT a FROM t WHERE id IN (%s, %s, %s)'), 'SELECT a FROM t WHERE id IN (...)')
+        self.assertEqual(shape('INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)'), shape('INSERT INTO t (a, b) VALUES (%s, %s)'))
+        self.assertEqual(
+            shape('UPDATE t SET a = CASE WHEN ("t"."id" = %s) THEN %s WHEN ("t"."id" = %s) THEN %s ELSE NULL END'),
+            shape('UPDATE t SET a = CASE WHEN ("t"."id" = %s) THEN %s ELSE NULL END'),
         )
+        self.assertEqual(shape('SAVEPOINT "s1234_x5"'), shape('SAVEPOINT "s1234_x6"'))
+        self.assertNotEqual(shape('SELECT a FROM t'), shape('SELECT b FROM t'))
+
+
+class UpdateReturningTests(CustomTestCase):
+    def check(self, queries):
+        from ..accounts.factories import AccountFactory
+        from ..accounts.models import Account
+        accounts = AccountFactory.create_batch(2)
+        now = timezone.now()
+        with self.assertQueryBudget(exact=queries):
+            rows = Account.objects.filter(id=accounts[0].id).update_returning(['name', 'modified'], name='Renamed', modified=now)
+        self.assertEqual([(row.id, row.name, row.modified) for row in rows], [(accounts[0].id, 'Renamed', now)])
+        # Fields that weren't asked for are deferred, rather than stale.
+        self.assertEqual(rows[0].get_deferred_fields(), {'created', 'deleted'})
+        self.assertEqual(Account.objects.get(id=accounts[1].id).name, accounts[1].name)
+        
+        self.assertEqual(Account.objects.filter(id=accounts[0].id, name='Other').update_returning(name='x'), [])
+        self.assertEqual(Account.objects.filter(id__in=[]).update_returning(name='x'), [])
+    
+    def test_returning(self):
+        from django.db import connection
+        from .models import returns_from_update
+        if not returns_from_update(connection):
+            self.skipTest('The database cannot return columns from UPDATE.')
+        self.check(1)
+    
+    def test_fallback(self):
+        # Finding the rows, updating them, and reading them back.
+        from unittest import mock
+        with mock.patch('docstore.libs.models.returns_from_update', return_value=False):
+            self.check(3)
+
+
+class ContentResponseTests(CustomTestCase):
+    def request(self, **headers):
+        from django.test import RequestFactory
+        return RequestFactory().get('/', **headers)
+    
+    def test_byte_range(self):
+        from .views import byte_range
+        for header, expected in [
+            (None, None),
+            ('bytes=0-0', (0, 1)),
+            ('bytes=2-5', (2, 6)),
+            ('bytes=2-', (2, 10)),
+            ('bytes=-3', (7, 10)),
+            ('bytes=-30', (0, 10)),
+            ('bytes=8-30', (8, 10)),
+            ('bytes=10-', False),
+            ('bytes=-0', False),
+            ('bytes=5-2', None),
+            ('bytes=0-1,3-4', None),
+            ('bytes=a-b', None),
+            ('bytes=-', None),
+            ('bytes=1-x', None),
+            ('items=0-1', None),
+        ]:
+            headers = {} if header is None else {'HTTP_RANGE': header}
+            self.assertEqual(byte_range(self.request(**headers), 10, '"tag"'), expected, header)
+        self.assertEqual(byte_range(self.request(HTTP_RANGE='bytes=-1'), 0, '"tag"'), False)
+        self.assertEqual(byte_range(self.request(HTTP_RANGE='bytes=1-2', HTTP_IF_RANGE='"tag"'), 10, '"tag"'), (1, 3))
+        self.assertIsNone(byte_range(self.request(HTTP_RANGE='bytes=1-2', HTTP_IF_RANGE='"old"'), 10, '"tag"'))
+    
+    def test_files(self):
+        # Files running to their end go to the server as they are, ready for sendfile().
+        from tempfile import TemporaryFile
+        from .views import FileSlice, content_response
+        for headers, status, body, sliced in [
+            ({}, 200, b'0123456789', False),
+            ({'HTTP_RANGE': 'bytes=4-'}, 206, b'456789', False),
+            ({'HTTP_RANGE': 'bytes=4-6'}, 206, b'456', True),
+        ]:
+            source = TemporaryFile()
+            source.write(b'0123456789')
+            response = content_response(self.request(**headers), source, 10, '"tag"', 'text/plain')
+            self.assertEqual(response.status_code, status)
+            self.assertIsInstance(response.file_to_stream, FileSlice if sliced else type(source))
+            self.assertEqual(b''.join(response.streaming_content), body)
+            self.assertEqual(response['Content-Length'], str(len(body)))
+            response.close()
+            self.assertTrue(source.closed)
+        
+        source = TemporaryFile()
+        response = content_response(self.request(HTTP_RANGE='bytes=20-'), source, 10, '"tag"', 'text/plain')
+        self.assertEqual(response.status_code, 416)
+        self.assertTrue(source.closed)
+
+
+class EncodingTests(CustomTestCase):
+    def sample(self):
+        from decimal import Decimal
+        from uuid import uuid4
+        return {
+            'text': 'café "quoted" ☃',
+            'numbers': [0, -1, 2 ** 40, Decimal('1.10')],
+            'created': datetime(2020, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc),
+            'modified': datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+            'deleted': None,
+            'uuid': uuid4(),
+            'nested': [{'flag': True}, []],
+        }
+    
+    def test_backends(self):
+        # Every backend should produce the same values.
+        from .encoding import backend, orjson
+        if orjson is None:
+            self.skipTest('orjson is not installed')
+        data = self.sample()
+        stdlib = json_decode(backend('stdlib').encode(data))
+        self.assertEqual(json_decode(backend('orjson').encode(data)), stdlib)
+        self.assertEqual(stdlib['created'], '2020-01-02T03:04:05.678901Z')
+        self.assertEqual(stdlib['modified'], '2020-01-02T03:04:05Z')
+        self.assertEqual(stdlib['uuid'], str(data['uuid']))
+        self.assertEqual(stdlib['numbers'][-1], '1.10')
+    
+    def test_decode(self):
+        # Floats become Decimals, and oddities are handled like the standard library.
+        from decimal import Decimal
+        from .encoding import backend, backends
+        for name in backends:
+            with self.subTest(backend=name):
+                decode = backend(name).decode
+                self.assertEqual(decode(b'{"a": [1, "x"]}'), {'a': [1, 'x']})
+                self.assertEqual(decode(b'{"a": [1.10]}'), {'a': [Decimal('1.10')]})
+                self.assertIsInstance(decode(b'{"a": [1.10]}')['a'][0], Decimal)
+                self.assertEqual(decode(b'[%d]' % 2 ** 70), [2 ** 70])
+                self.assertEqual(decode('"café"'.encode('utf-8')), 'café')
+                with self.assertRaises(ValueError):
+                    decode(b'{"a": ')
+                with self.assertRaises(ValueError):
+                    decode(b'"\xff"')
+    
+    def test_request(self):
+        # Decimal values should survive the trip through a request.
+        from ..accounts.factories import TokenFactory
+        token = TokenFactory()
+        response = self.call_api('POST', '/documents/', {'name': 'pi', 'content': 3.14}, token=token.uuid)
+        result = self.assertJsonResponse(response)
+        self.assertEqual(result['document']['content'], '3.14')
+    
+    @override_settings(JSON_BACKEND='stdlib')
+    def test_stdlib(self):
+        from ..accounts.factories import TokenFactory
+        token = TokenFactory()
+        response = self.call_api('GET', '/documents/?stream=1', token=token.uuid)
+        self.assertEqual(self.assertJsonResponse(response), {'documents': []})
+
+
+class EchoView(AsyncApiView):
+    async def get(self, request):
+        return {'account': request.account.code, 'query': request.GET.get('q')}
+    
+    def post(self, request):
+        from ..accounts.models import Account
+        return {'data': request.POST, 'accounts': Account.objects.count()}
+
+
+urlpatterns = [
+    path('echo/', EchoView),
+    path('', include('docstore.urls')),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncTests(CustomTestCase):
+    # Existing views should work under ASGI, and async views under WSGI.
+    
+    def test_entry_points(self):
+        # Views are synchronous to WSGI, with a coroutine function for ASGI to await.
+        from asyncio import iscoroutinefunction
+        from django.core.handlers.asgi import ASGIHandler
+        from ..asgi import django_application
+        self.assertFalse(iscoroutinefunction(EchoView))
+        self.assertTrue(iscoroutinefunction(EchoView.asgi))
+        self.assertFalse(hasattr(ApiView, 'asgi'))
+        self.assertIsInstance(django_application, AsyncViewRouting)
+        self.assertIsInstance(django_application, ASGIHandler)
+    
+    async def test_awaited(self):
+        # Under ASGI, views must be awaited, never run as synchronous views in a worker thread.
+        from unittest import mock
+        from asgiref.sync import sync_to_async
+        from ..accounts.factories import TokenFactory
+        token = await sync_to_async(TokenFactory)()
+        with mock.patch.object(AsyncApiView, '__call__', side_effect=AssertionError('Served synchronously')):
+            response = await self.async_client.get('/echo/', secure=True, authorization=f'Bearer {token.uuid}')
+            self.assertEqual(self.assertJsonResponse(response), {'account': token.account.code, 'query': None})
+            response = await self.async_client.post('/echo/', json_encode({'x': 1}),
+                content_type='application/json', secure=True, authorization=f'Bearer {token.uuid}')
+            self.assertEqual(self.assertJsonResponse(response), {'data': {'x': 1}, 'accounts': 1})
+    
+    def test_wsgi(self):
+        from ..accounts.factories import TokenFactory
+        token = TokenFactory()
+        response = self.client.get('/echo/?q=1', secure=True, HTTP_AUTHORIZATION=f'Bearer {token.uuid}')
+        self.assertEqual(self.assertJsonResponse(response), {'account': token.account.code, 'query': '1'})
+        response = self.call_api('POST', '/echo/', {'x': 1.5}, token=token.uuid)
+        self.assertEqual(self.assertJsonResponse(response), {'data': {'x': '1.5'}, 'accounts': 1})
+        response = self.call_api('PUT', '/echo/', {}, token=token.uuid)
+        self.assertEqual(response.status_code, 405)
+    
+    async def test_async(self):
+        from asgiref.sync import sync_to_async
+        from ..accounts.factories import TokenFactory
+        from uuid import UUID
+        from ..accounts.models import token_cache
+        token = await sync_to_async(TokenFactory)()
+        auth = f'Bearer {token.uuid}'
+        for n in range(2):
+            response = await self.async_client.get('/echo/', secure=True, authorization=auth)
+            self.assertEqual(self.assertJsonResponse(response), {'account': token.account.code, 'query': None})
+        # The second request should have found the token in the cache.
+        self.assertEqual(token_cache.get(UUID(str(token.uuid))), token)
+        
+        response = await self.async_client.post('/echo/', json_encode({'x': [1]}),
+            content_type='application/json', secure=True, authorization=auth)
+        self.assertEqual(self.assertJsonResponse(response), {'data': {'x': [1]}, 'accounts': 1})
+        
+        response = await self.async_client.get('/echo/', secure=True, authorization='Bearer nope')
+        self.assertJsonResponse(response, status_code=401)
+        response = await self.async_client.get('/echo/', secure=True)
+        self.assertJsonResponse(response, status_code=401)
+    
+    async def test_asgi(self):
+        from asgiref.sync import sync_to_async
+        from ..accounts.factories import TokenFactory
+        from ..documents.factories import DocumentFactory
+        token = await sync_to_async(TokenFactory)()
+        document = await sync_to_async(DocumentFactory)(account=token.account)
+        auth = f'Bearer {token.uuid}'
+        
+        response = await self.async_client.get(f'/documents/{document.code}/', secure=True, authorization=auth)
+        result = self.assertJsonResponse(response)
+        self.assertEqual(result['document']['content'], document.content)
+        
+        # Streams run their queries in a worker thread, a batch at a time, as docstore.asgi sends them.
+        from ..asgi import django_application
+        other = await sync_to_async(DocumentFactory)(account=token.account)
+        messages = []
+        
+        async def send(message):
+            messages.append(message)
+        
+        with self.settings(STREAM_CHUNK_SIZE=1):
+            response = await self.async_client.get('/documents/?stream=1', secure=True, authorization=auth)
+            await django_application.send_response(response, send)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+        result = json_decode(b''.join(message.get('body', b'') for message in messages[1:]))
+        self.assertEqual([doc['id'] for doc in result['result']['documents']], [document.code, other.code])
+        self.assertEqual(set(result['result']), {'documents'})
+        
+        response = await self.async_client.post('/documents/', json_encode({'name': 'x', 'content': 'y'}),
+            content_type='application/json', secure=True, authorization=auth)
+        self.assertJsonResponse(response)
@@ -1,11 +1,34 @@
-from django.core.exceptions import ValidationError
-from django.http.response import HttpResponse, HttpResponseNotAllowed, JsonResponse
+from asyncio import iscoroutinefunction
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.http.response import FileResponse, HttpResponse, HttpResponseBase, HttpResponseNotAllowed
+from django.http.response import StreamingHttpResponse
+
+from .encoding import backend
 
 
 class ViewMeta(type):
-    def __call__(self, request, *args, **kwargs):
+    r'''Builds one shared instance of each view class, and its handler table.
+        Handlers are looked up once, when the class is defined, instead of on
+        every request. The instance serves every thread at once, so views must
+        keep per-request state in the request, never on self.
+    '''#"""#'''
+    
+    def __init__(self, name, bases, namespace):
+        super().__init__(name, bases, namespace)
         instance = super().__call__()
-        return instance(request, *args, **kwargs)
+        handlers = {}
+        for method in self.http_method_names:
+            handler = getattr(instance, method, None)
+            if handler is None and method == 'head':
+                handler = getattr(instance, 'get', None)
+            if handler is not None:
+                handlers[method.upper()] = handler
+        self.handlers = handlers
+        self.instance = instance
+    
+    def __call__(self, request, *args, **kwargs):
+        return self.instance(request, *args, **kwargs)
     
     @property
     def func_name(self):
@@ -20,21 +43,11 @@ class SimpleView(metaclass=ViewMeta):
         self.log = getLogger('%s.%s' % (self.__class__.__module__, self.__class__.__name__))
 
     def __call__(self, request, *args, **kwargs):
-        if hasattr(self, 'get') and not hasattr(self, 'head'):
-            self.head = self.get
-
-        self.request = request
-        self.args = args
-        self.kwargs = kwargs
-
-        if request.method.lower() in self.http_method_names:
-            handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
-        else:
-            handler = self.http_method_not_allowed
+        handler = self.handlers.get(request.method, self.http_method_not_allowed)
         return handler(request, *args, **kwargs)
 
     def _allowed_methods(self):
-        return [m.upper() for m in self.http_method_names if hasattr(self, m)]
+        return list(self.handlers)
 
     def http_method_not_allowed(self, request, *args, **kwargs):
         return HttpResponseNotAllowed(self._allowed_methods())
@@ -51,7 +64,7 @@ class ApiException(Exception):
         self.errors = errors
 
 
-class ApiResponse(JsonResponse):
+class ApiResponse(HttpResponse):
     def __init__(self, result=None, errors=None, status=None, **kwargs):
         if errors:
             if not isinstance(errors, (list, dict)):
@@ -60,27 +73,250 @@ class ApiResponse(JsonResponse):
             if status is None:
                 status = 400
         
-        return super().__init__({
+        kwargs.setdefault('content_type', 'application/json')
+        return super().__init__(backend().encode({
             'result': result,
             'errors': errors,
-        }, status=status, **kwargs)
+        }), status=status, **kwargs)
+
+
+class ApiStreamingResponse(StreamingHttpResponse):
+    r'''Stream a list result in the same envelope as an ApiResponse.
+        Items are serialized as they are consumed, so memory use depends
+        on the size of each item instead of the size of the whole list.
+        Items may also come from an async iterator, for views served through
+        ASGI; only handlers with AsyncViewRouting can send those, as async_content.
+    '''#"""#'''
+
+    def __init__(self, key, items, status=200, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        if hasattr(items, '__aiter__'):
+            super().__init__((), status=status, **kwargs)
+            self.async_content = self.stream_async(key, items, backend())
+        else:
+            super().__init__(self.stream(key, items, backend()), status=status, **kwargs)
+            self.async_content = None
+
+    @staticmethod
+    def stream(key, items, encoder):
+        yield b'{"result":{%s:[' % encoder.encode(key)
+        separator = b''
+        try:
+            for item in items:
+                yield separator + encoder.encode(item)
+                separator = b','
+        except Exception:
+            # The headers are already gone, so the best we can do is to log
+            # the problem and leave the client with truncated JSON.
+            from logging import getLogger
+            getLogger('docstore').exception('Error streaming %s:', key)
+            raise
+        yield b']},"errors":null}'
+
+    @staticmethod
+    async def stream_async(key, items, encoder):
+        yield b'{"result":{%s:[' % encoder.encode(key)
+        separator = b''
+        try:
+            async for item in items:
+                yield separator + encoder.encode(item)
+                separator = b','
+        except Exception:
+            from logging import getLogger
+            getLogger('docstore').exception('Error streaming %s:', key)
+            raise
+        yield b']},"errors":null}'
+
+
+def make_etag(*parts):
+    r'''Build a quoted entity tag from the values that define a representation.
+    '''#"""#'''
+
+    from hashlib import sha1
+    digest = sha1('|'.join(str(part) for part in parts).encode('utf-8'))
+    return '"%s"' % digest.hexdigest()
+
+
+def version_etag(version, *parts):
+    r'''Build an entity tag that shows a version number in the clear, ahead of
+        a digest of the values that define the representation.  Writes can
+        then check If-Match against the version as part of their UPDATE,
+        instead of reading the row first.
+    '''#"""#'''
+
+    return '"%s.%s"' % (version, make_etag(*parts).strip('"'))
+
+
+def matched_versions(request):
+    r'''The versions named by a request's If-Match header, from tags built by
+        version_etag(); None without the header, or with If-Match: *.
+        Weak and unrecognized tags can't match anything, so they're left out.
+    '''#"""#'''
+
+    from django.utils.http import parse_etags
+    header = request.META.get('HTTP_IF_MATCH')
+    if header is None:
+        return None
+    etags = parse_etags(header)
+    if '*' in etags:
+        return None
+    versions = []
+    for etag in etags:
+        version = etag.strip('"').split('.')[0]
+        if etag.startswith('"') and version.isdigit():
+            versions.append(int(version))
+    return versions
+
+
+def is_conditional(request):
+    return 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
+
+
+def conditional_response(request, etag=None, last_modified=None):
+    r'''Answer a request whose validators show that the client is up to date.
+        Returns a 304 (or 412) response, or None if the full response is needed.
+    '''#"""#'''
+
+    from django.utils.cache import get_conditional_response
+    timestamp = None if last_modified is None else int(last_modified.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag=etag, last_modified=last_modified)
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None):
+    from django.utils.http import http_date
+    if etag is not None:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+def byte_range(request, size, etag=None):
+    r'''The byte range requested by a Range header, as (start, stop) offsets;
+        None to send the whole body, without a usable header or when If-Range
+        names another version; or False when no requested byte exists.
+        Requests for several ranges get the whole body, as RFC 7233 allows.
+    '''#"""#'''
+
+    header = request.META.get('HTTP_RANGE', '')
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    if 'HTTP_IF_RANGE' in request.META and request.META['HTTP_IF_RANGE'] != etag:
+        return None
+    first, dash, last = header[len('bytes='):].strip().partition('-')
+    if not dash or not (first or last).isdigit() or (first and last and not last.isdigit()):
+        return None
+    if not first:
+        # A suffix: the last so many bytes.
+        length = int(last)
+        if not length or not size:
+            return False
+        return (max(size - length, 0), size)
+    start = int(first)
+    stop = size if not last else int(last) + 1
+    if start >= size:
+        return False
+    if stop <= start:
+        return None
+    return (start, min(stop, size))
+
+
+class FileSlice(object):
+    r'''Reads no further than a given number of bytes into an open file.
+    '''#"""#'''
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+def content_response(request, source, size, etag, content_type):
+    r'''Serve a raw body, honoring single Range requests.
+        The source is bytes, or a binary file; a file is handed to the server
+        as it is whenever the response runs to its end, so that servers with
+        a wsgi.file_wrapper can send it with sendfile() instead of copying it.
+    '''#"""#'''
+
+    span = byte_range(request, size, etag)
+    if span is False:
+        if not isinstance(source, bytes):
+            source.close()
+        response = ApiResponse(status=416, errors=['Range Not Satisfiable'])
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    start, stop = span or (0, size)
+    if isinstance(source, bytes):
+        response = HttpResponse(source[start:stop], content_type=content_type)
+    else:
+        source.seek(start)
+        if stop < size:
+            source = FileSlice(source, stop - start)
+        response = FileResponse(source, content_type=content_type)
+        # Named after the file's path; meaningless to clients.
+        response.headers.pop('Content-Disposition', None)
+    if span:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+    response['Content-Length'] = stop - start
+    response['Accept-Ranges'] = 'bytes'
+    return response
 
 
 class ApiView(SimpleView):
     auth_required = True
     
+    # Lets BrowserMiddleware skip sessions and CSRF for bearer token requests.
+    sessionless = True
+    
     def __call__(self, request, *args, **kwargs):
-        # Check for an authorization token.
-        if 'HTTP_AUTHORIZATION' in request.META:
+        credential = self.credential(request)
+        token = None
+        if credential:
             from ..accounts.models import Token
-            auth = request.META['HTTP_AUTHORIZATION']
-            prefix = "Bearer "
-            if not auth.startswith(prefix):
-                # Sometime, other types of authorization could be acceptable, or even preferable.
-                return ApiResponse(status=401, errors='Unauthorized')
-            try:
-                token = Token.objects.select_related('account').get(uuid=auth[len(prefix):])
-            except (Token.DoesNotExist, ValidationError):
+            token = Token.authenticate(credential)
+        response = self.prepare(request, credential, token)
+        if response is not None:
+            return response
+        
+        try:
+            result = super().__call__(request, *args, **kwargs)
+        except Exception as err:
+            return self.failure(err)
+        return self.success(result)
+    
+    def credential(self, request):
+        r'''The bearer token sent with a request.
+            Returns None without an Authorization header,
+            or an empty string for other kinds of authorization.
+        '''#"""#'''
+        
+        auth = request.META.get('HTTP_AUTHORIZATION')
+        if auth is None:
+            return None
+        prefix = "Bearer "
+        if not auth.startswith(prefix):
+            # Sometime, other types of authorization could be acceptable, or even preferable.
+            return ''
+        return auth[len(prefix):]
+    
+    def prepare(self, request, credential, token):
+        # Check for an authorization token.
+        if credential is not None:
+            if token is None:
                 return ApiResponse(status=401, errors='Unauthorized')
             request.account = token.account
             request.csrf_processing_done = True
@@ -91,35 +327,115 @@ class ApiView(SimpleView):
 
         # Translate JSON data in the request body.
         if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
-            from decimal import Decimal
-            from json import loads as json_decode
             try:
-                data = json_decode(request.body.decode('utf-8'), parse_float=Decimal)
+                data = backend().decode(request.body)
             except ValueError:
                 return ApiResponse(status=400, errors='Invalid JSON request')
             else:
                 request.POST = data
+        return None
 
+    def failure(self, err):
         # Hide internal server errors.
         from django.core.exceptions import PermissionDenied
-        try:
-            result = super().__call__(request, *args, **kwargs)
-        except PermissionDenied as err:
+        if isinstance(err, PermissionDenied):
             message = str(err) or 'Permission Denied'
             return ApiResponse(errors=[message], status=403)
-        except ApiException as err:
+        if isinstance(err, ApiException):
             return ApiResponse(errors=err.errors, status=400)
-        except Exception as err:
-            self.log.exception('API exception:')
-            from django.conf import settings
-            if settings.DEBUG:
-                message = str(err)
-            else:
-                message = 'Internal server error'
-            return ApiResponse(errors=message, status=500)
 
+        self.log.exception('API exception:')
+        from django.conf import settings
+        if settings.DEBUG:
+            message = str(err)
+        else:
+            message = 'Internal server error'
+        return ApiResponse(errors=message, status=500)
+    
+    def success(self, result):
         # Translate results into responses.
-        if not isinstance(result, HttpResponse):
+        if not isinstance(result, HttpResponseBase):
             result = ApiResponse(result, status=200)
-
         return result
+
+
+class AsyncViewMeta(ViewMeta):
+    r'''Gives each view two entry points: the class itself, called synchronously,
+        as under WSGI, and its `asgi` coroutine function, awaited by handlers
+        using AsyncViewRouting. Coroutine handlers get synchronous wrappers for the former.
+    '''#"""#'''
+    
+    def __init__(self, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        self.async_handlers = self.handlers
+        self.handlers = {
+            method: async_to_sync(handler) if iscoroutinefunction(handler) else handler
+            for method, handler in self.async_handlers.items()
+        }
+        
+        instance = self.instance
+        async def asgi(request, *args, **kwargs):
+            return await instance.serve(request, *args, **kwargs)
+        asgi.__name__ = name
+        asgi.__qualname__ = self.__qualname__ + '.asgi'
+        asgi.__module__ = self.__module__
+        self.asgi = asgi
+
+
+class AsyncViewRouting(object):
+    r'''Mixin for ASGI handlers, to await each AsyncApiView's `asgi` coroutine
+        function in place of the class, which Django would otherwise run as
+        a synchronous view in a worker thread.
+        Also sends streams from async iterators, which Django 3.2 can't.
+    '''#"""#'''
+    
+    def resolve_request(self, request):
+        match = super().resolve_request(request)
+        if isinstance(match.func, AsyncViewMeta):
+            match.func = match.func.asgi
+        return match
+    
+    async def send_response(self, response, send):
+        content = getattr(response, 'async_content', None)
+        if content is None:
+            return await super().send_response(response, send)
+        
+        # As in ASGIHandler.send_response(), but with `async for`.
+        headers = [(header.encode('ascii'), value.encode('latin1')) for header, value in response.items()]
+        headers.extend((b'Set-Cookie', c.output(header='').encode('ascii').strip()) for c in response.cookies.values())
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        try:
+            async for part in content:
+                for chunk, last in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+class AsyncApiView(ApiView, metaclass=AsyncViewMeta):
+    r'''An ApiView that runs in the event loop when served through an ASGI
+        handler with AsyncViewRouting, as in docstore.asgi.
+        Handlers may be coroutines; synchronous handlers, and anything else
+        that touches the database, run in a worker thread instead.
+        Under WSGI, the view runs synchronously, like any other ApiView.
+    '''#"""#'''
+    
+    async def serve(self, request, *args, **kwargs):
+        credential = self.credential(request)
+        token = None
+        if credential:
+            from ..accounts.models import Token
+            token = await Token.authenticate_async(credential)
+        response = self.prepare(request, credential, token)
+        if response is not None:
+            return response
+        
+        try:
+            handler = self.async_handlers.get(request.method, self.http_method_not_allowed)
+            if not iscoroutinefunction(handler):
+                handler = sync_to_async(handler)
+            result = await handler(request, *args, **kwargs)
+        except Exception as err:
+            return self.failure(err)
+        return self.success(result)
@@ -33,22 +33,32 @@ INSTALLED_APPS = [
     'django_extensions',
     
     'docstore.accounts',
+    'docstore.folders',
     'docstore.documents',
 ]
 
 MIDDLEWARE = [
+    'docstore.libs.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'docstore.libs.middleware.BrowserMiddleware',
+    'docstore.libs.middleware.SecurityPolicyMiddleware',
+    'docstore.libs.middleware.ErrorLoggingMiddleware',
+]
+
+# Run within BrowserMiddleware, which skips them for API requests with a bearer token.
+BROWSER_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'docstore.libs.middleware.SecurityPolicyMiddleware',
-    'docstore.libs.middleware.ErrorLoggingMiddleware',
 ]
 
+# The admin's middleware checks only look at MIDDLEWARE, not BROWSER_MIDDLEWARE.
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+
 ROOT_URLCONF = 'docstore.urls'
 
 TEMPLATES = [
@@ -117,6 +127,69 @@ DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 ENCODER_ALPHABETS = settings.AlphabetContainer(env)
 
 
+# API Settings
+
+# Default and maximum number of items in one page of a list response.
+PAGE_SIZE = env.int('PAGE_SIZE', default=100)
+MAX_PAGE_SIZE = env.int('MAX_PAGE_SIZE', default=1000)
+
+# Maximum number of operations accepted by a single batch request.
+MAX_BATCH_SIZE = env.int('MAX_BATCH_SIZE', default=1000)
+
+# Attempts at a conditional write before giving up on a busy document.
+WRITE_ATTEMPTS = env.int('WRITE_ATTEMPTS', default=3)
+
+# Number of rows fetched at a time for streamed list responses.
+STREAM_CHUNK_SIZE = env.int('STREAM_CHUNK_SIZE', default=500)
+
+# Seconds that changes wait before the change feed reports them.
+# On PostgreSQL, the feed also waits for older transactions to finish, so this only has to
+# cover clock skew between servers. Elsewhere, it must exceed the longest transaction
+# that modifies documents; otherwise, a late commit could slip behind a client's cursor.
+CHANGES_SETTLE_TIME = env.float('CHANGES_SETTLE_TIME', default=5)
+
+# Broker for change notifications. LocalBroker only reaches this process;
+# with several, use DocumentPollingBroker, which also polls the database.
+BROKER = env.str('BROKER', default='docstore.libs.broker.LocalBroker')
+BROKER_POLL_INTERVAL = env.float('BROKER_POLL_INTERVAL', default=2)
+
+# Longest wait, in seconds, for a long-poll of /documents/events/poll/.
+# Under WSGI, each waiting client holds one of the server's threads.
+EVENTS_POLL_TIMEOUT = env.float('EVENTS_POLL_TIMEOUT', default=25)
+
+# In-process cache of authentication tokens.
+# Changes made by other processes can take up to TOKEN_CACHE_TTL seconds to be seen.
+TOKEN_CACHE_SIZE = env.int('TOKEN_CACHE_SIZE', default=1000)
+TOKEN_CACHE_TTL = env.float('TOKEN_CACHE_TTL', default=60)
+TOKEN_CACHE_NEGATIVE_TTL = env.float('TOKEN_CACHE_NEGATIVE_TTL', default=5)
+# Unknown tokens are cached separately, so that guessing can't evict real ones.
+TOKEN_CACHE_MISSING_SIZE = env.int('TOKEN_CACHE_MISSING_SIZE', default=200)
+
+# Compression of stored document content: 'zlib', 'lzma', or 'none'.
+# Content smaller than the threshold, in bytes, is always stored as-is.
+CONTENT_COMPRESSION = env.str('CONTENT_COMPRESSION', default='zlib')
+CONTENT_COMPRESSION_THRESHOLD = env.int('CONTENT_COMPRESSION_THRESHOLD', default=1024)
+
+# Storage for large document content: 'files' keeps bodies of at least
+# CONTENT_STORAGE_THRESHOLD bytes in CONTENT_STORAGE_DIRECTORY, uncompressed,
+# so they can be served from disk; empty keeps all content in the database.
+CONTENT_STORAGE = env.str('CONTENT_STORAGE', default='')
+CONTENT_STORAGE_DIRECTORY = env.str('CONTENT_STORAGE_DIRECTORY', default=root('content'))
+CONTENT_STORAGE_THRESHOLD = env.int('CONTENT_STORAGE_THRESHOLD', default=65536)
+
+# Raw content uploads are read this many bytes at a time, up to the maximum size.
+UPLOAD_CHUNK_SIZE = env.int('UPLOAD_CHUNK_SIZE', default=65536)
+MAX_UPLOAD_SIZE = env.int('MAX_UPLOAD_SIZE', default=100 * 1024 * 1024)
+
+# JSON library for API requests and responses: 'orjson', 'stdlib', or 'auto'
+# to use orjson when it's installed.
+JSON_BACKEND = env.str('JSON_BACKEND', default='auto')
+
+# Bearer token required to read /metrics, such as the output of `openssl rand -hex 32`.
+# When it's empty, /metrics is only served with DJANGO_DEBUG on, to anyone.
+METRICS_TOKEN = env.str('METRICS_TOKEN', default='')
+
+
 # Logging Configuration
 LOGGING = {
     'version': 1,
@@ -4,12 +4,22 @@ from django.views.generic.base import RedirectView
 
 from .accounts import views as accounts
 from .documents import views as documents
+from .folders import views as folders
+from .libs import metrics
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^accounts/$', accounts.AccountList, name='accounts'),
     url(r'^documents/$', documents.DocumentList, name='documents'),
+    url(r'^documents/batch/$', documents.DocumentBatch, name='document-batch'),
+    url(r'^documents/changes/$', documents.DocumentChanges, name='document-changes'),
+    url(r'^documents/events/poll/$', documents.DocumentEvents, name='document-events'),
+    url(r'^documents/totals/$', documents.DocumentTotals, name='document-totals'),
     url(r'^documents/(?P<code>d-\w+)/$', documents.DocumentView, name='document'),
+    url(r'^documents/(?P<code>d-\w+)/content$', documents.DocumentContent, name='document-content'),
+    url(r'^folders/$', folders.FolderList, name='folders'),
+    url(r'^folders/(?P<code>f-\w+)/$', folders.FolderView, name='folder'),
+    url(r'^metrics$', metrics.metrics, name='metrics'),
     url(r'^favicon.*$', RedirectView.as_view(url='/static/logo.png', permanent=True), name='favicon'),
     url(r'^$', RedirectView.as_view(url='https://github.com/eswald/docfiles/', permanent=True), name='main'),
 ]